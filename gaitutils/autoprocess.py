@@ -14,8 +14,11 @@ import time
 import logging
 import itertools
 import shutil
+from collections import defaultdict
 
-from . import nexus, eclipse, utils, sessionutils, read_data, videos
+from . import nexus, eclipse, utils, sessionutils, read_data, videos, models
+from . import c3d_numpy
+from .trial import _run_in_pool, _check_errors
 from .envutils import GaitDataError
 from .config import cfg
 from .gui.qt_widgets import ProgressSignals
@@ -23,6 +26,102 @@ from .gui.qt_widgets import ProgressSignals
 logger = logging.getLogger(__name__)
 
 
+def _fail_desc(reason):
+    """Get Eclipse description string for a processing failure"""
+    return (
+        cfg.autoproc.enf_descriptions[reason]
+        if reason in cfg.autoproc.enf_descriptions
+        else reason
+    )
+
+
+def _context_desc(fpev):
+    """Get Eclipse description string for given forceplate events dict"""
+    s = ""
+    nr = len(fpev['R_strikes'])
+    if nr:
+        s += '%dR' % nr
+    nl = len(fpev['L_strikes'])
+    if nr and nl:
+        s += '/'
+    if nl:
+        s += '%dL' % nl
+    return s or cfg.autoproc.enf_descriptions['context_none']
+
+
+def _direction_desc(subj_pos, gait_dim):
+    """Get Eclipse description string for gait direction (may be empty)"""
+    # main direction in lab frame (1,2,3 for x,y,z)
+    inds_ok = np.where(np.any(subj_pos, axis=1))  # ignore gaps
+    subj_pos_ = subj_pos[inds_ok]
+    # +1/-1 for forward/backward (coord increase / decrease)
+    gait_dir = np.median(np.diff(subj_pos_, axis=0), axis=0)[gait_dim]
+    if (
+        'dir_forward' in cfg.autoproc.enf_descriptions
+        and 'dir_backward' in cfg.autoproc.enf_descriptions
+    ):
+        dir_str = 'dir_forward' if gait_dir > 0 else 'dir_backward'
+        return '%s,' % cfg.autoproc.enf_descriptions[dir_str]
+    return ''
+
+
+def _range_to_roi(subj_pos, gait_dim, mov_range):
+    """Try to determine ROI (in frames) from movement range"""
+    subj_pos1 = subj_pos[:, [gait_dim]]
+    # find non-gap frames where we are inside movement range
+    dist_ok = np.where(
+        (subj_pos1 >= mov_range[0])
+        & (subj_pos1 <= mov_range[1])
+        & (subj_pos1 != 0.0)
+    )[0]
+    if dist_ok.size > 0:
+        return min(dist_ok), max(dist_ok)
+    else:
+        raise GaitDataError('no frames inside given range')
+
+
+def _skip_by_description(edata):
+    """Whether to skip a trial based on Eclipse description/notes"""
+    skip = [s.upper() for s in cfg.autoproc.eclipse_skip]
+    return any([s in edata['DESCRIPTION'].upper() for s in skip]) or any(
+        [s in edata['NOTES'].upper() for s in skip]
+    )
+
+
+def _has_gaps(mkrdata):
+    """Whether a MarkerSet has gaps in markers that are not ignored.
+
+    Leading and trailing gaps are not counted. Markers without any data are
+    not considered to have gaps.
+    """
+    has_data = ~mkrdata.gap_mask.all(axis=1)
+    gap_markers = [
+        k
+        for k, marker in enumerate(mkrdata)
+        if marker not in cfg.autoproc.ignore_markers and has_data[k]
+    ]
+    return bool(mkrdata.interior_gap_mask[gap_markers].any())
+
+
+def _write_eclipse_fp_info(enffile, fp_info):
+    """Write Eclipse fp values according to our detection, or reset them.
+
+    Note that Eclipse fp data affects e.g. Plug-in Gait functioning.
+    """
+    try:
+        if cfg.autoproc.write_eclipse_fp_info == 'write':
+            logger.debug('writing detected forceplate info into Eclipse')
+            eclipse.set_eclipse_keys(enffile, fp_info, update_existing=True)
+        elif cfg.autoproc.write_eclipse_fp_info == 'reset':
+            logger.debug('resetting Eclipse forceplate info')
+            fp_info_auto = {k: 'Auto' for k, v in fp_info.items()}
+            eclipse.set_eclipse_keys(enffile, fp_info_auto, update_existing=True)
+        else:
+            logger.debug('ignoring Eclipse forceplate info')
+    except IOError:
+        logger.warning('failed to update Eclipse forceplate info in %s' % enffile)
+
+
 def _do_autoproc(enffiles, signals=None, pipelines_in_proc=True, do_current=False):
     """Run autoprocessing for given enf files."""
     if not cfg.autoproc.run_models_only and cfg.autoproc.delete_c3ds:
@@ -45,45 +144,14 @@ def _do_autoproc(enffiles, signals=None, pipelines_in_proc=True, do_current=Fals
         logger.debug('saving trial')
         vicon.SaveTrial(cfg.autoproc.nexus_timeout)
 
-    def _context_desc(fpev):
-        """Get Eclipse description string for given forceplate events dict"""
-        s = ""
-        nr = len(fpev['R_strikes'])
-        if nr:
-            s += '%dR' % nr
-        nl = len(fpev['L_strikes'])
-        if nr and nl:
-            s += '/'
-        if nl:
-            s += '%dL' % nl
-        return s or cfg.autoproc.enf_descriptions['context_none']
-
     def _fail(trial, reason):
         """Abort processing: mark and save trial"""
-        fail_desc = (
-            cfg.autoproc.enf_descriptions[reason]
-            if reason in cfg.autoproc.enf_descriptions
-            else reason
-        )
+        fail_desc = _fail_desc(reason)
         logger.info(f'preprocessing failed: {fail_desc}')
         trial['recon_ok'] = False
         trial['description'] = fail_desc
         _save_trial()
 
-    def _range_to_roi(subj_pos, gait_dim, mov_range):
-        """Try to determine ROI (in frames) from movement range"""
-        subj_pos1 = subj_pos[:, [gait_dim]]
-        # find non-gap frames where we are inside movement range
-        dist_ok = np.where(
-            (subj_pos1 >= mov_range[0])
-            & (subj_pos1 <= mov_range[1])
-            & (subj_pos1 != 0.0)
-        )[0]
-        if dist_ok.size > 0:
-            return min(dist_ok), max(dist_ok)
-        else:
-            raise GaitDataError('no frames inside given range')
-
     # used to store stats about foot velocity
     foot_vel = {
         'L_strike': np.array([]),
@@ -149,10 +217,7 @@ def _do_autoproc(enffiles, signals=None, pipelines_in_proc=True, do_current=Fals
             trial['recon_ok'] = False
             trial['description'] = 'skipped'
             continue
-        skip = [s.upper() for s in cfg.autoproc.eclipse_skip]
-        if any([s in edata['DESCRIPTION'].upper() for s in skip]) or any(
-            [s in edata['NOTES'].upper() for s in skip]
-        ):
+        if _skip_by_description(edata):
             logger.debug('skipping based on description/notes')
             # run preprocessing + save even for skipped trials, to mark
             # them as processed - mostly so that Eclipse export to Polygon
@@ -176,22 +241,17 @@ def _do_autoproc(enffiles, signals=None, pipelines_in_proc=True, do_current=Fals
         allmarkers = nexus._get_marker_names(vicon, trajs_only=True)
         try:
             mkrdata = read_data.get_marker_data(vicon, allmarkers, ignore_missing=True)
-        except GaitDataError:
+            # the gaps and velocities are then computed once for all checks
+            mkrdata = utils.MarkerSet.from_dict(mkrdata)
+        except (GaitDataError, ValueError):
             logger.info('get_marker_data failed')
             _fail(trial, 'label_failure')
             continue
 
         # fail on any gaps in trial (off by default)
-        gaps_found = False
-        if cfg.autoproc.fail_on_gaps:
-            for marker in set(allmarkers) - set(cfg.autoproc.ignore_markers):
-                gaps = utils.marker_gaps(mkrdata[marker])
-                if gaps.size > 0:
-                    gaps_found = True
-                    break
-            if gaps_found:
-                _fail(trial, 'gaps')
-                continue
+        if cfg.autoproc.fail_on_gaps and _has_gaps(mkrdata):
+            _fail(trial, 'gaps')
+            continue
 
         # check for valid Plug-in Gait set
         if cfg.autoproc.check_marker_set:
@@ -269,19 +329,7 @@ def _do_autoproc(enffiles, signals=None, pipelines_in_proc=True, do_current=Fals
             foot_vel[context + '_toeoff'] = nv
         eclipse_str += ','
 
-        # main direction in lab frame (1,2,3 for x,y,z)
-        inds_ok = np.where(np.any(subj_pos, axis=1))  # ignore gaps
-        subj_pos_ = subj_pos[inds_ok]
-        # +1/-1 for forward/backward (coord increase / decrease)
-        gait_dir = np.median(np.diff(subj_pos_, axis=0), axis=0)[gait_dim]
-        # write Eclipse key for direction
-        if (
-            'dir_forward' in cfg.autoproc.enf_descriptions
-            and 'dir_backward' in cfg.autoproc.enf_descriptions
-        ):
-            dir_str = 'dir_forward' if gait_dir > 0 else 'dir_backward'
-            dir_desc = cfg.autoproc.enf_descriptions[dir_str]
-            eclipse_str += '%s,' % dir_desc
+        eclipse_str += _direction_desc(subj_pos, gait_dim)
 
         # compute gait velocity
         median_vel = utils._trial_median_velocity(vicon)
@@ -291,26 +339,10 @@ def _do_autoproc(enffiles, signals=None, pipelines_in_proc=True, do_current=Fals
         _save_trial()
         trial['description'] = eclipse_str
 
-        # write Eclipse fp values according to our detection, or reset them
-        # note that Eclipse fp data affects e.g. Plug-in Gait functioning
-        fp_info = fpev['our_fp_info']
         # try to avoid a possible race condition where Nexus is still
         # holding the .enf file open
         time.sleep(0.1)
-        try:
-            if cfg.autoproc.write_eclipse_fp_info == 'write':
-                logger.debug('writing detected forceplate info into Eclipse')
-                eclipse.set_eclipse_keys(enffile, fp_info, update_existing=True)
-            elif cfg.autoproc.write_eclipse_fp_info == 'reset':
-                logger.debug('resetting Eclipse forceplate info')
-                fp_info_auto = {k: 'Auto' for k, v in fp_info.items()}
-                eclipse.set_eclipse_keys(enffile, fp_info_auto, update_existing=True)
-            else:
-                logger.debug('ignoring Eclipse forceplate info')
-        except IOError:
-            logger.warning(
-                'failed to update Eclipse forceplate info ' 'in %s' % enffile
-            )
+        _write_eclipse_fp_info(enffile, fpev['our_fp_info'])
 
     # all preprocessing done
     # compute velocity thresholds using all trials
@@ -494,6 +526,350 @@ def autoproc_trial(signals=None):
         )
 
 
+def _c3d_to_enf(c3dfile):
+    """Return the name of the trial .enf file for a c3d file"""
+    return op.splitext(c3dfile)[0] + '.Trial.enf'
+
+
+def _read_eclipse_keys(enffile):
+    """Read Eclipse keys for offline processing; empty if there is no .enf"""
+    if not op.isfile(enffile):
+        logger.warning('.enf file %s does not exist' % enffile)
+        return defaultdict(lambda: '')
+    return eclipse.get_eclipse_keys(enffile, return_empty=True)
+
+
+def _swap_markers(mkrdata, pairs):
+    """Swap the trajectories of the given marker pairs in a MarkerSet"""
+    names = list(mkrdata.names)
+    for m1, m2 in pairs:
+        k1, k2 = names.index(m1), names.index(m2)
+        names[k1], names[k2] = m2, m1
+    return utils.MarkerSet(names, mkrdata.data)
+
+
+def _preprocess_c3d(c3dfile, fp_info):
+    """First pass of offline autoprocessing (worker function).
+
+    Runs the checks of the first pass of _do_autoproc() on a c3d file. fp_info
+    is the Eclipse forceplate info or None. Returns a dict of results. If a
+    check fails, recon_ok is False and the description gives the reason.
+    """
+    trial = {'recon_ok': False}
+
+    def _fail(reason):
+        trial['description'] = _fail_desc(reason)
+        logger.info('preprocessing failed: %s' % trial['description'])
+        return trial
+
+    source = read_data.SourceContext(c3dfile)
+    meta = source.get_metadata()
+    if meta['length'] - 1 < cfg.autoproc.min_trial_duration:
+        return _fail('short')
+
+    # model outputs are stored in the c3d as points too
+    allmarkers = [mkr for mkr in meta['markers'] if models.model_from_var(mkr) is None]
+    try:
+        mkrdata = read_data.get_marker_data(source, allmarkers, ignore_missing=True)
+        mkrdata = utils.MarkerSet.from_dict(mkrdata)
+    except (GaitDataError, ValueError):
+        return _fail('label_failure')
+
+    if cfg.autoproc.fail_on_gaps and _has_gaps(mkrdata):
+        return _fail('gaps')
+
+    if cfg.autoproc.check_marker_set and not utils.is_plugingait_set(mkrdata):
+        logger.info('marker set does not correspond to Plug-in Gait')
+        return _fail('label_failure')
+    # flipped markers cannot be swapped in the c3d file, so they are swapped
+    # in the data used for the subsequent steps
+    trial['flipped'] = list(utils._check_markers_flipped(mkrdata))
+    if trial['flipped']:
+        logger.info('swapping trajectories for %s' % trial['flipped'])
+        mkrdata = _swap_markers(mkrdata, trial['flipped'])
+
+    try:
+        subj_pos = utils.avg_markerdata(mkrdata, cfg.autoproc.track_markers)
+    except GaitDataError:
+        logger.info('gaps in tracking markers')
+        return _fail('label_failure')
+    gait_dim = utils._principal_movement_direction(subj_pos)
+    try:
+        roi = _range_to_roi(subj_pos, gait_dim, cfg.autoproc.events_range)
+    except GaitDataError:
+        return _fail('no_frames_in_range')
+
+    try:
+        fpev = utils.detect_forceplate_events(source, mkrdata, fp_info=fp_info, roi=roi)
+        vel = utils._get_foot_contact_vel(mkrdata, fpev, medians=False, roi=roi)
+    except GaitDataError:
+        logger.warning('cannot determine forceplate events, possibly due to gaps')
+        return _fail('gaps')
+
+    median_vel = utils._trial_median_velocity(source)
+    logger.debug('median forward velocity: %.2f m/s' % median_vel)
+    trial['description'] = '%s,%s%.2f m/s' % (
+        _context_desc(fpev),
+        _direction_desc(subj_pos, gait_dim),
+        median_vel,
+    )
+    trial.update(recon_ok=True, offset=meta['offset'], roi=roi, fpev=fpev, vel=vel)
+    return trial
+
+
+def _trial_events(evs, offset):
+    """Convert an automark event dict into a TrialEvents instance with c3d
+    frame numbers"""
+    events = utils.TrialEvents()
+    for context in ('R', 'L'):
+        for evtype in ('strikes', 'toeoffs'):
+            frames = [int(fr) + offset for fr in evs['%s_%s' % (context, evtype)]]
+            setattr(events, context.lower() + evtype, frames)
+    return events
+
+
+def _mark_c3d(c3dfile, trial, vel_th):
+    """Second pass of offline autoprocessing (worker function).
+
+    Returns the events detected using the pooled velocity thresholds, or None
+    if automarking fails.
+    """
+    markers = (
+        cfg.autoproc.right_foot_markers
+        + cfg.autoproc.left_foot_markers
+        + cfg.autoproc.track_markers
+    )
+    mkrdata = utils.MarkerSet.from_dict(read_data.get_marker_data(c3dfile, markers))
+    if trial['flipped']:
+        mkrdata = _swap_markers(mkrdata, trial['flipped'])
+    try:
+        return utils.automark_events(
+            c3dfile,
+            mkrdata=mkrdata,
+            vel_thresholds=vel_th,
+            fp_events=trial['fpev'],
+            events_range=cfg.autoproc.events_range,
+            start_on_forceplate=cfg.autoproc.start_on_forceplate,
+            roi=trial['roi'],
+            mark=False,
+        )
+    except GaitDataError:
+        logger.debug('automark failed')
+        return None
+
+
+def _map_c3ds(job, args, workers, signals, desc):
+    """Run job(c3dfile, *args) for each (c3dfile, args) item of args in a process
+    pool (see trial._run_in_pool).
+
+    Returns a dict of results and a dict of errors, keyed by c3d file. Returns
+    None if canceled via signals.
+    """
+    items = [(c3dfile,) + args_ for c3dfile, args_ in args]
+    res = _run_in_pool(job, items, workers, signals=signals, desc=desc)
+    if res is None:
+        return None
+    results, errors = res
+    c3dfiles = [c3dfile for c3dfile, _ in args]
+    results = {
+        c3dfiles[k]: result for k, result in enumerate(results) if k not in errors
+    }
+    errors = {c3dfiles[k]: e for k, e in sorted(errors.items())}
+    return results, errors
+
+
+def autoproc_c3ds(
+    c3dfiles,
+    workers=None,
+    on_error='raise',
+    write_events=True,
+    write_eclipse=True,
+    signals=None,
+):
+    """Autoprocess c3d files offline, without Nexus.
+
+    The preprocessing checks, forceplate detection and event marking of Nexus
+    autoprocessing are run directly on the c3d files, which must already
+    contain reconstructed, labeled and filtered marker data. As in Nexus
+    autoprocessing, the trials are processed in two passes: the first pass
+    checks the trials and collects foot velocities at forceplate contacts; the
+    velocities are then pooled across trials into velocity thresholds, which
+    are used in the second pass to mark the events. Both passes are run in a
+    process pool.
+
+    Nexus pipelines are not run and the trials are not cropped. The marked
+    events are written into the EVENT group of the c3d files, so that they are
+    picked up by read_data.get_metadata().
+
+    Parameters
+    ----------
+    c3dfiles : list
+        The c3d files. The corresponding .enf files are expected in the same
+        directory (e.g. 'walk01.c3d' -> 'walk01.Trial.enf').
+    workers : int | None
+        Number of worker processes. If None, taken from cfg.trial.load_workers.
+        If that is None too, the number of CPUs is used.
+    on_error : str
+        What to do when a trial cannot be processed due to an unexpected error
+        (e.g. an unreadable file). If 'raise', raise a GaitDataError listing the
+        errors for each failed trial; no files are written in that case. If
+        'skip', the error is logged and the trial is left out of the results.
+    write_events : bool
+        If True, write the marked events into the c3d files. Existing foot
+        strike and foot off events are replaced.
+    write_eclipse : bool
+        If True, write the description (cfg.autoproc.eclipse_write_key) and the
+        forceplate info (see cfg.autoproc.write_eclipse_fp_info) into the .enf
+        files.
+    signals : ProgressSignals | None
+        This is used to emit processing-related status signals. If None, a dummy
+        instance will be created.
+
+    Returns
+    -------
+    dict | None
+        The results, keyed by c3d file. Each value is a dict with keys
+        'recon_ok', 'description' (the Eclipse description) and 'events' (the
+        event dict from utils.automark_events(), or None if events were not
+        marked). None if the operation was canceled via signals.
+    """
+    if workers is None:
+        workers = cfg.trial.load_workers or os.cpu_count() or 1
+    if on_error not in ('raise', 'skip'):
+        raise ValueError('Invalid on_error: %s' % on_error)
+    if signals is None:
+        signals = ProgressSignals()
+    c3dfiles = [str(c3dfile) for c3dfile in c3dfiles]
+
+    # Eclipse data is needed to decide which trials to skip
+    trials, args = dict(), list()
+    for c3dfile in c3dfiles:
+        edata = _read_eclipse_keys(_c3d_to_enf(c3dfile))
+        if edata['TYPE'] in cfg.autoproc.type_skip or _skip_by_description(edata):
+            logger.debug('skipping %s based on Eclipse data' % c3dfile)
+            trials[c3dfile] = {'recon_ok': False, 'description': 'skipped'}
+        else:
+            fp_info = (
+                eclipse._eclipse_forceplate_keys(edata)
+                if cfg.autoproc.use_eclipse_fp_info
+                else None
+            )
+            args.append((c3dfile, (fp_info,)))
+
+    # 1st pass (map)
+    logger.debug('1st pass - processing %d trial(s)' % len(args))
+    res = _map_c3ds(_preprocess_c3d, args, workers, signals, 'Preprocessing')
+    if res is None:
+        return None
+    results, errors = res
+    trials.update(results)
+
+    # pool the velocities of all trials into thresholds (reduce)
+    foot_vel = defaultdict(list)
+    for trial in trials.values():
+        for context in trial.get('fpev', {}).get('valid', []):
+            for key in (context + '_strike', context + '_toeoff'):
+                foot_vel[key].append(trial['vel'][key])
+    vel_th = dict()
+    for key in ('L_strike', 'R_strike', 'L_toeoff', 'R_toeoff'):
+        x = np.concatenate(foot_vel[key]) if foot_vel[key] else np.array([])
+        vel_th[key] = np.median(x) if x.size > 0 else None
+
+    # 2nd pass (map)
+    args = [(c3dfile, (trial, vel_th)) for c3dfile, trial in trials.items()]
+    args = [item for item in args if item[1][0]['recon_ok']]
+    logger.debug('2nd pass - processing %d trial(s)' % len(args))
+    res = _map_c3ds(_mark_c3d, args, workers, signals, 'Events')
+    if res is None:
+        return None
+    results, errors_ = res
+    errors.update(errors_)
+    for c3dfile, evs in results.items():
+        trial = trials[c3dfile]
+        trial['events'] = evs
+        status = 'ok' if evs is not None else 'automark_failure'
+        desc = cfg.autoproc.enf_descriptions[status]
+        if evs is not None:
+            trial['description'] = '%s,%s' % (desc, trial['description'])
+        else:
+            trial['description'] = '%s,%s' % (trial['description'], desc)
+
+    for c3dfile in errors:
+        trials.pop(c3dfile, None)
+    _check_errors(errors, on_error, 'Could not autoprocess trials')
+
+    if write_events:
+        for c3dfile, trial in trials.items():
+            if trial.get('events') is None:
+                continue
+            try:
+                c3d_numpy._write_events(
+                    c3dfile, _trial_events(trial['events'], trial['offset'])
+                )
+            except (OSError, GaitDataError):
+                logger.warning('failed to write events into %s' % c3dfile)
+
+    if write_eclipse:
+        for c3dfile, trial in trials.items():
+            enffile = _c3d_to_enf(c3dfile)
+            if not op.isfile(enffile):
+                continue
+            if 'fpev' in trial:
+                _write_eclipse_fp_info(enffile, trial['fpev']['our_fp_info'])
+            if cfg.autoproc.eclipse_write_key:
+                try:
+                    eclipse.set_eclipse_keys(
+                        enffile,
+                        {cfg.autoproc.eclipse_write_key: trial['description']},
+                        update_existing=True,
+                    )
+                except IOError:
+                    logger.warning(
+                        'failed to update Eclipse description in %s' % enffile
+                    )
+
+    # results are returned in the order of the input files
+    return {
+        c3dfile: {
+            'recon_ok': trials[c3dfile]['recon_ok'],
+            'description': trials[c3dfile]['description'],
+            'events': trials[c3dfile].get('events'),
+        }
+        for c3dfile in c3dfiles
+        if c3dfile in trials
+    }
+
+
+def autoproc_session_c3ds(sessionpath, patterns=None, **kwargs):
+    """Autoprocess the c3d files of a session offline, without Nexus.
+
+    Parameters
+    ----------
+    sessionpath : str
+        The session path.
+    patterns : list, optional
+        Limit the processing to trialnames that contain given strings. if None,
+        all trials will be processed (but see relevant config options).
+    **kwargs
+        Passed to autoproc_c3ds().
+
+    Returns
+    -------
+    dict | None
+        See autoproc_c3ds().
+    """
+    enffiles = sessionutils.get_enfs(sessionpath)
+    if not enffiles:
+        raise GaitDataError('No trials found (no .enf files in session)')
+    if patterns:
+        # filter trial names according to patterns
+        enffiles = [s for s in enffiles if any([p in s for p in patterns])]
+    c3dfiles = [fn for fn in sessionutils._filter_to_c3ds(enffiles) if op.isfile(fn)]
+    if not c3dfiles:
+        raise GaitDataError('No c3d files found for session')
+    return autoproc_c3ds(c3dfiles, **kwargs)
+
+
 def automark_trial(plot=False):
     """Automatically mark events for the currently loaded Nexus trial.
 
@@ -509,6 +885,7 @@ def automark_trial(plot=False):
     foot_markers = cfg.autoproc.left_foot_markers + cfg.autoproc.right_foot_markers
     mkrs = foot_markers + utils._pig_pelvis_markers()
     mkrdata = read_data.get_marker_data(vicon, mkrs, ignore_missing=True)
+    mkrdata = utils.MarkerSet.from_dict(mkrdata)
     fpe = utils.detect_forceplate_events(vicon, mkrdata, roi=roi)
     vel = utils._get_foot_contact_vel(mkrdata, fpe, roi=roi)
     utils.automark_events(vicon, vel_thresholds=vel, fp_events=fpe, roi=roi, plot=plot)
@@ -18,7 +18,8 @@ import shutil
 
 from .numutils import center_of_pressure, _change_coords, _is_ascii
 from .utils import TrialEvents, _step_width
-from .envutils import lru_cache_checkfile, _named_tempfile, GaitDataError
+from .envutils import file_cache, _named_tempfile, GaitDataError
+from .config import cfg
 
 
 logger = logging.getLogger(__name__)
@@ -30,7 +31,7 @@ try:
     BTK_IMPORTED = True
 except ImportError:
     BTK_IMPORTED = False
-    logger.warning('cannot import btk module; unable to read .c3d files')
+    logger.warning('cannot import btk module; using the NumPy c3d reader')
 
 
 def _is_c3d_file(source):
@@ -73,11 +74,28 @@ def _get_c3d_metadata_field(acq, field, subfield):
         raise RuntimeError('Unhandled btk meta info type')
 
 
-@lru_cache_checkfile
+def _acq_nbytes(acq):
+    """Estimate the memory footprint of a btk acquisition in bytes.
+
+    Each point frame stores values (3 doubles), a residual and a mask, and each
+    analog frame stores a single double per channel.
+    """
+    point_bytes = acq.GetPointNumber() * acq.GetPointFrameNumber() * 5 * 8
+    analog_bytes = acq.GetAnalogNumber() * acq.GetAnalogFrameNumber() * 8
+    return point_bytes + analog_bytes
+
+
+@file_cache(
+    maxbytes=lambda: int(cfg.cache.acq_cache_size_mb * 2 ** 20),
+    sizer=_acq_nbytes,
+    content_hash=lambda: cfg.cache.content_hash,
+)
 def _get_c3dacq(c3dfile):
     """Get a btk c3dacq object.
 
-    Object is returned from cache if filename and digest match.
+    Object is returned from cache if the file has not changed on disk (see
+    envutils.file_cache). Cache statistics are available via
+    _get_c3dacq.cache_info().
     """
     reader = btk.btkAcquisitionFileReader()
     c3dfile = str(c3dfile)  # str conversion to accept Path objects too
@@ -108,7 +126,7 @@ def _get_c3dacq(c3dfile):
     return reader.GetOutput()
 
 
-def get_analysis(c3dfile, condition='unknown'):
+def get_analysis(c3dfile, condition='unknown', ctx=None):
     """Get analysis values from c3d (e.g. gait parameters).
 
     Parameters
@@ -117,6 +135,9 @@ def get_analysis(c3dfile, condition='unknown'):
         Name of the file.
     condition : str, optional
         The condition name, by default 'unknown'.
+    ctx : SourceContext | Trial, optional
+        If step width needs to be computed, the data is read via this object
+        instead of re-reading the file.
 
     Returns
     -------
@@ -134,6 +155,11 @@ def get_analysis(c3dfile, condition='unknown'):
     except RuntimeError:
         raise GaitDataError('Cannot read time-distance parameters from %s' % c3dfile)
 
+    return _analysis_dict(c3dfile, condition, vars_, units, contexts, vals, ctx=ctx)
+
+
+def _analysis_dict(c3dfile, condition, vars_, units, contexts, vals, ctx=None):
+    """Build the get_analysis() output dict from the ANALYSIS parameters"""
     # build a nice output dict
     di = defaultdict(lambda: defaultdict(dict))
     di_ = di[condition]
@@ -155,7 +181,7 @@ def get_analysis(c3dfile, condition='unknown'):
     # needed
     if 'Step Width' not in di_:
         logger.warning('computing step widths (not found in %s)' % c3dfile)
-        sw = _step_width(c3dfile)
+        sw = _step_width(c3dfile if ctx is None else ctx)
         di[condition]['Step Width'] = dict()
         # XXX: currently uses average of all cycles from trial
         di[condition]['Step Width']['Right'] = np.array(sw['R']).mean()
@@ -242,8 +268,21 @@ def _get_c3d_subject_param(acq, param):
 def _get_metadata(c3dfile):
     """Read trial and subject metadata from c3d file.
 
+    The metadata is read by parsing only the c3d header and parameters (see
+    c3d_numpy._get_metadata), which avoids loading the whole acquisition.
+
     See read_data.get_metadata() for details.
     """
+    from .c3d_numpy import _get_metadata as _get_metadata_header
+
+    return _get_metadata_header(c3dfile)
+
+
+def _get_metadata_btk(c3dfile):
+    """Read trial and subject metadata from c3d file using btk.
+
+    This loads the whole acquisition. Kept for reference and testing.
+    """
     c3dfile = Path(c3dfile)
     trialname = c3dfile.stem
     sessionpath = c3dfile.parent
@@ -364,51 +403,62 @@ def _get_forceplate_data(c3dfile):
             # Nexus should always write forceplates as type 2
             raise GaitDataError('Only type 2 forceplates are supported for now')
         rawdata = dict()
-        data = dict()
         for ch in btk.Iterate(plate.GetChannels()):
             label = ch.GetLabel()[-3:-1]  # strip descriptor and plate number
             rawdata[label] = np.squeeze(ch.GetData().GetValues())
         if not all([ch in rawdata for ch in read_chs]):
             logger.warning('could not read force/moment data for plate %d' % nplate)
             continue
-        F = np.stack([rawdata['Fx'], rawdata['Fy'], rawdata['Fz']], axis=1)
-        M = np.stack([rawdata['Mx'], rawdata['My'], rawdata['Mz']], axis=1)
         # we need to calculate center of pressure, since it's not in the c3d
         # this should be the plate thickness (from moment origin to physical
         # origin) needed for center of pressure calculations
         dz = np.abs(plate.GetOrigin()[2])
-        cop = center_of_pressure(F, M, dz)  # in plate local coords
-        Ftot = np.linalg.norm(F, axis=1)
-        # locations of +x+y, -x+y, -x-y, +x-y plate corners in world coords
-        # (in that order)
-        cor = plate.GetCorners()
-        wT = np.mean(cor, axis=1)  # translation vector, plate -> world
-        # upper and lower bounds of forceplate
-        ub = np.max(cor, axis=1)
-        lb = np.min(cor, axis=1)
-        # plate unit vectors in world system
-        px = cor[:, 0] - cor[:, 1]
-        py = cor[:, 0] - cor[:, 3]
-        pz = np.array([0, 0, -1])
-        P = np.stack([px, py, pz], axis=1)
-        wR = P / np.linalg.norm(P, axis=0)  # rotation matrix, plate -> world
-        # check whether CoP stays inside forceplate area and clip if necessary
-        cop_w = _change_coords(cop, wR, wT)
-        cop_wx = np.clip(cop_w[:, 0], lb[0], ub[0])
-        cop_wy = np.clip(cop_w[:, 1], lb[1], ub[1])
-        if not (cop_wx == cop_w[:, 0]).all() and (cop_wy == cop_w[:, 1]).all():
-            logger.warning(
-                'center of pressure outside forceplate bounds, clipping to plate'
-            )
-            cop[:, 0] = cop_wx
-            cop[:, 1] = cop_wy
-        # XXX moment and force transformations may still be wrong
-        data['F'] = _change_coords(-F, wR, 0)  # not sure why sign flip needed
-        data['Ftot'] = Ftot
-        data['M'] = _change_coords(-M, wR, 0)  # not sure why sign flip needed
-        data['CoP'] = cop_w
-        data['wR'] = wR
-        data['wT'] = wT
-        data['plate_corners'] = cor.T
+        data = _plate_data(rawdata, dz, plate.GetCorners())
         fpdata.append(data)
     return fpdata
+
+
+def _plate_data(rawdata, dz, cor):
+    """Compute forceplate data in world coordinates.
+
+    rawdata is a dict of the plate channels (Fx, Fy, Fz, Mx, My, Mz), dz is the
+    plate thickness (from moment origin to physical origin) needed for center
+    of pressure calculations, and cor is a 3x4 array of the plate corners in
+    world coordinates.
+    """
+    data = dict()
+    F = np.stack([rawdata['Fx'], rawdata['Fy'], rawdata['Fz']], axis=1)
+    M = np.stack([rawdata['Mx'], rawdata['My'], rawdata['Mz']], axis=1)
+    cop = center_of_pressure(F, M, dz)  # in plate local coords
+    Ftot = np.linalg.norm(F, axis=1)
+    # locations of +x+y, -x+y, -x-y, +x-y plate corners in world coords
+    # (in that order)
+    wT = np.mean(cor, axis=1)  # translation vector, plate -> world
+    # upper and lower bounds of forceplate
+    ub = np.max(cor, axis=1)
+    lb = np.min(cor, axis=1)
+    # plate unit vectors in world system
+    px = cor[:, 0] - cor[:, 1]
+    py = cor[:, 0] - cor[:, 3]
+    pz = np.array([0, 0, -1])
+    P = np.stack([px, py, pz], axis=1)
+    wR = P / np.linalg.norm(P, axis=0)  # rotation matrix, plate -> world
+    # check whether CoP stays inside forceplate area and clip if necessary
+    cop_w = _change_coords(cop, wR, wT)
+    cop_wx = np.clip(cop_w[:, 0], lb[0], ub[0])
+    cop_wy = np.clip(cop_w[:, 1], lb[1], ub[1])
+    if not (cop_wx == cop_w[:, 0]).all() and (cop_wy == cop_w[:, 1]).all():
+        logger.warning(
+            'center of pressure outside forceplate bounds, clipping to plate'
+        )
+        cop[:, 0] = cop_wx
+        cop[:, 1] = cop_wy
+    # XXX moment and force transformations may still be wrong
+    data['F'] = _change_coords(-F, wR, 0)  # not sure why sign flip needed
+    data['Ftot'] = Ftot
+    data['M'] = _change_coords(-M, wR, 0)  # not sure why sign flip needed
+    data['CoP'] = cop_w
+    data['wR'] = wR
+    data['wT'] = wT
+    data['plate_corners'] = cor.T
+    return data
@@ -0,0 +1,742 @@
+# -*- coding: utf-8 -*-
+"""
+Pure NumPy c3d reader functions.
+
+An alternative to the btk based reader in c3d.py, with the same interface. The
+header and parameter section are parsed directly, and the data block is
+memory-mapped and decoded with vectorized NumPy operations. Only the requested
+point and analog columns are decoded.
+
+Select the reader by the config item general.c3d_reader. This reader is also
+used if btk is not installed.
+
+Gait events can also be written back into the EVENT group of a file (see
+_write_events).
+
+NB: do not use the data readers from this file directly. They are intended to be
+called via the read_data module.
+
+@author: Jussi (jnu@iki.fi)
+"""
+
+from collections import defaultdict
+import copy
+import logging
+import os
+from pathlib import Path
+import shutil
+import struct
+
+import numpy as np
+
+from .c3d import _analysis_dict, _plate_data
+from .utils import TrialEvents
+from .envutils import file_cache, GaitDataError
+
+
+logger = logging.getLogger(__name__)
+
+BLOCK_SIZE = 512
+# max total size of parsed parameter sections to keep in memory
+PARAM_CACHE_BYTES = 32 * 2 ** 20
+# max number of memoized metadata dicts
+METADATA_CACHE_ENTRIES = 1024
+# processor types from the parameter section header
+PROC_INTEL, PROC_DEC, PROC_MIPS = 84, 85, 86
+# parameter data types
+PARAM_TYPES = {-1: 'S1', 1: 'i1', 2: 'i2', 4: 'f4'}
+# EVENT group parameters that are replaced when writing events
+EVENT_PARAMS = [
+    'USED',
+    'CONTEXTS',
+    'LABELS',
+    'DESCRIPTIONS',
+    'TIMES',
+    'SUBJECTS',
+    'ICON_IDS',
+    'GENERIC_FLAGS',
+]
+# event descriptions and icon ids as written by Nexus
+EVENT_DESCRIPTIONS = {
+    'Foot Strike': 'The instant the heel strikes the ground',
+    'Foot Off': 'The instant the toe leaves the ground',
+}
+EVENT_ICON_IDS = {'Foot Strike': 1, 'Foot Off': 2}
+
+
+def _dec_to_ieee(buf):
+    """Convert DEC (VAX F) 32-bit floats in a byte buffer to float32.
+
+    The 16-bit words of DEC floats are in reverse order compared to Intel, and
+    the exponent bias differs by 2.
+    """
+    b = np.frombuffer(buf, dtype=np.uint8).reshape(-1, 4)
+    b = b[:, [2, 3, 0, 1]].copy()
+    return b.view('<f4').ravel() / 4.0
+
+
+def _ieee_to_dec(vals):
+    """Convert floats into DEC (VAX F) 32-bit floats in a byte buffer"""
+    b = (np.asarray(vals, dtype='<f4') * 4.0).astype('<f4')
+    b = b.view(np.uint8).reshape(-1, 4)
+    return b[:, [2, 3, 0, 1]].tobytes()
+
+
+class _C3DFile:
+    """Parsed c3d header and parameters.
+
+    Parameters are stored in the params dict, keyed by (GROUP, PARAM) in upper
+    case. The original parameter names of each group are in the param_names
+    dict. Numeric
+    parameters are ndarrays whose shape is the reversed c3d dimension list (so
+    that the first c3d dimension is the last array axis). Character parameters
+    are lists of stripped strings, or strings for one-dimensional parameters.
+    """
+
+    def __init__(self, c3dfile):
+        self.filename = str(c3dfile)
+        with open(self.filename, 'rb') as f:
+            header = f.read(BLOCK_SIZE)
+            if len(header) < BLOCK_SIZE or header[1] != 0x50:
+                raise GaitDataError('%s is not a valid c3d file' % self.filename)
+            param_start = (header[0] - 1) * BLOCK_SIZE
+            f.seek(param_start)
+            param_header = f.read(4)
+            n_param_blocks, proc = param_header[2], param_header[3]
+            if proc not in (PROC_INTEL, PROC_DEC, PROC_MIPS):
+                raise GaitDataError('Unknown c3d processor type %d' % proc)
+            self.proc = proc
+            self.endian = '>' if proc == PROC_MIPS else '<'
+            # some writers put a wrong block count into the parameter header,
+            # so read everything up to the start of the data
+            data_start = (int(self._ints(header[16:18])[0]) - 1) * BLOCK_SIZE
+            param_len = data_start - param_start
+            if param_len <= 0:
+                param_len = n_param_blocks * BLOCK_SIZE
+            f.seek(param_start)
+            param_bytes = f.read(param_len)
+        self.nbytes = len(param_bytes)
+        self.params = dict()
+        self._parse_params(param_bytes)
+        self._parse_header(header)
+
+    def _ints(self, buf, dtype='i2'):
+        return np.frombuffer(buf, dtype=self.endian + dtype)
+
+    def _floats(self, buf):
+        if self.proc == PROC_DEC:
+            return _dec_to_ieee(buf)
+        return np.frombuffer(buf, dtype=self.endian + 'f4')
+
+    def _parse_header(self, header):
+        """Parse the header block"""
+        words = self._ints(header[:24])
+        self.n_points = int(words[1])
+        self.analog_per_frame = int(words[2])
+        # frame numbers are unsigned
+        self.first_frame = int(words[3]) & 0xFFFF
+        self.last_frame = int(words[4]) & 0xFFFF
+        self.point_scale = float(self._floats(header[12:16])[0])
+        self.data_start = (int(self._ints(header[16:18])[0]) - 1) * BLOCK_SIZE
+        self.samplesperframe = int(self._ints(header[18:20])[0])
+        self.framerate = float(self._floats(header[20:24])[0])
+        # 32-bit frame numbers for long trials, stored as pairs of words
+        for par, attr in [
+            ('ACTUAL_START_FIELD', 'first_frame'),
+            ('ACTUAL_END_FIELD', 'last_frame'),
+        ]:
+            val = self.params.get(('TRIAL', par))
+            if val is not None and val.size == 2:
+                lo, hi = val.astype(np.int64) & 0xFFFF
+                setattr(self, attr, int(lo + hi * 2 ** 16))
+        self.is_float = self.point_scale < 0
+        self.n_analog = int(self.param('ANALOG', 'USED', 0))
+        if self.n_analog and self.samplesperframe == 0:
+            self.samplesperframe = self.analog_per_frame // self.n_analog
+        self.analograte = float(
+            self.param('ANALOG', 'RATE', self.framerate * self.samplesperframe)
+        )
+        self.length = self.last_frame - self.first_frame + 1
+
+    def _records(self, buf):
+        """Iterate over the records of a parameter section.
+
+        Yields (gid, name, pos, pos_data) for each record, where pos is the
+        start of the record and pos_data the start of its contents (after the
+        offset to the next record). Negative gid denotes a group record.
+        """
+        pos = 4
+        while pos < len(buf) - 2:
+            nchars = abs(int(np.frombuffer(buf, dtype='i1', count=1, offset=pos)[0]))
+            if nchars == 0:
+                break
+            gid = int(np.frombuffer(buf, dtype='i1', count=1, offset=pos + 1)[0])
+            name = buf[pos + 2 : pos + 2 + nchars].decode('latin-1')
+            pos_offset = pos + 2 + nchars
+            next_offset = int(self._ints(buf[pos_offset : pos_offset + 2])[0])
+            yield gid, name, pos, pos_offset + 2
+            if next_offset == 0:
+                break
+            pos = pos_offset + next_offset
+
+    def _parse_params(self, buf):
+        """Parse the parameter section"""
+        groups = dict()
+        params = list()
+        for gid, name, _, pos_data in self._records(buf):
+            if gid < 0:
+                groups[-gid] = name.upper()
+            else:
+                params.append((gid, name, self._parse_param_data(buf, pos_data)))
+        self.param_names = defaultdict(list)
+        for gid, name, value in params:
+            if gid in groups:
+                self.params[(groups[gid], name.upper())] = value
+                self.param_names[groups[gid]].append(name)
+
+    def _parse_param_data(self, buf, pos):
+        """Parse the value of a parameter record starting at pos"""
+        dtype = int(np.frombuffer(buf, dtype='i1', count=1, offset=pos)[0])
+        ndims = buf[pos + 1]
+        dims = list(buf[pos + 2 : pos + 2 + ndims])
+        pos += 2 + ndims
+        nbytes = abs(dtype) * int(np.prod(dims))
+        raw = buf[pos : pos + nbytes]
+        if dtype == -1:
+            if ndims <= 1:
+                return raw.decode('latin-1').strip()
+            strlen = dims[0]
+            if strlen == 0:
+                return list()
+            return [
+                raw[k : k + strlen].decode('latin-1').strip()
+                for k in range(0, len(raw), strlen)
+            ]
+        elif dtype == 4:
+            vals = self._floats(raw)
+        elif dtype in PARAM_TYPES:
+            vals = self._ints(raw, dtype=PARAM_TYPES[dtype])
+        else:
+            raise GaitDataError('Invalid c3d parameter type %d' % dtype)
+        return vals.reshape(dims[::-1]) if ndims else vals
+
+    def param(self, group, name, default=None):
+        """Return a parameter value, or default if it does not exist"""
+        val = self.params.get((group, name.upper()))
+        if val is None:
+            return default
+        if isinstance(val, np.ndarray) and val.size == 1:
+            return val.ravel()[0]
+        return val
+
+    def param_list(self, group, name):
+        """Return a parameter as a list, concatenating the continuation
+        parameters (e.g. LABELS, LABELS2, LABELS3...)"""
+        vals = list()
+        for k in range(1, 100):
+            key = (group, name if k == 1 else '%s%d' % (name, k))
+            if key not in self.params:
+                break
+            val = self.params[key]
+            if isinstance(val, str):
+                vals.append(val)
+            elif isinstance(val, list):
+                vals.extend(val)
+            else:
+                vals.extend(val.ravel().tolist())
+        return vals
+
+    @property
+    def point_labels(self):
+        return self.param_list('POINT', 'LABELS')[: self.n_points]
+
+    @property
+    def analog_labels(self):
+        return self.param_list('ANALOG', 'LABELS')[: self.n_analog]
+
+    @property
+    def analog_descriptions(self):
+        return self.param_list('ANALOG', 'DESCRIPTIONS')[: self.n_analog]
+
+    def _frame_data(self):
+        """Memory-map the data block as a (n_frames, words_per_frame) array"""
+        words_per_frame = 4 * self.n_points + self.analog_per_frame
+        if self.is_float:
+            dtype = np.dtype('<u4' if self.proc == PROC_DEC else self.endian + 'f4')
+        else:
+            dtype = np.dtype(self.endian + 'i2')
+        frame_bytes = words_per_frame * dtype.itemsize
+        file_bytes = Path(self.filename).stat().st_size - self.data_start
+        n_frames = min(self.length, file_bytes // frame_bytes)
+        if n_frames < self.length:
+            logger.warning(
+                '%s is truncated: %d frames found, %d expected'
+                % (self.filename, n_frames, self.length)
+            )
+        return np.memmap(
+            self.filename,
+            dtype=dtype,
+            mode='r',
+            offset=self.data_start,
+            shape=(n_frames, words_per_frame),
+        )
+
+    def _decode(self, raw):
+        """Decode raw data words into float64"""
+        if self.is_float and self.proc == PROC_DEC:
+            return _dec_to_ieee(raw.tobytes()).reshape(raw.shape).astype(np.float64)
+        return raw.astype(np.float64)
+
+    def read_points(self, indices):
+        """Read data for given point indices.
+
+        Returns a (n_points, n_frames, 3) array. Invalid data (negative
+        residual) is set to zero.
+        """
+        data = self._frame_data()
+        indices = np.asarray(indices, dtype=int)
+        cols = (4 * indices[:, None] + np.arange(4)).ravel()
+        raw = self._decode(data[:, cols]).reshape(data.shape[0], len(indices), 4)
+        vals = raw[:, :, :3]
+        if not self.is_float:
+            vals = vals * self.point_scale
+        vals[raw[:, :, 3] < 0] = 0
+        return np.ascontiguousarray(vals.transpose(1, 0, 2))
+
+    def read_analog(self, indices):
+        """Read scaled data for given analog channel indices.
+
+        Returns a (n_channels, n_samples) C-contiguous array, so that the
+        channels are contiguous too.
+        """
+        data = self._frame_data()
+        n_frames = data.shape[0]
+        indices = np.asarray(indices, dtype=int)
+        spf = self.samplesperframe
+        # within a frame, analog samples are ordered sample by sample
+        cols = 4 * self.n_points + (
+            np.arange(spf)[:, None] * self.n_analog + indices
+        ).ravel()
+        raw = data[:, cols]
+        if not self.is_float and self.param('ANALOG', 'FORMAT') == 'UNSIGNED':
+            raw = raw.view(np.uint16)
+        raw = self._decode(raw).reshape(n_frames * spf, len(indices))
+        scales = np.array(self.param_list('ANALOG', 'SCALE'))
+        offsets = np.array(self.param_list('ANALOG', 'OFFSET'))
+        if self.param('ANALOG', 'FORMAT') == 'UNSIGNED':
+            offsets = offsets.astype(np.int64) & 0xFFFF
+        gen_scale = float(self.param('ANALOG', 'GEN_SCALE', 1.0))
+        scales = scales[indices] if scales.size else np.ones(len(indices))
+        offsets = offsets[indices] if offsets.size else np.zeros(len(indices))
+        return np.ascontiguousarray(((raw - offsets) * scales * gen_scale).T)
+
+
+@file_cache(maxbytes=PARAM_CACHE_BYTES, sizer=lambda c3d: c3d.nbytes)
+def _get_c3dfile(c3dfile):
+    """Parse c3d header and parameters.
+
+    Object is returned from cache if the file has not changed on disk.
+    """
+    return _C3DFile(c3dfile)
+
+
+def get_analysis(c3dfile, condition='unknown', ctx=None):
+    """Get analysis values from c3d (e.g. gait parameters).
+
+    See c3d.get_analysis() for details.
+    """
+    logger.debug('getting analysis values from %s' % c3dfile)
+    c3d = _get_c3dfile(c3dfile)
+    if ('ANALYSIS', 'NAMES') not in c3d.params:
+        raise GaitDataError('Cannot read time-distance parameters from %s' % c3dfile)
+    fields = [
+        c3d.param_list('ANALYSIS', field)
+        for field in ['NAMES', 'UNITS', 'CONTEXTS', 'VALUES']
+    ]
+    return _analysis_dict(c3dfile, condition, *fields, ctx=ctx)
+
+
+def _get_emg_data(c3dfile):
+    """Read EMG data from a c3d file.
+
+    See read_data.get_emg_data() for details.
+    """
+    return _get_analog_data(c3dfile, 'EMG')
+
+
+def _get_accelerometer_data(c3dfile):
+    """Read accelerometer data from a c3d file"""
+    data = _get_analog_data(c3dfile, 'Accelerometer')
+    # Remove the 'Acceleration.' prefix if inserted by Nexus, so that channel
+    # names match Nexus.
+    data['data'] = {
+        (key[13:] if key.find('Acceleration.') == 0 else key): val
+        for key, val in data['data'].items()
+    }
+    return data
+
+
+def _get_analog_data(c3dfile, devname):
+    """Read analog data from a c3d file.
+
+    devname is matched against channel descriptions.
+    """
+    c3d = _get_c3dfile(c3dfile)
+    labels = c3d.analog_labels
+    descs = c3d.analog_descriptions
+    inds = [k for k, desc in enumerate(descs) if desc.find(devname) >= 0]
+    if not inds:
+        raise GaitDataError(
+            'No analog channels matching device %s found in data' % devname
+        )
+    vals = c3d.read_analog(inds)
+    data = {labels[ind]: val for ind, val in zip(inds, vals)}
+    return {'t': np.arange(vals.shape[1]) / c3d.analograte, 'data': data}
+
+
+def _get_marker_data(c3dfile, markers, ignore_missing=False):
+    """Get position data for specified markers.
+
+    See read_data.get_marker_data for details.
+    """
+    if not isinstance(markers, list):  # listify if not already a list
+        markers = [markers]
+    c3d = _get_c3dfile(c3dfile)
+    labels = c3d.point_labels
+    mkr_inds = dict()
+    for marker in markers:
+        if marker in labels:
+            mkr_inds[marker] = labels.index(marker)
+        elif ignore_missing:
+            logger.warning('Cannot read trajectory %s from c3d file' % marker)
+        else:
+            raise GaitDataError('Cannot read trajectory %s from c3d file' % marker)
+    vals = c3d.read_points(list(mkr_inds.values()))
+    return dict(zip(mkr_inds.keys(), vals))
+
+
+def _get_c3d_subject_param(c3d, param):
+    val = c3d.param('PROCESSING', param)
+    if isinstance(val, list):
+        val = val[0] if val else None
+    elif isinstance(val, np.ndarray):
+        val = float(val.ravel()[0]) if val.size else None
+    elif val is not None and not isinstance(val, str):
+        val = float(val)
+    if val is None:
+        logger.warning('Cannot get subject parameter %s' % param)
+    return val
+
+
+def _get_events(c3d):
+    """Read gait events from the EVENT group"""
+    n_events = int(c3d.param('EVENT', 'USED', 0))
+    rstrikes, lstrikes, rtoeoffs, ltoeoffs = [], [], [], []
+    if n_events:
+        labels = c3d.param_list('EVENT', 'LABELS')[:n_events]
+        contexts = c3d.param_list('EVENT', 'CONTEXTS')[:n_events]
+        # times are stored as (minutes, seconds) pairs
+        times = np.reshape(c3d.params[('EVENT', 'TIMES')], (-1, 2))[:n_events]
+        secs = times[:, 0] * 60.0 + times[:, 1]
+        # c3d frame numbering starts from 1 at time 0
+        frames = np.round(secs * c3d.framerate).astype(int) + 1
+        for label, context, frame in zip(labels, contexts, frames):
+            frame = int(frame)
+            if label == 'Foot Strike':
+                if context == 'Right':
+                    rstrikes.append(frame)
+                elif context == 'Left':
+                    lstrikes.append(frame)
+                else:
+                    raise GaitDataError("Unknown context on foot strike event")
+            elif label == 'Foot Off':
+                if context == 'Right':
+                    rtoeoffs.append(frame)
+                elif context == 'Left':
+                    ltoeoffs.append(frame)
+                else:
+                    raise GaitDataError("Unknown context on foot strike event")
+    return TrialEvents(
+        rstrikes=rstrikes, lstrikes=lstrikes, rtoeoffs=rtoeoffs, ltoeoffs=ltoeoffs
+    )
+
+
+def _record_end(buf, gid, pos_data):
+    """Return the end of the contents of a parameter section record"""
+    pos = pos_data
+    if gid > 0:  # parameter type, dimensions and data precede the description
+        dtype = int(np.frombuffer(buf, dtype='i1', count=1, offset=pos)[0])
+        ndims = buf[pos + 1]
+        dims = list(buf[pos + 2 : pos + 2 + ndims])
+        pos += 2 + ndims + abs(dtype) * int(np.prod(dims))
+    return pos + 1 + buf[pos]
+
+
+def _param_record(c3d, gid, name, value=None):
+    """Encode a parameter section record in the format of a c3d file.
+
+    value is a list of strings or a numeric array in the layout of the parsed
+    parameters. A negative gid encodes a group record (value is ignored).
+    """
+    if gid < 0:
+        body = b'\x00'
+    else:
+        if isinstance(value, list):
+            strlen = max([len(s) for s in value] + [1])
+            dtype, dims = -1, (strlen, len(value))
+            data = b''.join(s.ljust(strlen).encode('latin-1') for s in value)
+        else:
+            value = np.asarray(value)
+            dims = value.shape[::-1]
+            if np.issubdtype(value.dtype, np.integer):
+                dtype, data = 2, value.astype(c3d.endian + 'i2').tobytes()
+            elif c3d.proc == PROC_DEC:
+                dtype, data = 4, _ieee_to_dec(value.ravel())
+            else:
+                dtype, data = 4, value.astype(c3d.endian + 'f4').tobytes()
+        if max(dims, default=0) > 255:
+            raise GaitDataError('Too many values for c3d parameter %s' % name)
+        body = struct.pack('bB', dtype, len(dims)) + bytes(dims) + data + b'\x00'
+    name = name.encode('latin-1')
+    offset = struct.pack(c3d.endian + 'h', len(body) + 2)
+    return struct.pack('bb', len(name), gid) + name + offset + body
+
+
+def _write_events(c3dfile, events):
+    """Write gait events into the EVENT group of a c3d file.
+
+    events is a TrialEvents instance with frame numbers as returned by
+    _get_metadata(), i.e. including the frame offset. Existing foot strike and
+    foot off events are replaced, other events are kept. The data is moved if
+    the parameter section grows beyond its blocks. The file is rewritten via a
+    temporary file, which also changes its fingerprint, so that cached reads of
+    the file are invalidated.
+    """
+    logger.debug('writing events into %s' % c3dfile)
+    c3dfile = Path(c3dfile)
+    c3d = _C3DFile(c3dfile)
+    with open(c3dfile, 'rb') as f:
+        head = f.read(c3d.data_start)
+    param_start = (head[0] - 1) * BLOCK_SIZE
+    if c3d.data_start <= param_start:
+        raise GaitDataError('Invalid data start in %s' % c3dfile)
+    buf = head[param_start:]
+    groups = dict()
+    records = list()
+    for gid, name, pos, pos_data in c3d._records(buf):
+        if gid < 0:
+            groups[name.upper()] = -gid
+        records.append((gid, name.upper(), buf[pos : _record_end(buf, gid, pos_data)]))
+    gid_event = groups.get('EVENT')
+    if gid_event is None:
+        gid_event = max([abs(rec[0]) for rec in records] + [0]) + 1
+        records.append((-gid_event, 'EVENT', _param_record(c3d, -gid_event, 'EVENT')))
+    records = [
+        rec for rec in records if rec[0] != gid_event or rec[1] not in EVENT_PARAMS
+    ]
+    # event rows of (time, label, context, description, subject, icon id, flag)
+    names = c3d.param_list('SUBJECTS', 'NAMES')
+    subject = names[0] if names else ''
+    evs = [
+        (
+            (frame - 1) / c3d.framerate,  # c3d frame 1 is at time 0
+            label,
+            context,
+            EVENT_DESCRIPTIONS[label],
+            subject,
+            EVENT_ICON_IDS[label],
+            0,
+        )
+        for label, context, frames in [
+            ('Foot Strike', 'Right', events.rstrikes),
+            ('Foot Strike', 'Left', events.lstrikes),
+            ('Foot Off', 'Right', events.rtoeoffs),
+            ('Foot Off', 'Left', events.ltoeoffs),
+        ]
+        for frame in frames
+    ]
+    # keep any other events
+    n_events = int(c3d.param('EVENT', 'USED', 0))
+    if n_events:
+        old = [
+            c3d.param_list('EVENT', par)[:n_events] + [default] * n_events
+            for par, default in [
+                ('LABELS', ''),
+                ('CONTEXTS', ''),
+                ('DESCRIPTIONS', ''),
+                ('SUBJECTS', subject),
+                ('ICON_IDS', 0),
+                ('GENERIC_FLAGS', 0),
+            ]
+        ]
+        times = np.reshape(c3d.params[('EVENT', 'TIMES')], (-1, 2))[:n_events]
+        secs = times[:, 0] * 60.0 + times[:, 1]
+        evs.extend(
+            (float(secs[k]),) + tuple(vals[k] for vals in old)
+            for k in range(n_events)
+            if old[0][k] not in EVENT_DESCRIPTIONS
+        )
+    evs.sort(key=lambda ev: ev[0])
+    cols = list(zip(*evs)) or [()] * 7
+    # times are stored as (minutes, seconds) pairs
+    times = [divmod(sec, 60) for sec in cols[0]]
+    event_params = {
+        'USED': np.array(len(evs), dtype=np.int16),
+        'CONTEXTS': list(cols[2]),
+        'LABELS': list(cols[1]),
+        'DESCRIPTIONS': list(cols[3]),
+        'TIMES': np.array(times, dtype=np.float32).reshape(-1, 2),
+        'SUBJECTS': list(cols[4]),
+        'ICON_IDS': np.array(cols[5], dtype=np.int16),
+        'GENERIC_FLAGS': np.array(cols[6], dtype=np.int16),
+    }
+    records.extend(
+        (gid_event, par, _param_record(c3d, gid_event, par, value))
+        for par, value in event_params.items()
+    )
+    # keep the data in place, unless the parameters no longer fit
+    n_blocks = max(
+        -(-(4 + sum(len(rec[2]) for rec in records)) // BLOCK_SIZE),
+        len(buf) // BLOCK_SIZE,
+    )
+    if n_blocks > 255:
+        raise GaitDataError('Too many parameters for %s' % c3dfile)
+    data_block = param_start // BLOCK_SIZE + n_blocks + 1
+    if n_blocks * BLOCK_SIZE > len(buf):
+        for k, (gid, name, _) in enumerate(records):
+            if (gid, name) == (groups.get('POINT'), 'DATA_START'):
+                value = np.array(data_block, dtype=np.int16)
+                records[k] = (gid, name, _param_record(c3d, gid, name, value))
+    section = buf[:2] + bytes([n_blocks, c3d.proc])
+    for k, (gid, name, rec) in enumerate(records):
+        nchars = len(name)
+        # zero offset for the last record terminates the parameter section
+        offset = len(rec) - nchars - 2 if k < len(records) - 1 else 0
+        section += rec[: nchars + 2] + struct.pack(c3d.endian + 'h', offset)
+        section += rec[nchars + 4 :]
+    header = bytearray(head[:BLOCK_SIZE])
+    header[16:18] = struct.pack(c3d.endian + 'h', data_block)
+    fn_temp = c3dfile.with_name(c3dfile.name + '.%d.tmp' % os.getpid())
+    with open(c3dfile, 'rb') as f_in, open(fn_temp, 'wb') as f_out:
+        f_out.write(header + head[BLOCK_SIZE:param_start])
+        f_out.write(section.ljust(n_blocks * BLOCK_SIZE, b'\x00'))
+        f_in.seek(c3d.data_start)
+        shutil.copyfileobj(f_in, f_out)
+    os.replace(fn_temp, c3dfile)
+
+
+def _get_metadata(c3dfile):
+    """Read trial and subject metadata from c3d file.
+
+    Only the header and parameter section of the file are parsed, so this is
+    fast also for large files. The result is memoized per file fingerprint; a
+    copy is returned on each call, so callers are free to modify it.
+
+    See read_data.get_metadata() for details.
+    """
+    meta = _read_metadata(c3dfile)
+    meta_copy = meta.copy()
+    meta_copy['events'] = copy.deepcopy(meta['events'])
+    meta_copy['subj_params'] = defaultdict(lambda: None)
+    meta_copy['subj_params'].update(meta['subj_params'])
+    meta_copy['markers'] = meta['markers'][:]
+    return meta_copy
+
+
+@file_cache(maxbytes=METADATA_CACHE_ENTRIES, sizer=lambda meta: 1)
+def _read_metadata(c3dfile):
+    """Read metadata from c3d parameters"""
+    c3dfile = Path(c3dfile)
+    c3d = _get_c3dfile(c3dfile)
+    # XXX: not sure what the '*xx' markers are, but delete them for now
+    markers = [m for m in c3d.param_list('POINT', 'LABELS') if m and m[0] != '*']
+    names = c3d.param_list('SUBJECTS', 'NAMES')
+    if names:
+        name = names[0]
+    else:
+        logger.warning('Cannot get subject name')
+        name = 'Unknown'
+    par_names = c3d.param_names['PROCESSING']
+    if not par_names:
+        raise GaitDataError('%s is missing required subject info' % c3dfile)
+    subj_params = defaultdict(lambda: None)
+    subj_params.update({par: _get_c3d_subject_param(c3d, par) for par in par_names})
+    return {
+        'trialname': c3dfile.stem,
+        'sessionpath': str(c3dfile.parent),
+        'offset': c3d.first_frame,
+        'framerate': c3d.framerate,
+        'analograte': c3d.analograte,
+        'name': name,
+        'subj_params': subj_params,
+        'events': _get_events(c3d),
+        'length': c3d.length,
+        'samplesperframe': c3d.samplesperframe,
+        'n_forceplates': int(c3d.param('FORCE_PLATFORM', 'USED', 0)),
+        'markers': markers,
+    }
+
+
+def _get_model_data(c3dfile, model):
+    """Read model output variables (e.g. Plug-in Gait).
+
+    See read_data.get_model_data for details.
+    """
+    c3d = _get_c3dfile(c3dfile)
+    labels = c3d.point_labels
+    found = [var for var in model.read_vars if var in labels]
+    vals = dict(zip(found, c3d.read_points([labels.index(var) for var in found])))
+    modeldata = dict()
+    for var in model.read_vars:
+        if var in vals:
+            modeldata[var] = vals[var].T
+        else:
+            logger.info('cannot read model variable %s, returning nans' % var)
+            data = np.empty((3, c3d.length))
+            data[:] = np.nan
+            modeldata[var] = data
+        # c3d stores scalars as last dim of 3-d array
+        if model.read_strategy == 'last':
+            modeldata[var] = modeldata[var][2, :]
+    return modeldata
+
+
+def _get_forceplate_data(c3dfile):
+    """Read data of all forceplates from c3d file.
+
+    See read_data.get_forceplate_data() for details.
+    """
+    logger.debug('reading forceplate data from %s' % c3dfile)
+    read_chs = ['Fx', 'Fy', 'Fz', 'Mx', 'My', 'Mz']
+    c3d = _get_c3dfile(c3dfile)
+    n_plates = int(c3d.param('FORCE_PLATFORM', 'USED', 0))
+    if not n_plates:
+        return list()
+    types = np.ravel(c3d.params[('FORCE_PLATFORM', 'TYPE')])
+    corners = np.reshape(c3d.params[('FORCE_PLATFORM', 'CORNERS')], (-1, 4, 3))
+    origins = np.reshape(c3d.params[('FORCE_PLATFORM', 'ORIGIN')], (-1, 3))
+    channels = np.reshape(c3d.params[('FORCE_PLATFORM', 'CHANNEL')], (n_plates, -1))
+    labels = c3d.analog_labels
+    # read all plate channels at once
+    inds = np.unique(channels[channels > 0] - 1)
+    chdata = dict(zip(inds, c3d.read_analog(inds)))
+    fpdata = list()
+    for nplate in range(n_plates):
+        logger.debug('reading from plate %d' % nplate)
+        if types[nplate] != 2:
+            # Nexus should always write forceplates as type 2
+            raise GaitDataError('Only type 2 forceplates are supported for now')
+        rawdata = dict()
+        for ind in channels[nplate]:
+            label = labels[ind - 1][-3:-1]  # strip descriptor and plate number
+            rawdata[label] = chdata[ind - 1]
+        if not all([ch in rawdata for ch in read_chs]):
+            logger.warning('could not read force/moment data for plate %d' % nplate)
+            continue
+        # we need to calculate center of pressure, since it's not in the c3d
+        # this should be the plate thickness (from moment origin to physical
+        # origin) needed for center of pressure calculations
+        dz = np.abs(origins[nplate, 2])
+        data = _plate_data(rawdata, dz, corners[nplate].T.astype(np.float64))
+        fpdata.append(data)
+    return fpdata
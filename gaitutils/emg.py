@@ -7,37 +7,140 @@ Class for handling EMG data.
 @author: Jussi (jnu@iki.fi)
 """
 
+import itertools
 import numpy as np
 import logging
+import weakref
+from scipy import signal
 
 from . import read_data, numutils
 from .config import cfg
+from .envutils import _to_bytes, _from_bytes, ByteLRUCache
 
 logger = logging.getLogger(__name__)
 
+# derived (filtered/enveloped) signals of all EMG instances; keys are
+# (instance id, channel, kind, parameters, sfrate, correction factor)
+_derived_cache = ByteLRUCache(
+    maxbytes=lambda: int(cfg.emg.derived_cache_size_mb * 2 ** 20)
+)
+_instance_ids = itertools.count()
+
+
+def _drop_derived(keys):
+    """Remove given keys from the derived signal cache"""
+    for key in list(keys):
+        _derived_cache.pop(key)
+    keys.clear()
+
 
 class EMG:
     """Class for processing and storing EMG data.
 
     Parameters
     ----------
-    source : ViconNexus | str
-        The data source. Can be a c3d filename or a ViconNexus instance.
+    source : ViconNexus | str | SourceContext
+        The data source. Can be a c3d filename or a ViconNexus instance. A
+        read_data.SourceContext can be given to share the reads with e.g. a
+        Trial instance.
     correction_factor : int, optional
         After read, the EMG data is multiplied by this factor.
+
+    Notes
+    -----
+    Filtered and enveloped channel data is cached, so that repeated calls to
+    get_channel_data() do not recompute it. The cache is shared by all
+    instances and its size is limited by cfg.emg.derived_cache_size_mb; see
+    EMG.cache_info(). Entries of an instance are dropped when its passband is
+    changed or the instance is garbage collected.
     """
 
     def __init__(self, source, correction_factor=1, chs_disabled=None):
         logger.debug('new EMG instance from %s' % source)
         self.source = source
-        self.passband = cfg.emg.passband
+        self._passband = cfg.emg.passband
         self._data = None
+        self._chmap = dict()
         self.t = None
         self.sfrate = None
         self.correction_factor = correction_factor
         self.chs_disabled = chs_disabled
         if self.chs_disabled is None:
             self.chs_disabled = list()
+        self._init_derived()
+
+    def _init_derived(self):
+        """Set up the bookkeeping of cached derived signals"""
+        self._cache_id = next(_instance_ids)
+        self._derived_keys = set()
+        weakref.finalize(self, _drop_derived, self._derived_keys)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # cache entries belong to this process
+        del state['_cache_id']
+        del state['_derived_keys']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_derived()
+
+    @property
+    def passband(self):
+        """The EMG passband (Hz). Setting it invalidates the cached filtered
+        data."""
+        return self._passband
+
+    @passband.setter
+    def passband(self, passband):
+        if passband != self._passband:
+            _drop_derived(self._derived_keys)
+        self._passband = passband
+
+    @staticmethod
+    def cache_info():
+        """Return statistics of the derived signal cache.
+
+        The cache is shared by all EMG instances.
+
+        Returns
+        -------
+        CacheInfo
+            Named tuple of (hits, misses, evictions, nbytes, maxbytes, entries).
+        """
+        return _derived_cache.info()
+
+    def to_bytes(self):
+        """Serialize the instance into bytes.
+
+        See Trial.to_bytes() for details.
+
+        Returns
+        -------
+        bytes
+            The serialized instance.
+        """
+        return _to_bytes(self)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Create an instance from data serialized by to_bytes().
+
+        Parameters
+        ----------
+        data : bytes | bytearray | memoryview
+            The serialized instance.
+
+        Returns
+        -------
+        EMG
+            The instance.
+        """
+        emg = _from_bytes(data)
+        if not isinstance(emg, cls):
+            raise TypeError('Data does not contain a %s instance' % cls.__name__)
+        return emg
 
     @property
     def data(self):
@@ -64,6 +167,8 @@ class EMG:
         emgdi = read_data.get_emg_data(self.source)
         self._data = emgdi['data']
         self.t = emgdi['t']
+        self._chmap = dict()
+        _drop_derived(self._derived_keys)
 
     def _edf_export(self, filename):
         """Export the EMG data to EDF format.
@@ -122,12 +227,24 @@ class EMG:
         f.close()
 
     def _match_name(self, chname):
-        """Fuzzily match channel name"""
+        """Fuzzily match channel name. The results are memoized."""
         if not (isinstance(chname, str) and len(chname)) >= 2:
             raise ValueError('invalid channel name: %s' % chname)
+        if self._data is None:
+            self._read_data()
+        try:
+            ch = self._chmap[chname]
+        except KeyError:
+            ch = self._chmap[chname] = self._resolve_name(chname)
+        if ch is None:
+            raise KeyError('No matching channel for %s' % chname)
+        return ch
+
+    def _resolve_name(self, chname):
+        """Match channel name against the data. Returns None if no match."""
         matches = [x for x in self.data if x.find(chname) >= 0]
         if len(matches) == 0:
-            raise KeyError('No matching channel for %s' % chname)
+            return None
         else:
             ch = min(matches, key=len)  # choose shortest matching name
         if len(matches) > 1:
@@ -145,7 +262,8 @@ class EMG:
         'Voltage.LGas8_filtered' would be matches, and the former would be
         returned.
 
-        Data is returned filtered if self.passband is set.
+        Data is returned filtered if self.passband is set. The returned data is
+        cached and read-only.
 
         Parameters
         ----------
@@ -161,15 +279,70 @@ class EMG:
             The data, shape (N,).
         """
         ch = self._match_name(chname)
-        data = self.data[ch]
         if envelope:
-            data = numutils.envelope(data, self.sfrate)
+            kind = cfg.emg.envelope_method
+            if kind == 'rms':
+                param = cfg.emg.rms_win
+            else:
+                param = cfg.emg.linear_envelope_lowpass
         elif self.passband:  # no filtering for RMS data
-            # filtered data is currently not cached; _filtfilt() call typically
-            # takes less than 1 ms, so this should not be a problem, unless a
-            # huge number of calls are made
-            data = numutils._filtfilt(data, self.passband, self.sfrate)
-        return data * self.correction_factor
+            kind = 'bandpassed'
+            param = tuple(self.passband)
+        else:
+            kind = 'raw'
+            param = None
+        data = _derived_cache.get(self._derived_key(ch, kind, param))
+        if data is None:
+            data = self._compute_derived(kind, param)[ch]
+        return data
+
+    def _derived_key(self, ch, kind, param):
+        """Key of a derived signal in the cache"""
+        return (
+            self._cache_id,
+            ch,
+            kind,
+            param,
+            self.sfrate,
+            self.correction_factor,
+        )
+
+    def _compute_derived(self, kind, param):
+        """Compute a derived signal for all channels and cache the results.
+
+        The channels are processed as a single 2-D array. Returns a dict keyed
+        by channel name.
+        """
+        chs = list(self.data.keys())
+        try:
+            block = np.stack([self.data[ch] for ch in chs])
+        except ValueError:  # channels of different length
+            derived = {
+                ch: self._derive(self.data[ch], kind) * self.correction_factor
+                for ch in chs
+            }
+        else:
+            block = self._derive(block, kind) * self.correction_factor
+            derived = dict(zip(chs, block))
+        for ch, data in derived.items():
+            data.flags.writeable = False
+            key = self._derived_key(ch, kind, param)
+            _derived_cache.put(key, data)
+            self._derived_keys.add(key)
+        return derived
+
+    def _derive(self, data, kind):
+        """Compute a derived signal along the last axis of data"""
+        workers = cfg.emg.filter_workers
+        if kind == 'bandpassed':
+            return numutils._filtfilt(
+                data, self.passband, self.sfrate, axis=-1, workers=workers
+            )
+        elif kind == 'raw':
+            return data
+        else:
+            axis = -1 if data.ndim > 1 else None
+            return numutils.envelope(data, self.sfrate, axis=axis, workers=workers)
 
     def has_channel(self, chname):
         """Check whether a channel exists in the data.
@@ -258,6 +431,7 @@ class AvgEMG(EMG):
 
     def __init__(self, data):
         self._data = data
+        self._chmap = dict()
 
     def get_channel_data(self, chname, envelope=None):
         if not envelope:
@@ -281,3 +455,195 @@ class AvgEMG(EMG):
 
     def read(self):
         raise RuntimeError('read not implemented for averaged EMG')
+
+
+class EMGStreamProcessor:
+    """Stateful EMG envelope computation for continuously arriving data.
+
+    The data is fed in fixed-size blocks of shape (nchannels, blocksize), and
+    an envelope block of the same shape is returned for each input block. The
+    state (filter conditions or the RMS window history) is carried over from
+    block to block, so the concatenated output is the envelope of the whole
+    signal.
+
+    Parameters
+    ----------
+    sfrate : float
+        The sampling rate (Hz).
+    nchannels : int
+        Number of channels.
+    blocksize : int | None
+        Number of samples per block. Default is cfg.emg.stream_blocksize.
+    method : str | None
+        The envelope method, 'rms' or 'linear_envelope'. Default is
+        cfg.emg.envelope_method. The RMS window and the lowpass frequency are
+        taken from cfg.emg.rms_win and cfg.emg.linear_envelope_lowpass.
+    correction_factor : float, optional
+        The envelope is multiplied by this factor.
+
+    Notes
+    -----
+    The output of each block is available immediately, so the latency is
+    bounded by the block duration plus the delay of the envelope itself (see
+    the delay attribute, in samples).
+
+    The offline envelope (numutils.envelope) is computed from the whole
+    signal, which the streaming version cannot do. The differences are:
+
+    -RMS: the streamed envelope is delayed by (rms_win - 1) / 2 samples (the
+    centered window needs the future samples). Apart from the delay, it equals
+    the offline RMS up to rounding errors, except for the first rms_win
+    samples, where the offline version pads the data.
+
+    -linear envelope: the lowpass filter is run forward only, instead of
+    forward and backward. The filter then has a phase lag, which is about 50
+    ms for the default 10 Hz lowpass (the delay attribute gives the
+    low-frequency group delay in samples). Also, the amplitude response is that
+    of the filter itself, while the offline response is its square. For
+    amplitude modulated noise at 1 kHz, after shifting by the delay, the
+    streamed envelope deviates from the offline one by up to about 7% of the
+    envelope peak value.
+    """
+
+    def __init__(
+        self, sfrate, nchannels, blocksize=None, method=None, correction_factor=1
+    ):
+        if blocksize is None:
+            blocksize = cfg.emg.stream_blocksize
+        if method is None:
+            method = cfg.emg.envelope_method
+        self.sfrate = sfrate
+        self.nchannels = nchannels
+        self.blocksize = blocksize
+        self.method = method
+        self.correction_factor = correction_factor
+        if method == 'rms':
+            self.rms_win = cfg.emg.rms_win
+            if self.rms_win % 2 != 1:
+                raise ValueError('Need RMS window of odd length')
+            self.delay = (self.rms_win - 1) / 2
+        elif method == 'linear_envelope':
+            passband = (0.0, float(cfg.emg.linear_envelope_lowpass))
+            self._sos = numutils._butter_sos(passband, float(sfrate), 5)
+            b, a = signal.sos2tf(self._sos)
+            self.delay = float(signal.group_delay((b, a), w=[0])[1][0])
+        else:
+            raise ValueError('Invalid envelope method: %s' % method)
+        self.reset()
+
+    def reset(self):
+        """Reset the state, e.g. to start a new recording"""
+        if self.method == 'rms':
+            # ring buffer of squared samples of the last rms_win - 1 samples
+            self._ring = np.zeros((self.nchannels, self.rms_win - 1))
+            self._ring_pos = 0
+        else:
+            self._zi = None
+        self.nsamples = 0
+
+    def process(self, block):
+        """Process a block of data.
+
+        Parameters
+        ----------
+        block : ndarray
+            The data, shape (nchannels, blocksize).
+
+        Returns
+        -------
+        ndarray
+            The envelope, shape (nchannels, blocksize).
+        """
+        block = np.asarray(block, dtype=np.float64)
+        if block.shape != (self.nchannels, self.blocksize):
+            raise ValueError(
+                'expected a block of shape %s, got %s'
+                % ((self.nchannels, self.blocksize), block.shape)
+            )
+        if self.method == 'rms':
+            env = self._process_rms(block)
+        else:
+            env = self._process_linear(block)
+        self.nsamples += self.blocksize
+        return env * self.correction_factor
+
+    def _process_rms(self, block):
+        """RMS over the window that ends at each sample"""
+        nring = self._ring.shape[1]
+        # history in time order, followed by the new samples
+        history = np.roll(self._ring, -self._ring_pos, axis=1)
+        sq = np.concatenate([history, block ** 2], axis=1)
+        csum = np.cumsum(sq, axis=1)
+        csum = np.concatenate([np.zeros((self.nchannels, 1)), csum], axis=1)
+        sums = csum[:, self.rms_win :] - csum[:, : -self.rms_win]
+        if nring:
+            # write the newest samples into the ring buffer
+            nnew = min(self.blocksize, nring)
+            newpos = np.arange(self.blocksize - nnew, self.blocksize)
+            idx = (self._ring_pos + newpos) % nring
+            self._ring[:, idx] = sq[:, -nnew:]
+            self._ring_pos = (self._ring_pos + self.blocksize) % nring
+        return np.sqrt(np.maximum(sums, 0) / self.rms_win)
+
+    def _process_linear(self, block):
+        """Rectification and causal lowpass filtering"""
+        rect = np.abs(block)
+        if self._zi is None:
+            # start from the steady state of the first sample
+            zi0 = signal.sosfilt_zi(self._sos)
+            self._zi = zi0[:, None, :] * rect[None, :, :1]
+        env, self._zi = signal.sosfilt(self._sos, rect, axis=-1, zi=self._zi)
+        return env
+
+
+class EMGReplay:
+    """Replay EMG data from a file in fixed-size blocks.
+
+    Stands in for a live EMG data stream, e.g. for testing
+    EMGStreamProcessor. Iterating over the instance yields blocks of shape
+    (nchannels, blocksize). A trailing partial block is not returned.
+
+    Parameters
+    ----------
+    source : str | SourceContext
+        The data source, e.g. a c3d filename.
+    blocksize : int | None
+        Number of samples per block. Default is cfg.emg.stream_blocksize.
+    chnames : list | None
+        The channels to replay. Name matching is used (see
+        EMG.get_channel_data()). By default, all channels are replayed.
+    """
+
+    def __init__(self, source, blocksize=None, chnames=None):
+        if blocksize is None:
+            blocksize = cfg.emg.stream_blocksize
+        self.blocksize = blocksize
+        self._emg = EMG(source)
+        if chnames is None:
+            self.chnames = list(self._emg.data.keys())
+        else:
+            self.chnames = [self._emg._match_name(ch) for ch in chnames]
+        self.sfrate = self._emg.sfrate
+
+    @property
+    def nblocks(self):
+        """Number of blocks in the replay"""
+        return len(self._emg.t) // self.blocksize
+
+    def __len__(self):
+        return self.nblocks
+
+    def __iter__(self):
+        data = np.stack([self._emg.data[ch] for ch in self.chnames])
+        for k in range(self.nblocks):
+            yield data[:, k * self.blocksize : (k + 1) * self.blocksize]
+
+    def processor(self, method=None, correction_factor=1):
+        """Return an EMGStreamProcessor that matches the replayed data"""
+        return EMGStreamProcessor(
+            self.sfrate,
+            len(self.chnames),
+            blocksize=self.blocksize,
+            method=method,
+            correction_factor=correction_factor,
+        )
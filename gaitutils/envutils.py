@@ -18,7 +18,11 @@ import hashlib
 import os
 import tempfile
 import binascii
-from functools import lru_cache
+import pickle
+import struct
+import threading
+from collections import OrderedDict, namedtuple
+from functools import lru_cache, wraps
 
 from .gui._windows import error_exit
 
@@ -126,6 +130,9 @@ def lru_cache_checkfile(fun):
     Works by computing the md5 digest for the input file and passing that on to
     lru_cache, so the cache is invalidated if file contents have changed.
 
+    NB: this reads the whole file for each call. For large files, see
+    file_cache() which validates entries using file status instead.
+
     Parameters
     ----------
     fun : function
@@ -150,6 +157,203 @@ def lru_cache_checkfile(fun):
     return wrapper
 
 
+def _file_md5(filename, blocksize=2 ** 20):
+    """Return md5 digest for file, reading it in blocks"""
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def _file_fingerprint(filename, content_hash=False):
+    """Return a fingerprint tuple identifying the current state of a file.
+
+    The fingerprint is (path, size, mtime_ns, inode), computed from a single
+    stat() call. If content_hash is True, the md5 digest of the file is
+    appended, which makes the fingerprint robust against modifications that
+    preserve size and mtime, at the cost of reading the whole file.
+    """
+    filename = op.abspath(str(filename))
+    st = os.stat(filename)
+    fp = (filename, st.st_size, st.st_mtime_ns, st.st_ino)
+    if content_hash:
+        fp += (_file_md5(filename),)
+    return fp
+
+
+CacheInfo = namedtuple(
+    'CacheInfo', ['hits', 'misses', 'evictions', 'nbytes', 'maxbytes', 'entries']
+)
+
+
+class ByteLRUCache:
+    """A LRU cache that is limited by the total size of its values in bytes.
+
+    Entries are evicted in least recently used order, until the total size fits
+    in the budget. Values larger than the whole budget are not cached at all.
+
+    Parameters
+    ----------
+    maxbytes : int | callable
+        The size budget in bytes. If callable, it is called without arguments
+        whenever the budget is needed, which allows the budget to follow config
+        changes.
+    sizer : callable | None
+        A function that returns the size of a value in bytes. If None, the
+        nbytes attribute of the value is used, or 0 if it does not exist.
+    """
+
+    def __init__(self, maxbytes, sizer=None):
+        self._maxbytes = maxbytes
+        self._sizer = sizer
+        self._entries = OrderedDict()  # key -> (value, nbytes)
+        self._lock = threading.RLock()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def maxbytes(self):
+        """The current size budget"""
+        return self._maxbytes() if callable(self._maxbytes) else self._maxbytes
+
+    def _sizeof(self, value):
+        if self._sizer is not None:
+            return int(self._sizer(value))
+        return int(getattr(value, 'nbytes', 0))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None, validate=None):
+        """Return value for key, or default if key is not cached.
+
+        If validate is given, it is called with the cached value, and a False
+        return value causes the entry to be dropped as stale.
+        """
+        with self._lock:
+            try:
+                value, _ = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            if validate is not None and not validate(value):
+                self.pop(key)
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """Insert a value and evict old entries as needed"""
+        nbytes = self._sizeof(value)
+        maxbytes = self.maxbytes
+        with self._lock:
+            self.pop(key)
+            if nbytes > maxbytes:
+                logger.debug(
+                    'not caching value of %d bytes (budget %d)' % (nbytes, maxbytes)
+                )
+                return
+            self._entries[key] = (value, nbytes)
+            self.nbytes += nbytes
+            self._evict(maxbytes)
+
+    def pop(self, key):
+        """Remove key from the cache, if it exists. Returns the value or None"""
+        with self._lock:
+            try:
+                value, nbytes = self._entries.pop(key)
+            except KeyError:
+                return None
+            self.nbytes -= nbytes
+            return value
+
+    def _evict(self, maxbytes):
+        """Evict least recently used entries until the budget is met"""
+        while self.nbytes > maxbytes and self._entries:
+            _, (_, nbytes) = self._entries.popitem(last=False)
+            self.nbytes -= nbytes
+            self.evictions += 1
+
+    def clear(self):
+        """Empty the cache and reset the counters"""
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = self.hits = self.misses = self.evictions = 0
+
+    def info(self):
+        """Return cache statistics as a CacheInfo named tuple"""
+        return CacheInfo(
+            self.hits,
+            self.misses,
+            self.evictions,
+            self.nbytes,
+            self.maxbytes,
+            len(self._entries),
+        )
+
+
+def file_cache(maxbytes, sizer=None, content_hash=False):
+    """Cache results of a function that reads a file, limited by total bytes.
+
+    A replacement for lru_cache_checkfile for functions that return large
+    objects. Cache entries are keyed by the absolute file name, and validated
+    by the file fingerprint (size, mtime, inode and optionally the md5 digest),
+    so the file is only read when the cached entry is stale.
+
+    Parameters
+    ----------
+    maxbytes : int | callable
+        The size budget of the cache in bytes, or a callable that returns it.
+    sizer : callable | None
+        Function that returns the size of a result in bytes. See ByteLRUCache.
+    content_hash : bool | callable
+        Whether to include the md5 digest in the fingerprint. May also be a
+        callable that returns the setting.
+
+    Returns
+    -------
+    function
+        A decorator. The decorated function has the attributes cache (the
+        ByteLRUCache instance), cache_info() and cache_clear().
+    """
+
+    def _entry_size(entry):
+        _, result = entry
+        if sizer is not None:
+            return sizer(result)
+        return getattr(result, 'nbytes', 0)
+
+    cache = ByteLRUCache(maxbytes, sizer=_entry_size)
+
+    def decorator(fun):
+        @wraps(fun)
+        def wrapper(filename):
+            use_hash = content_hash() if callable(content_hash) else content_hash
+            fp = _file_fingerprint(filename, content_hash=use_hash)
+            key = fp[0]
+            entry = cache.get(key, validate=lambda entry: entry[0] == fp)
+            if entry is not None:
+                return entry[1]
+            result = fun(filename)
+            cache.put(key, (fp, result))
+            return result
+
+        wrapper.cache = cache
+        wrapper.cache_info = cache.info
+        wrapper.cache_clear = cache.clear
+        return wrapper
+
+    return decorator
+
+
 def _named_tempfile(suffix=None):
     """Return a name for a temporary file.
     Does not open the file. Cross-platform. Replaces tempfile.NamedTemporaryFile
@@ -164,3 +368,62 @@ def _named_tempfile(suffix=None):
     # convert to hex string
     basename = basename.hex()
     return os.path.join(tempfile.gettempdir(), basename + suffix)
+
+
+# header of serialized objects: magic, format version, number of out-of-band
+# buffers; followed by the byte lengths of the pickle and the buffers
+_SERIALIZE_MAGIC = b'GUPK'
+_SERIALIZE_VERSION = 1
+_SERIALIZE_ALIGN = 64  # alignment of buffers, in bytes
+
+
+def _to_bytes(obj):
+    """Serialize an object into bytes.
+
+    Uses pickle protocol 5, so that contiguous arrays are stored as
+    out-of-band buffers. The buffers are not copied by pickle, and they are
+    aligned in the output, so that _from_bytes() can return arrays that are
+    views into the serialized data.
+    """
+    buffers = list()
+    data = pickle.dumps(obj, protocol=5, buffer_callback=buffers.append)
+    raws = [buf.raw() for buf in buffers]
+    lengths = [len(data)] + [raw.nbytes for raw in raws]
+    header = struct.pack(
+        '<4sII%dQ' % len(lengths),
+        _SERIALIZE_MAGIC,
+        _SERIALIZE_VERSION,
+        len(raws),
+        *lengths,
+    )
+    parts = [header, data]
+    offset = len(header) + len(data)
+    for raw in raws:
+        pad = -offset % _SERIALIZE_ALIGN
+        parts.extend([b'\0' * pad, raw])
+        offset += pad + raw.nbytes
+    return b''.join(parts)
+
+
+def _from_bytes(data):
+    """Deserialize an object serialized by _to_bytes().
+
+    The arrays of the returned object are views into data (read-only, if data
+    is immutable).
+    """
+    view = memoryview(data).cast('B')
+    magic, version, nbufs = struct.unpack_from('<4sII', view)
+    if magic != _SERIALIZE_MAGIC:
+        raise ValueError('Not a serialized gaitutils object')
+    if version != _SERIALIZE_VERSION:
+        raise ValueError('Unsupported serialization format %d' % version)
+    lengths = struct.unpack_from('<%dQ' % (nbufs + 1), view, 12)
+    offset = 12 + 8 * (nbufs + 1)
+    pickle_data = view[offset : offset + lengths[0]]
+    offset += lengths[0]
+    buffers = list()
+    for length in lengths[1:]:
+        offset += -offset % _SERIALIZE_ALIGN
+        buffers.append(view[offset : offset + length])
+        offset += length
+    return pickle.loads(pickle_data, buffers=buffers)
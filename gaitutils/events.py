@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+"""
+Gait event detection from marker data.
+
+The detection works on marker data arrays only, so it can be used with any
+data source. utils.automark_events() uses this for the actual detection;
+detect_trials_events() processes a list of trials in a process pool.
+
+@author: Jussi (jnu@iki.fi)
+"""
+
+import logging
+import os
+
+import numpy as np
+from scipy import signal
+
+from . import read_data, trial
+from .config import cfg
+from .envutils import GaitDataError
+from .numutils import digitize_array, falling_zerocross, rising_zerocross
+from .utils import (
+    MarkerSet,
+    avg_markerdata,
+    _get_foot_swing_velocity,
+    _principal_movement_direction,
+)
+
+
+logger = logging.getLogger(__name__)
+
+# minimum swing velocity (rel to max velocity)
+MIN_SWING_VELOCITY = 0.5
+# median prefilter width
+PREFILTER_MEDIAN_WIDTH = 3
+# tolerance for matching forceplate and vel. thresholded events
+FP_EVENT_TOL = 10
+
+
+def _swing_ok(footctrv, strikes, min_vel):
+    """Check for foot swing between consecutive strikes.
+
+    Returns a boolean mask of the strikes to keep. A strike is dropped if the
+    velocity does not reach min_vel after the previous kept strike. Since
+    dropping a strike extends the interval to the following strike, this is
+    equivalent to checking the interval from the immediately preceding strike,
+    which can be done by a single segment reduction.
+    """
+    if len(strikes) == 0:
+        return np.zeros(0, dtype=bool)
+    seg_max = np.maximum.reduceat(footctrv, strikes)[:-1]
+    return np.r_[True, seg_max >= min_vel]
+
+
+def _last_toeoffs(strikes, toeoffs):
+    """Keep only the last toeoff in each interval between strikes.
+
+    Returns a boolean mask of the toeoffs to keep. Both arrays must be sorted.
+    """
+    # index of the interval (strikes[k-1], strikes[k]) for each toeoff
+    k = np.searchsorted(strikes, toeoffs, side='right')
+    inside = (k > 0) & (k < len(strikes))
+    inside[inside] = toeoffs[inside] != strikes[k[inside] - 1]
+    # drop inside toeoffs that are followed by one in the same interval
+    followed = np.r_[(k[:-1] == k[1:]) & inside[1:], False]
+    return ~(inside & followed)
+
+
+def _slope_ok(footctrv, cross, max_slope_vel, min_slope_vel):
+    """Check velocity on both sides of threshold crossings"""
+    vel_before, vel_after = footctrv[cross - 1], footctrv[cross + 1]
+    return (
+        (vel_before < max_slope_vel)
+        & (vel_before > min_slope_vel)
+        & (vel_after < max_slope_vel)
+        & (vel_after > min_slope_vel)
+    )
+
+
+def _fp_correct(events, fp_events_):
+    """Replace events by nearby forceplate events, in place"""
+    fpc = digitize_array(events, fp_events_)
+    ok_ind = np.where(np.abs(fpc - events) < FP_EVENT_TOL)[0]
+    if ok_ind.size > 0:
+        events[ok_ind] = fpc[ok_ind]
+    return ok_ind.size > 0
+
+
+def _foot_velocity(mkrdata, markers, roi=None):
+    """Scalar foot center velocity, prefiltered"""
+    footctrv_ = avg_markerdata(
+        mkrdata, markers, roi=roi, fail_on_gaps=False, avg_velocity=True
+    )
+    footctrv = np.linalg.norm(footctrv_, axis=1)
+    # filter scalar velocity data to suppress noise and spikes
+    return signal.medfilt(footctrv, PREFILTER_MEDIAN_WIDTH)
+
+
+def detect_events(
+    mkrdata,
+    framerate,
+    events_range=None,
+    fp_events=None,
+    vel_thresholds=None,
+    roi=None,
+    start_on_forceplate=False,
+    return_velocities=False,
+):
+    """Detect foot strike and toeoff events from marker data.
+
+    Events are detected by foot velocity thresholding. See
+    utils.automark_events() for details of the parameters.
+
+    Parameters
+    ----------
+    mkrdata : dict | MarkerSet
+        The marker data. It must include foot markers and subject tracking
+        markers (see cfg).
+    framerate : float
+        The frame rate of the marker data.
+    events_range : array_like, optional
+        If specified, the events will be restricted to given coordinate range in
+        the principal gait direction. E.g. [-1000, 1000]
+    fp_events : dict, optional
+        Forceplate detected strikes and toeoffs, which replace nearby
+        autodetected events.
+    vel_thresholds : dict, optional
+        Absolute velocity thresholds for identifying events.
+    roi : array_like, optional
+        If not None, specifies a ROI (in frames) inside which to detect events.
+    start_on_forceplate : bool, optional
+        If True, events earlier than the first forceplate contact are dropped.
+    return_velocities : bool, optional
+        If True, also return the foot velocities and the swing velocities used
+        for the thresholds, as dicts keyed by context.
+
+    Returns
+    -------
+    dict
+        The events, keyed by 'R_strikes', 'L_strikes', 'R_toeoffs' and
+        'L_toeoffs'. The values are arrays of 0-based frame indices.
+    """
+    # marker data is assumed to be in mm
+    # mm/frame = 1000 m/frame = 1000/frate m/s
+    vel_conv = 1000 / framerate
+    # reasonable limit for peak velocity (m/s before multiplier)
+    max_peak_velocity = 12 * vel_conv
+    # reasonable limits for velocity on slope (increasing/decreasing)
+    max_slope_velocity = 6 * vel_conv
+    min_slope_velocity = 0  # not currently in use
+    if vel_thresholds is None:
+        vel_thresholds = dict()
+    # velocities and gaps are then computed only once
+    mkrdata = MarkerSet.from_dict(mkrdata)
+    # the principal direction is needed for both sides
+    if events_range:
+        mdata = avg_markerdata(mkrdata, cfg.autoproc.track_markers, roi=roi)
+        fwd_dim = _principal_movement_direction(mdata)
+    events = dict()
+    footctrvs = dict()
+    maxvs = dict()
+    for context, markers, footctrP in zip(
+        ('R', 'L'),
+        (cfg.autoproc.right_foot_markers, cfg.autoproc.left_foot_markers),
+        (mkrdata['RANK'], mkrdata['LANK']),
+    ):
+        logger.debug('detecting events for side %s' % context)
+        footctrv = _foot_velocity(mkrdata, markers, roi=roi)
+        # get peak (swing) velocity
+        maxv = _get_foot_swing_velocity(
+            footctrv, max_peak_velocity, MIN_SWING_VELOCITY
+        )
+        # compute thresholds
+        threshold_fall = maxv * cfg.autoproc.strike_vel_threshold
+        threshold_rise = maxv * cfg.autoproc.toeoff_vel_threshold
+        if cfg.autoproc.use_fp_vel_thresholds:
+            threshold_fall = vel_thresholds.get(context + '_strike') or threshold_fall
+            threshold_rise = vel_thresholds.get(context + '_toeoff') or threshold_rise
+        logger.debug('using thresholds: %.2f/%.2f' % (threshold_fall, threshold_rise))
+        # foot strikes (velocity decreases); exclude edges of data vector
+        fmax = len(footctrv) - 1
+        cross = falling_zerocross(footctrv - threshold_fall)
+        cross = cross[(cross > 0) & (cross < fmax)]
+        strikes = cross[
+            _slope_ok(footctrv, cross, max_slope_velocity, min_slope_velocity)
+        ]
+        # check for foot swing (velocity maximum) between consecutive strikes
+        strikes = strikes[_swing_ok(footctrv, strikes, maxv * MIN_SWING_VELOCITY)]
+        if len(strikes) == 0:
+            raise GaitDataError('No valid foot strikes detected')
+        # toe offs (velocity increases)
+        cross = rising_zerocross(footctrv - threshold_rise)
+        cross = cross[(cross > 0) & (cross < fmax)]
+        toeoffs = cross[
+            _slope_ok(footctrv, cross, max_slope_velocity, min_slope_velocity)
+        ]
+        if len(toeoffs) == 0:
+            raise GaitDataError('Could not detect any toe-off events')
+        # check for multiple toeoffs
+        toeoffs = toeoffs[_last_toeoffs(strikes, toeoffs)]
+        logger.debug('autodetected strike events: %s' % strikes)
+        logger.debug('autodetected toeoff events: %s' % toeoffs)
+        # select events for which the foot is close enough to center frame
+        if events_range:
+            strike_pos = footctrP[strikes, fwd_dim]
+            dist_ok = (strike_pos > events_range[0]) & (strike_pos < events_range[1])
+            # exactly zero position at strike should indicate a gap -> exclude
+            strikes = strikes[dist_ok & (strike_pos != 0)]
+        # correct foot strikes with force plate autodetected events
+        if fp_events and fp_events[context + '_strikes']:
+            fp_strikes = fp_events[context + '_strikes']
+            logger.debug('forceplate strikes: %s' % fp_strikes)
+            if not _fp_correct(strikes, fp_strikes):
+                logger.warning(
+                    'could not match forceplate strike with an autodetected strike'
+                )
+            if not _fp_correct(toeoffs, fp_events[context + '_toeoffs']):
+                logger.warning(
+                    'could not match forceplate toeoff with an autodetected toeoff'
+                )
+            # delete strikes before (actual) 1st forceplate contact
+            if start_on_forceplate:
+                # use a tolerance here to avoid deleting possible (uncorrected)
+                # strike near the fp
+                strikes = strikes[strikes >= fp_strikes[0] - FP_EVENT_TOL]
+        if roi is not None:
+            strikes = strikes[(roi[0] <= strikes + 1) & (strikes + 1 <= roi[1])]
+            toeoffs = toeoffs[(roi[0] <= toeoffs + 1) & (toeoffs + 1 <= roi[1])]
+        if len(strikes) == 0:
+            raise GaitDataError('No valid foot strikes detected')
+        # delete toeoffs that are not between strike events
+        toeoffs = toeoffs[(toeoffs > strikes.min()) & (toeoffs < strikes.max())]
+        logger.debug('final strike events: %s' % strikes)
+        logger.debug('final toeoff events: %s' % toeoffs)
+        events[context + '_strikes'] = strikes
+        events[context + '_toeoffs'] = toeoffs
+        footctrvs[context] = footctrv
+        maxvs[context] = maxv
+    events = {
+        key: events[key] for key in ['R_strikes', 'L_strikes', 'R_toeoffs', 'L_toeoffs']
+    }
+    if return_velocities:
+        return events, footctrvs, maxvs
+    return events
+
+
+def _detect_trial_events(source, kwargs):
+    """Read marker data and detect events for a trial (worker function)"""
+    meta = read_data.get_metadata(source)
+    markers = (
+        cfg.autoproc.right_foot_markers
+        + cfg.autoproc.left_foot_markers
+        + cfg.autoproc.track_markers
+    )
+    mkrdata = read_data.get_marker_data(source, markers)
+    return detect_events(mkrdata, meta['framerate'], **kwargs)
+
+
+def detect_trials_events(sources, workers=None, on_error='raise', **kwargs):
+    """Detect gait events for a list of trials.
+
+    The trials are processed in a process pool.
+
+    Parameters
+    ----------
+    sources : list
+        List of sources (c3d filenames).
+    workers : int | None
+        Number of worker processes. If None, taken from cfg.trial.load_workers.
+        If that is None too, the number of CPUs is used.
+    on_error : str
+        What to do when events cannot be detected for a trial. If 'raise',
+        raise a GaitDataError listing the errors for each failed trial. If
+        'skip', the error is logged and None is returned for the trial.
+    **kwargs
+        Passed to detect_events().
+
+    Returns
+    -------
+    list
+        The event dicts (see detect_events()), in the same order as sources.
+    """
+    if workers is None:
+        workers = cfg.trial.load_workers or os.cpu_count() or 1
+    if on_error not in ('raise', 'skip'):
+        raise ValueError('Invalid on_error: %s' % on_error)
+    sources = list(sources)
+    items = [(source, kwargs) for source in sources]
+    results, errors = trial._run_in_pool(_detect_trial_events, items, workers)
+    errors = {sources[k]: e for k, e in sorted(errors.items())}
+    trial._check_errors(errors, on_error, 'Could not detect events')
+    return results
@@ -37,6 +37,7 @@ from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
 from .. import nexus, cfg, read_data, GaitDataError
 from ..trial import Trial
 from ..numutils import _segment_angles, rms
+from ..utils import MarkerSet
 from .qt_dialogs import qt_message_dialog, qt_yesno_dialog
 
 
@@ -518,13 +519,9 @@ class TardieuPlot:
 
         # read marker data and compute segment angle
         mnames = cfg.tardieu.marker_names
-        data = read_data.get_marker_data(source, mnames)
-
-        P0 = data[mnames[0]]
-        P1 = data[mnames[1]]
-        P2 = data[mnames[2]]
+        data = MarkerSet.from_dict(read_data.get_marker_data(source, mnames))
         # stack so that marker changes along 2nd dim for segment_angles
-        Pall = np.stack([P0, P1, P2], axis=1)
+        Pall = np.moveaxis(data.stack(mnames[:3]), 0, 1)
         # compute segment angles (deg)
         self.angd = _segment_angles(Pall) / np.pi * 180
         # this is our calculated starting angle
@@ -19,7 +19,12 @@ import time
 import multiprocessing
 import subprocess
 
-from .numutils import _change_coords, _isfloat, _isint, _rigid_body_extrapolate_markers
+from .numutils import (
+    _change_coords,
+    _isfloat,
+    _isint,
+    _rigid_body_extrapolate_markers_batch,
+)
 from .utils import TrialEvents
 from .envutils import GaitDataError
 from .config import cfg
@@ -705,7 +710,6 @@ def rigid_body_extrapolate(
     )
     # read reference marker data from extrapolation trials
     for extrap_trial in extrap_trials:
-        extrap_coords = defaultdict(list)
         _open_trial(extrap_trial)
         subjname = get_subjectnames()
         try:
@@ -714,16 +718,12 @@ def rigid_body_extrapolate(
             raise GaitDataError(
                 'cannot read markers from extrapolation trial %s' % extrap_trial
             )
-        for frame in range(vicon.GetFrameCount()):
-            mdata_thisframe = np.row_stack(
-                [mdata_ref[marker][frame, :] for marker in ref_markers]
-            )
-            mdata_extrap = _rigid_body_extrapolate_markers(mdata_ref_, mdata_thisframe)
-            for marker, pos in zip(extrap_markers, mdata_extrap):
-                extrap_coords[marker].append(pos)
+        # all frames are extrapolated at once
+        mdata_frames = np.stack([mdata_ref[marker] for marker in ref_markers], axis=1)
+        mdata_extrap = _rigid_body_extrapolate_markers_batch(mdata_ref_, mdata_frames)
         # write extrapolated data
-        for marker, vals in extrap_coords.items():
-            vals_x, vals_y, vals_z = np.array(vals).T
+        for marker, vals in zip(extrap_markers, np.moveaxis(mdata_extrap, 1, 0)):
+            vals_x, vals_y, vals_z = vals.T
             data_exists = [True] * vicon.GetFrameCount()
             vicon.SetTrajectory(
                 subjname,
@@ -6,16 +6,20 @@ Normal data readers
 """
 
 
+from collections import defaultdict
+import hashlib
 import numpy as np
 import openpyxl
+import os
 import os.path as op
+from pathlib import Path
 import json
 import io
 import logging
 
 from .config import cfg
-from .envutils import GaitDataError
-from . import sessionutils, numutils
+from .envutils import GaitDataError, _file_fingerprint
+from . import sessionutils, numutils, stats, trial, trialcache
 from .numutils import _isfloat
 from ulstools.num import age_from_hetu
 from .models import models_all
@@ -233,6 +237,33 @@ def _write_xlsx(normaldata, filename):
     wb.save(filename=filename)
 
 
+def _write_gcd(normaldata, filename):
+    """Save normal data dict into GCD format.
+
+    The (min, max) data is written as (mean, dev), see _read_gcd(). Variable
+    names are translated according to the models' GCD translation tables.
+    """
+    gcd_names = {
+        var: gcdvar
+        for model in models_all
+        for gcdvar, var in model.gcd_normaldata_map.items()
+    }
+    lines = ['#!DST-0.1 GCD Oxford Metrics']
+    for var in sorted(normaldata):
+        data = normaldata[var]
+        nrows, ncols = data.shape
+        if nrows not in (51, 1) or ncols != 2:
+            raise ValueError(
+                'normal data has unexpected dimensions: %d x %d' % (nrows, ncols)
+            )
+        lines.append('!%s' % gcd_names.get(var, var))
+        for vmin, vmax in data:
+            lines.append('%.6f %.6f' % ((vmin + vmax) / 2, (vmax - vmin) / 2))
+    logger.debug('saving %s' % filename)
+    with io.open(filename, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
 def _normals_from_data(data):
     """Compute normal data from dict output by stats.collect_trial_data"""
     normaldata = dict()
@@ -257,3 +288,180 @@ def _normals_from_data(data):
             upper_vardata = curve_med_ds + curve_std_ds
             normaldata[var] = np.stack([lower_vardata, upper_vardata], axis=1)
     return normaldata
+
+
+def _session_checkpoint_key(c3ds):
+    """Key that identifies the state of the input data of a session"""
+    return {
+        'files': [list(_file_fingerprint(c3dfile)) for c3dfile in sorted(c3ds)],
+        'config': trialcache._config_digest(),
+    }
+
+
+def _checkpoint_fn(checkpoint_dir, session):
+    """Checkpoint file for a session"""
+    digest = hashlib.md5(op.abspath(session).encode('utf-8')).hexdigest()
+    return Path(checkpoint_dir) / ('%s.npz' % digest)
+
+
+def _load_checkpoint(fn, key):
+    """Load the session curves from a checkpoint, if it's valid for key"""
+    try:
+        with np.load(fn, allow_pickle=False) as npz:
+            if json.loads(str(npz['__key__'])) != key:
+                return None
+            return {var: npz[var] for var in npz.files if var != '__key__'}
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def _session_curves(session, tags, checkpoint_dir):
+    """Collect the model curves for a session (worker function).
+
+    Returns a dict of (n_curves x 101) arrays keyed by variable. The curves are
+    checkpointed on disk, and only recomputed if the session data has changed.
+    """
+    c3ds = sessionutils.get_c3ds(session, tags=tags, trial_type='dynamic')
+    if not c3ds:
+        raise GaitDataError('No dynamic trials found for session %s' % session)
+    key = _session_checkpoint_key(c3ds)
+    fn = _checkpoint_fn(checkpoint_dir, session)
+    curves = _load_checkpoint(fn, key)
+    if curves is not None:
+        logger.debug('using checkpoint for %s' % session)
+        return curves
+    logger.debug('collecting curves for %s' % session)
+    # we are already in a worker process, so the trials are created serially
+    trials = [trial.Trial(c3dfile) for c3dfile in c3ds]
+    data_all, _ = stats.collect_trial_data(trials, collect_types=['model'])
+    curves = {
+        var: vardata
+        for var, vardata in data_all['model'].items()
+        if vardata is not None
+    }
+    arrays = dict(curves, __key__=np.array(json.dumps(key)))
+    trialcache._write_atomic(fn, lambda f: np.savez(f, **arrays))
+    return curves
+
+
+def _merge_curves(curves_list):
+    """Merge session curves into the dict format of collect_trial_data()"""
+    chunks = defaultdict(list)
+    for curves in curves_list:
+        for var, vardata in curves.items():
+            chunks[var].append(vardata)
+    data = defaultdict(lambda: None)
+    data.update({var: np.concatenate(vardata) for var, vardata in chunks.items()})
+    return data
+
+
+def _session_age(session):
+    """Patient age at the time of a session, or None if it is not known"""
+    info = sessionutils.load_info(session)
+    if info is not None and info.get('hetu'):
+        try:
+            session_t = sessionutils.get_session_date(session)
+        except GaitDataError:
+            logger.warning('cannot determine session date for %s' % session)
+            return None
+        try:
+            return age_from_hetu(info['hetu'], session_t)
+        except ValueError:
+            logger.warning('invalid hetu in patient info for %s' % session)
+    return None
+
+
+def build_normaldata(
+    sessions,
+    destdir,
+    basename=None,
+    tags=None,
+    workers=None,
+    checkpoint_dir=None,
+    on_error='raise',
+):
+    """Build model normal data from a set of (control) sessions.
+
+    The gait curves of each session are collected in a process pool. The
+    curves are checkpointed for each session, so that a rerun only processes
+    sessions that are new or whose data has changed. Normal data is then
+    computed from the merged curves of all sessions (see _normals_from_data)
+    and written in both xlsx and gcd formats. Additionally, age specific
+    normal data is written for each age range in cfg.general.normaldata_age,
+    using the sessions whose patient age at the session date (from the patient
+    info) falls into the range. The age specific files get the names of the
+    configured files.
+
+    Parameters
+    ----------
+    sessions : list
+        List of session paths.
+    destdir : str
+        Directory for the output files.
+    basename : str | None
+        Base name (without extension) for the output files computed from all
+        sessions. Default is 'normaldata'.
+    tags : list | None
+        Eclipse tags for selecting the trials. None to use all dynamic trials.
+    workers : int | None
+        Number of worker processes. If None, taken from cfg.trial.load_workers.
+        If that is None too, the number of CPUs is used.
+    checkpoint_dir : str | None
+        Directory for the session checkpoints. If None, a .checkpoints
+        directory under destdir is used.
+    on_error : str
+        What to do when a session cannot be processed. If 'raise', raise a
+        GaitDataError listing the errors for each failed session. If 'skip',
+        the error is logged and the session is ignored.
+
+    Returns
+    -------
+    dict
+        The normal data dicts, keyed by the age range tuple, or None for the
+        normal data from all sessions.
+    """
+    if basename is None:
+        basename = 'normaldata'
+    if checkpoint_dir is None:
+        checkpoint_dir = op.join(destdir, '.checkpoints')
+    if workers is None:
+        workers = cfg.trial.load_workers or os.cpu_count() or 1
+    if on_error not in ('raise', 'skip'):
+        raise ValueError('Invalid on_error: %s' % on_error)
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    sessions = list(sessions)
+    items = [(session, tags, checkpoint_dir) for session in sessions]
+    results, errors = trial._run_in_pool(_session_curves, items, workers)
+    curves = {
+        sessions[k]: curves_ for k, curves_ in enumerate(results) if k not in errors
+    }
+    errors = {sessions[k]: e for k, e in sorted(errors.items())}
+    trial._check_errors(errors, on_error, 'Could not process sessions')
+    sessions = [session for session in sessions if session in curves]
+    if not sessions:
+        raise GaitDataError('No data for normal data')
+    # session groups for the outputs
+    groups = {None: (sessions, basename)}
+    ages = {session: _session_age(session) for session in sessions}
+    for age_range, filename in cfg.general.normaldata_age.items():
+        sessions_ = [
+            session
+            for session, age in ages.items()
+            if age is not None and age_range[0] <= age <= age_range[1]
+        ]
+        if not sessions_:
+            logger.warning('no sessions for age range %d-%d' % tuple(age_range))
+            continue
+        # the configured names may be Windows paths
+        name = op.splitext(filename.replace('\\', '/').split('/')[-1])[0]
+        groups[tuple(age_range)] = (sessions_, name)
+    normaldata = dict()
+    for key, (sessions_, name) in groups.items():
+        logger.info(
+            'computing normal data %s from %d sessions' % (name, len(sessions_))
+        )
+        ndata = _normals_from_data(_merge_curves(curves[s] for s in sessions_))
+        _write_xlsx(ndata, op.join(destdir, name + '.xlsx'))
+        _write_gcd(ndata, op.join(destdir, name + '.gcd'))
+        normaldata[key] = ndata
+    return normaldata
@@ -8,7 +8,10 @@ Misc numerical utils
 """
 
 
+from concurrent.futures import ThreadPoolExecutor
+import functools
 import logging
+import math
 import numpy as np
 import hashlib
 from scipy import signal
@@ -48,6 +51,24 @@ def _rotation_matrix(yaw, pitch, roll):
     return np.array([r1, r2, r3])
 
 
+def kabsch_rotation_batch(P, Q):
+    """Calculate rotation matrices P->Q for stacks of point sets.
+
+    Vectorized version of kabsch_rotation(). P and Q are arrays of shape
+    (..., N, 3); all the rotations are solved by a single batched SVD. Returns
+    the rotation matrices, shape (..., 3, 3).
+    """
+    H = np.swapaxes(P, -1, -2) @ Q
+    U, S, Vt = np.linalg.svd(H)
+    V = np.swapaxes(Vt, -1, -2)
+    Ut = np.swapaxes(U, -1, -2)
+    # correct for reflections
+    E = np.zeros(H.shape)
+    E[..., 0, 0] = E[..., 1, 1] = 1
+    E[..., 2, 2] = np.sign(np.linalg.det(V @ Ut))
+    return V @ E @ Ut
+
+
 def _rigid_body_extrapolate_markers(P0, Pr):
     """Extrapolate some markers in a rigid set.
     P0 (N x 3), the marker positions in the static frame.
@@ -59,20 +80,30 @@ def _rigid_body_extrapolate_markers(P0, Pr):
     reference markers in P0)
     -apply R and t to P0 to get the extrapolated positions
     """
-    nref = Pr.shape[0]
-    if P0.shape <= nref:
-        raise ValueError('1st dim of P0 needs to be larger than 1st dim of Pr')
+    return _rigid_body_extrapolate_markers_batch(P0, Pr[None, :, :])[0]
+
+
+def _rigid_body_extrapolate_markers_batch(P0, Pr):
+    """Extrapolate some markers in a rigid set, for many frames at once.
+    P0 (N x 3), the marker positions in the static frame.
+    Pr (F x M x 3), the reference marker positions in F frames.
+    Returns the extrapolated positions of the last N-M markers of P0, shape
+    (F x N-M x 3).
+    """
+    nref = Pr.shape[1]
+    if P0.shape[0] <= nref:
+        raise ValueError('1st dim of P0 needs to be larger than 2nd dim of Pr')
     Pr0 = P0[:nref, :]  # reference markers
-    # find rotation and translation that take the static reference position to the
-    # position where extrapolation is needed
+    # find rotations and translations that take the static reference position to
+    # the positions where extrapolation is needed
     trans0 = Pr0.mean(axis=0)
     Pr0_ = Pr0 - trans0
     P0_ = P0 - trans0
-    trans1 = Pr.mean(axis=0)
+    trans1 = Pr.mean(axis=1, keepdims=True)
     Pr_ = Pr - trans1
-    R = kabsch_rotation(Pr0_, Pr_)
-    # apply the transformation to the markers to be extrapolated
-    return np.dot(R, P0_[nref:, :].T).T + trans1
+    R = kabsch_rotation_batch(np.broadcast_to(Pr0_, Pr_.shape), Pr_)
+    # apply the transformations to the markers to be extrapolated
+    return P0_[nref:, :] @ np.swapaxes(R, -1, -2) + trans1
 
 
 def mad(data, axis=None, scale=1.4826, keepdims=False):
@@ -404,12 +435,12 @@ def rms(data, win, axis=None, pad_mode=None):
     return np.pad(rms_, padarg, mode=pad_mode)
 
 
-def envelope(data, sfrate=None, axis=None):
+def envelope(data, sfrate=None, axis=None, workers=1):
     """Calculate an envelope for data using the configured method"""
     if cfg.emg.envelope_method == 'linear_envelope':
         if sfrate is None:
             raise RuntimeError('Linear envelope requires the sampling rate')
-        data = _linear_envelope(data, sfrate, axis=axis)
+        data = _linear_envelope(data, sfrate, axis=axis, workers=workers)
     elif cfg.emg.envelope_method == 'rms':
         data = rms(data, cfg.emg.rms_win, axis=axis)
     else:
@@ -417,28 +448,125 @@ def envelope(data, sfrate=None, axis=None):
     return data
 
 
-def _linear_envelope(data, sfrate, axis=None):
+def _linear_envelope(data, sfrate, axis=None, workers=1):
     """Calculate a linear envelope"""
     data_rect = np.abs(data)
-    return _filtfilt(data_rect, [0, cfg.emg.linear_envelope_lowpass], sfrate, axis=axis)
+    return _filtfilt(
+        data_rect,
+        [0, cfg.emg.linear_envelope_lowpass],
+        sfrate,
+        axis=axis,
+        workers=workers,
+    )
 
 
-def _filtfilt(data, passband, sfrate, buttord=5, axis=None):
+@functools.lru_cache(maxsize=None)
+def _butter_sos(passband, sfrate, buttord):
+    """Design a Butterworth filter in second-order sections form.
+
+    passband must be a tuple; see _filtfilt(). The designs are memoized, so the
+    returned array must not be modified.
+    """
+    passbandn = 2 * np.array(passband) / sfrate
+    if passbandn[0] > 0:  # bandpass
+        sos = signal.butter(buttord, passbandn, 'bandpass', output='sos')
+    else:  # lowpass
+        sos = signal.butter(buttord, passbandn[1], output='sos')
+    return sos
+
+
+def _filtfilt(data, passband, sfrate, buttord=5, axis=None, workers=1):
     """Forward-backward filter.
     Filter data into given passband, e.g. [1, 40].
     Frequencies are given in Hz along with sfrate (sampling rate).
     Implemented as pure lowpass, if highpass freq = 0.
+
+    Multidimensional data is filtered along the given axis (by default the
+    last one). If workers > 1, the remaining dimensions are split into blocks
+    that are filtered in a thread pool (SciPy releases the GIL while filtering).
     """
     if axis is None:
         axis = -1  # filtfilt() default
     if passband is None:
         return data
-    passbandn = 2 * np.array(passband) / sfrate
-    if passbandn[0] > 0:  # bandpass
-        b, a = signal.butter(buttord, passbandn, 'bandpass')
-    else:  # lowpass
-        b, a = signal.butter(buttord, passbandn[1])
-    return signal.filtfilt(b, a, data, axis=axis)
+    passband = tuple(float(f) for f in passband)
+    sos = _butter_sos(passband, float(sfrate), buttord)
+    data = np.asarray(data)
+    if workers is None or workers <= 1 or data.ndim == 1:
+        return signal.sosfiltfilt(sos, data, axis=axis)
+    # filter rows of a (nrows, nsamples) view in blocks
+    data_ = np.moveaxis(data, axis, -1)
+    rows = data_.reshape(-1, data_.shape[-1])
+    out = np.empty(rows.shape, dtype=np.result_type(rows, sos))
+    bounds = np.linspace(0, len(rows), min(workers, len(rows)) + 1).astype(int)
+    blocks = [slice(a, b) for a, b in zip(bounds[:-1], bounds[1:])]
+
+    def _filter_block(block):
+        out[block] = signal.sosfiltfilt(sos, rows[block], axis=-1)
+
+    with ThreadPoolExecutor(max_workers=len(blocks)) as executor:
+        list(executor.map(_filter_block, blocks))
+    return np.moveaxis(out.reshape(data_.shape), -1, axis)
+
+
+def resample_segments(data, segments, n, method=None):
+    """Resample segments of data into a grid of common length.
+
+    All segments are processed in one call; e.g. all gait cycles of an EMG
+    channel.
+
+    Parameters
+    ----------
+    data : ndarray
+        The data. Time is along the last axis, so that e.g. (n_channels, N)
+        data is resampled for all channels at once.
+    segments : sequence
+        Sequence of (start, end) sample indices for each segment. The end index
+        is exclusive.
+    n : int
+        Number of samples in the resampled segments.
+    method : str | None
+        The resampling method. 'linear' interpolates linearly, so that the
+        first and last samples of the segment map onto the ends of the grid.
+        'polyphase' uses scipy.signal.resample_poly() and 'fft' uses
+        scipy.signal.resample(); these treat the segment as n samples spanning
+        the same time as the original samples. If None, taken from
+        cfg.emg.cycle_resample_method.
+
+    Returns
+    -------
+    ndarray
+        The resampled data, shape (n_segments, ..., n).
+    """
+    if method is None:
+        method = cfg.emg.cycle_resample_method
+    if method not in ('linear', 'polyphase', 'fft'):
+        raise ValueError('Invalid resampling method: %s' % method)
+    data = np.asarray(data)
+    segments = np.asarray(segments, dtype=int).reshape(-1, 2)
+    starts, ends = segments[:, 0], segments[:, 1]
+    lens = ends - starts
+    if (lens < 1).any() or (starts < 0).any() or (ends > data.shape[-1]).any():
+        raise ValueError('invalid segments for data of length %d' % data.shape[-1])
+    if method == 'linear':
+        # sample positions of the grid for all segments, shape (n_segments, n)
+        pos = starts[:, None] + np.linspace(0, 1, n)[None, :] * (lens - 1)[:, None]
+        lo = np.minimum(np.floor(pos).astype(int), (ends - 1)[:, None])
+        hi = np.minimum(lo + 1, (ends - 1)[:, None])
+        w = pos - lo
+        res = data[..., lo] * (1 - w) + data[..., hi] * w
+        return np.moveaxis(res, -2, 0)
+    res = np.empty((len(segments),) + data.shape[:-1] + (n,))
+    for k, (start, end) in enumerate(segments):
+        seg = data[..., start:end]
+        if method == 'polyphase':
+            g = math.gcd(n, end - start)
+            res[k] = signal.resample_poly(
+                seg, n // g, (end - start) // g, axis=-1, padtype='line'
+            )
+        else:
+            res[k] = signal.resample(seg, n, axis=-1)
+    return res
 
 
 def _get_local_max(data):
@@ -4,37 +4,208 @@ Wrapper methods that read from Vicon Nexus or c3d files.
 The 'source' argument can be either a ViconNexus.ViconNexus instance or a c3d
 filename. Returned values should be independent of source.
 
+The source may also be given as a SourceContext instance, which memoizes the
+reads from the underlying source. Code that reads several kinds of data from
+the same source (e.g. Trial and EMG) can share a context, so that each kind of
+data is read only once.
+
 @author: Jussi (jnu@iki.fi)
 """
 
 from collections import defaultdict
+import copy
 import numpy as np
 import logging
 
-from . import nexus, c3d
+from . import nexus, c3d, c3d_numpy, trialcache
 from .config import cfg
+from .envutils import GaitDataError
 
 
 logger = logging.getLogger(__name__)
 
 
+def _c3d_reader_module():
+    """Return the c3d reader module selected in config"""
+    if cfg.general.c3d_reader == 'numpy' or not c3d.BTK_IMPORTED:
+        return c3d_numpy
+    elif cfg.general.c3d_reader == 'btk':
+        return c3d
+    else:
+        raise ValueError('Invalid c3d reader %s' % cfg.general.c3d_reader)
+
+
 def _reader_module(source):
     """Determine the appropriate data reader module to use"""
     if nexus._is_vicon_instance(source):
         return nexus
     elif c3d._is_c3d_file(source):
-        return c3d
+        return _c3d_reader_module()
     else:
         raise RuntimeError('Unknown type for data source %s' % source)
 
 
-def get_metadata(source):
-    """Get trial metadata from a source.
+def _cached_read(source, kind, reader, subkind=None):
+    """Read data via the persistent trial cache.
+
+    For c3d sources, the data is returned from the cache if possible. Otherwise
+    it is read by calling reader() and written into the cache. Errors
+    (GaitDataError) are cached too. For other sources, reader() is simply
+    called.
+    """
+    if _reader_module(source) is nexus or not trialcache._enabled():
+        return reader()
+    data = trialcache.load(source, kind, subkind)
+    if data is not None:
+        return data
+    try:
+        data = reader()
+    except GaitDataError as e:
+        trialcache.store(source, kind, e, subkind)
+        raise
+    trialcache.store(source, kind, data, subkind)
+    # return from the cache, so that the output is consistent between calls
+    data_cached = trialcache.load(source, kind, subkind)
+    return data if data_cached is None else data_cached
+
+
+class SourceContext:
+    """Memoized reads from a single data source.
+
+    The read_data functions accept a SourceContext instance in place of the
+    source. Each kind of data is then read from the underlying source only
+    once, regardless of which caller requests it first. Read errors
+    (GaitDataError) are memoized too.
 
     Parameters
     ----------
     source : ViconNexus | str
         The data source. Can be a c3d filename or a ViconNexus instance.
+    """
+
+    def __init__(self, source):
+        if isinstance(source, SourceContext):
+            raise ValueError('source is already a SourceContext')
+        self.source = source
+        self._metadata = None
+        self._markers = dict()
+        self._markers_missing = set()
+        self._data = dict()
+
+    def __repr__(self):
+        return '<SourceContext: %s>' % self.source
+
+    def __getstate__(self):
+        """Return the state for pickling. The memoized data is not stored."""
+        if nexus._is_vicon_instance(self.source):
+            raise TypeError('Cannot pickle a context for a Nexus source')
+        return {'source': self.source}
+
+    def __setstate__(self, state):
+        self.__init__(state['source'])
+
+    def _memoized(self, key, reader):
+        """Call reader() on first request of key, return the memoized result
+        afterwards"""
+        if key not in self._data:
+            try:
+                self._data[key] = reader()
+            except GaitDataError as e:
+                self._data[key] = e
+        data = self._data[key]
+        if isinstance(data, GaitDataError):
+            raise data
+        return data
+
+    def get_metadata(self):
+        """Return a copy of the metadata, see get_metadata()"""
+        if self._metadata is None:
+            self._metadata = get_metadata(self.source)
+        return _copy_metadata(self._metadata)
+
+    def get_marker_data(self, markers, ignore_missing=False):
+        """Return marker data, see get_marker_data().
+
+        Only markers that have not been requested before are read from the
+        source.
+        """
+        if not isinstance(markers, list):
+            markers = [markers]
+        toread = [
+            marker
+            for marker in markers
+            if marker not in self._markers and marker not in self._markers_missing
+        ]
+        if toread:
+            mkrdata = get_marker_data(self.source, toread, ignore_missing=True)
+            self._markers.update(mkrdata)
+            self._markers_missing.update(set(toread) - set(mkrdata))
+        mkrdata = dict()
+        for marker in markers:
+            if marker in self._markers:
+                mkrdata[marker] = self._markers[marker]
+            elif not ignore_missing:
+                raise GaitDataError('Cannot read trajectory %s' % marker)
+            elif marker not in toread:  # otherwise already warned by the reader
+                logger.warning('Cannot read trajectory %s' % marker)
+        return mkrdata
+
+    def get_model_data(self, model):
+        """Return model data, see get_model_data()"""
+        modeldata = self._memoized(
+            ('model', model.desc), lambda: _get_model_data(self.source, model, self)
+        )
+        return dict(modeldata)
+
+    def get_forceplate_data(self):
+        """Return forceplate data, see get_forceplate_data()"""
+        return self._memoized('forceplate', lambda: get_forceplate_data(self.source))
+
+    def get_emg_data(self):
+        """Return EMG data, see get_emg_data()"""
+        return self._memoized('emg', lambda: get_emg_data(self.source))
+
+    def get_accelerometer_data(self):
+        """Return accelerometer data, see get_accelerometer_data()"""
+        return self._memoized(
+            'accelerometer', lambda: get_accelerometer_data(self.source)
+        )
+
+    def get_analysis(self, condition='unknown'):
+        """Return analysis data, see get_analysis()"""
+        an = self._memoized(
+            'analysis', lambda: _get_analysis(self.source, self)['unknown']
+        )
+        di = defaultdict(lambda: defaultdict(dict))
+        di[condition].update(copy.deepcopy(an))
+        return di
+
+
+def _raw_source(source):
+    """Return the underlying source, if source is a SourceContext"""
+    return source.source if isinstance(source, SourceContext) else source
+
+
+def _copy_metadata(meta):
+    """Copy a metadata dict, so that the copy can be freely modified"""
+    meta_copy = meta.copy()
+    meta_copy['events'] = copy.deepcopy(meta['events'])
+    subj_params = defaultdict(lambda: None)
+    subj_params.update(meta['subj_params'])
+    meta_copy['subj_params'] = subj_params
+    if 'markers' in meta:
+        meta_copy['markers'] = meta['markers'][:]
+    return meta_copy
+
+
+def get_metadata(source):
+    """Get trial metadata from a source.
+
+    Parameters
+    ----------
+    source : ViconNexus | str | SourceContext
+        The data source. Can be a c3d filename, a ViconNexus instance or a
+        SourceContext.
 
     Returns
     -------
@@ -65,7 +236,11 @@ def get_metadata(source):
         events : TrialEvents
             Trial events (foot strikes, toeoffs etc.)
     """
-    meta = _reader_module(source)._get_metadata(source)
+    if isinstance(source, SourceContext):
+        return source.get_metadata()
+    meta = _cached_read(
+        source, 'metadata', lambda: _reader_module(source)._get_metadata(source)
+    )
     # Nexus uses slightly different metadata field names as c3d,
     # so translate here into c3d naming convention
     # XXX: c3d angle params are apparently in radians while Nexus uses degrees
@@ -90,8 +265,9 @@ def get_forceplate_data(source):
 
     Parameters
     ----------
-    source : ViconNexus | str
-        The data source. Can be a c3d filename or a ViconNexus instance.
+    source : ViconNexus | str | SourceContext
+        The data source. Can be a c3d filename, a ViconNexus instance or a
+        SourceContext.
 
     Returns
     -------
@@ -110,7 +286,13 @@ def get_forceplate_data(source):
         samplesperframe : int
             Analog samples per capture frame.
     """
-    return _reader_module(source)._get_forceplate_data(source)
+    if isinstance(source, SourceContext):
+        return source.get_forceplate_data()
+    return _cached_read(
+        source,
+        'forceplate',
+        lambda: _reader_module(source)._get_forceplate_data(source),
+    )
 
 
 def get_marker_data(source, markers, ignore_missing=False):
@@ -118,8 +300,9 @@ def get_marker_data(source, markers, ignore_missing=False):
 
     Parameters
     ----------
-    source : ViconNexus | str
-        The data source. Can be a c3d filename or a ViconNexus instance.
+    source : ViconNexus | str | SourceContext
+        The data source. Can be a c3d filename, a ViconNexus instance or a
+        SourceContext.
     markers : list | str
         Marker name, or list of marker names.
     ignore_missing : bool, optional
@@ -131,11 +314,33 @@ def get_marker_data(source, markers, ignore_missing=False):
         Marker data dict. Keys are marker names and values are Nx3 ndarrays of
         x,y,z data.
     """
-    return _reader_module(source)._get_marker_data(
+    if isinstance(source, SourceContext):
+        return source.get_marker_data(markers, ignore_missing=ignore_missing)
+    if _reader_module(source) is nexus or not trialcache._enabled():
+        return _reader_module(source)._get_marker_data(
+            source,
+            markers,
+            ignore_missing=ignore_missing,
+        )
+    # for c3d files, all markers are cached at once
+    if not isinstance(markers, list):
+        markers = [markers]
+    mkrdata_all = _cached_read(
         source,
-        markers,
-        ignore_missing=ignore_missing,
+        'markers',
+        lambda: _reader_module(source)._get_marker_data(
+            source, get_metadata(source)['markers'], ignore_missing=True
+        ),
     )
+    mkrdata = dict()
+    for marker in markers:
+        if marker in mkrdata_all:
+            mkrdata[marker] = mkrdata_all[marker]
+        elif ignore_missing:
+            logger.warning('Cannot read trajectory %s from c3d file' % marker)
+        else:
+            raise GaitDataError('Cannot read trajectory %s from c3d file' % marker)
+    return mkrdata
 
 
 def get_emg_data(source):
@@ -143,8 +348,9 @@ def get_emg_data(source):
 
     Parameters
     ----------
-    source : ViconNexus | str
-        The data source. Can be a c3d filename or a ViconNexus instance.
+    source : ViconNexus | str | SourceContext
+        The data source. Can be a c3d filename, a ViconNexus instance or a
+        SourceContext.
 
     Returns
     -------
@@ -155,7 +361,11 @@ def get_emg_data(source):
         data : dict
             The data. Keys are channel names and values are ndarrays.
     """
-    return _reader_module(source)._get_emg_data(source)
+    if isinstance(source, SourceContext):
+        return source.get_emg_data()
+    return _cached_read(
+        source, 'emg', lambda: _reader_module(source)._get_emg_data(source)
+    )
 
 
 def get_analysis(source, condition='unknown'):
@@ -163,8 +373,9 @@ def get_analysis(source, condition='unknown'):
 
     Parameters
     ----------
-    source : str
-        Name of a c3d file. Reads from Nexus are not supported yet.
+    source : str | SourceContext
+        Name of a c3d file, or a SourceContext for one. Reads from Nexus are not
+        supported yet.
     condition : str, optional
         The condition name for the analysis dict, by default 'unknown'.
 
@@ -174,9 +385,28 @@ def get_analysis(source, condition='unknown'):
         A nested dict of the analysis values, keyed by variable name and
         context. The first key is the condition name.
     """
+    if isinstance(source, SourceContext):
+        return source.get_analysis(condition)
+    return _get_analysis(source, condition=condition)
+
+
+def _get_analysis(source, ctx=None, condition='unknown'):
+    """Read analysis data.
+
+    ctx is passed on to the reader, so that it can be used for computing
+    missing values (step width) without re-reading the source.
+    """
     if nexus._is_vicon_instance(source):
         raise Exception('Analysis var reads from Nexus not supported yet')
-    return _reader_module(source).get_analysis(source, condition)
+    reader = _reader_module(source)
+    an = _cached_read(
+        source,
+        'analysis',
+        lambda: reader.get_analysis(source, 'unknown', ctx=ctx)['unknown'],
+    )
+    di = defaultdict(lambda: defaultdict(dict))
+    di[condition].update(an)
+    return di
 
 
 def get_accelerometer_data(source):
@@ -184,8 +414,9 @@ def get_accelerometer_data(source):
 
     Parameters
     ----------
-    source : ViconNexus | str
-        The data source. Can be a c3d filename or a ViconNexus instance.
+    source : ViconNexus | str | SourceContext
+        The data source. Can be a c3d filename, a ViconNexus instance or a
+        SourceContext.
 
     Returns
     -------
@@ -196,7 +427,13 @@ def get_accelerometer_data(source):
         data : dict
             The data. Keys are channel names and values are ndarrays.
     """
-    return _reader_module(source)._get_accelerometer_data(source)
+    if isinstance(source, SourceContext):
+        return source.get_accelerometer_data()
+    return _cached_read(
+        source,
+        'accelerometer',
+        lambda: _reader_module(source)._get_accelerometer_data(source),
+    )
 
 
 def get_model_data(source, model):
@@ -204,8 +441,9 @@ def get_model_data(source, model):
 
     Parameters
     ----------
-    source : ViconNexus | str
-        The data source. Can be a c3d filename or a ViconNexus instance.
+    source : ViconNexus | str | SourceContext
+        The data source. Can be a c3d filename, a ViconNexus instance or a
+        SourceContext.
     model : GaitModel
         The model to read. For available models, see models.py. For a known
         variable name, the corresponding model can be obtained by calling
@@ -217,19 +455,45 @@ def get_model_data(source, model):
         The model data. Keys are model variable names and values are ndarrays of
         data.
     """
-    modeldata = _reader_module(source)._get_model_data(source, model)
-    for var in model.read_vars:
-        # convert Moment variables into SI units
-        if var.find('Moment') > 0:
-            modeldata[var] /= 1.0e3  # Nmm -> Nm
-        # split 3D arrays into x,y,z variables
-        if model.read_strategy == 'split_xyz':
+    if isinstance(source, SourceContext):
+        return source.get_model_data(model)
+    return _get_model_data(source, model)
+
+
+def _get_model_data(source, model, ctx=None):
+    """Read model data.
+
+    If ctx is given, the metadata needed for the corrections is read via it.
+    """
+    modeldata = _cached_read(
+        source,
+        'model',
+        lambda: _read_model_data(source, model, ctx),
+        subkind=model.desc,
+    )
+    modeldata = dict(modeldata)
+    # split 3D arrays into x,y,z variables (these are views, not copies)
+    if model.read_strategy == 'split_xyz':
+        for var in model.read_vars:
             if modeldata[var].shape[0] == 3:
                 modeldata[var + 'X'] = modeldata[var][0, :]
                 modeldata[var + 'Y'] = modeldata[var][1, :]
                 modeldata[var + 'Z'] = modeldata[var][2, :]
             else:
                 raise RuntimeError('Expected a 3D array')
+    return modeldata
+
+
+def _read_model_data(source, model, ctx=None):
+    """Read model data from source and apply our corrections.
+
+    Returns new arrays, i.e. the reader output is not modified in place.
+    """
+    modeldata = _reader_module(source)._get_model_data(source, model)
+    for var in model.read_vars:
+        # convert Moment variables into SI units
+        if var.find('Moment') > 0:
+            modeldata[var] = modeldata[var] / 1.0e3  # Nmm -> Nm
     # For basic Plug-in Gait, add the tibial torsion value to knee rotation.
     # This is to compensate for a weird PiG feature that offsets knee rotation
     # by tibial torsion, so that it always rotates around zero. With this fix,
@@ -238,9 +502,9 @@ def get_model_data(source, model):
         model.desc == 'Plug-in Gait lower body kinematics'
         and cfg.models.add_tibial_torsion
     ):
-        params = get_metadata(source)['subj_params']
+        params = get_metadata(source if ctx is None else ctx)['subj_params']
         for ctxt in 'RL':
-            var_knee = ctxt + 'KneeAnglesZ'
+            var_knee = ctxt + 'KneeAngles'
             var_torsion = ctxt + 'TibialTorsion'
             if var_torsion in params and var_knee in modeldata:
                 tibt = params[var_torsion]
@@ -249,5 +513,7 @@ def get_model_data(source, model):
                     tibt /= np.pi / 180
                 if np.abs(tibt) > 1e-2:  # do not add insignificant values
                     logger.info('adding %s tibial torsion: %g deg' % (ctxt, tibt))
-                    modeldata[var_knee] += tibt
+                    knee_angles = modeldata[var_knee].copy()
+                    knee_angles[2, :] += tibt  # Z component is knee rotation
+                    modeldata[var_knee] = knee_angles
     return modeldata
@@ -30,7 +30,7 @@ from .. import (
 from ..config import cfg
 from ..envutils import GaitDataError
 from ..sessionutils import enf_to_trialfile
-from ..trial import Trial
+from ..trial import load_trials
 from ..viz.plot_plotly import plot_trials, plot_extracted_box
 from ..viz import timedist, layouts
 from ..stats import AvgTrial, _trials_extract_values
@@ -283,23 +283,32 @@ def dash_report(
 
         # make Trial instances for all dynamic and static trials
         # this is currently necessary even if saved figures are used
-        trials_dyn = list()
-        trials_dyn_dict = dict()  # also organize dynamic trials by session
-        trials_static = list()
+        # first collect the files, then load the trials in parallel
+        c3ds_dyn = list()  # (session, c3dfile) tuples
+        c3ds_static = list()
         for session in sessions:
-            trials_dyn_dict[session] = list()
             for tag in dyn_tags:
                 if enfs[session]['dynamic'][tag]:
-                    if signals.canceled:
-                        return None
                     c3dfile = enf_to_trialfile(enfs[session]['dynamic'][tag][0], 'c3d')
-                    tri = Trial(c3dfile)
-                    trials_dyn.append(tri)
-                    trials_dyn_dict[session].append(tri)
+                    c3ds_dyn.append((session, c3dfile))
             if enfs[session]['static'][static_tag]:
                 c3dfile = enf_to_trialfile(enfs[session]['static']['Static'][0], 'c3d')
-                tri = Trial(c3dfile)
-                trials_static.append(tri)
+                c3ds_static.append(c3dfile)
+        signals.progress.emit('Loading trials...', 0)
+        trials_all = load_trials(
+            [c3dfile for _, c3dfile in c3ds_dyn] + c3ds_static, signals=signals
+        )
+        if trials_all is None:  # canceled
+            return None
+        trials_dyn = trials_all[: len(c3ds_dyn)]
+        trials_static = trials_all[len(c3ds_dyn) :]
+        trials_dyn_dict = dict()  # also organize dynamic trials by session
+        for session in sessions:
+            trials_dyn_dict[session] = [
+                tri
+                for (session_, _), tri in zip(c3ds_dyn, trials_dyn)
+                if session_ == session
+            ]
 
         emg_auto_layout = None
 
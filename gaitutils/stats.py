@@ -7,17 +7,22 @@ Compute statistics across/within trials
 """
 
 
+import concurrent.futures
 import logging
 import numpy as np
-import scipy
 import os.path as op
 import itertools
+import shutil
+import tempfile
+import warnings
+import weakref
 from collections import defaultdict
+from scipy.special import erfcinv
+import scipy.stats
 
-from .trial import Trial, Gaitcycle
+from .trial import Trial, Gaitcycle, load_trials
 from . import models, numutils
 from .envutils import GaitDataError
-from .numutils import _get_local_max, _get_local_min
 from .config import cfg
 from .emg import AvgEMG
 
@@ -186,6 +191,101 @@ def _robust_reject_rows(data, p_threshold):
     return data
 
 
+def _stack_curves(vardata):
+    """Stack curves of several variables into a nan-padded tensor.
+
+    vardata is a list of (n_curves x T) arrays with equal T. Returns the
+    (n_vars x max_curves x T) tensor and a (n_vars x max_curves) mask of the
+    rows that hold data.
+    """
+    counts = np.array([len(x) for x in vardata])
+    npts = vardata[0].shape[1]
+    tensor = np.full((len(vardata), counts.max(), npts), np.nan)
+    for k, x in enumerate(vardata):
+        tensor[k, : len(x)] = x
+    rows = np.arange(tensor.shape[1])[None, :] < counts[:, None]
+    return tensor, rows
+
+
+def _masked_median(tensor, rows):
+    """Median over axis 1 of a tensor, using only the given rows.
+
+    Like np.median, the result is nan where the selected data has nans.
+    """
+    sel = rows[:, :, None]
+    with warnings.catch_warnings():  # all-nan slices
+        warnings.simplefilter('ignore', RuntimeWarning)
+        med = np.nanmedian(np.where(sel, tensor, np.nan), axis=1)
+    med[np.any(np.isnan(tensor) & sel, axis=1)] = np.nan
+    return med
+
+
+def _masked_mad(tensor, rows, med, scale=1.4826):
+    """MAD over axis 1 of a tensor, using only the given rows"""
+    return scale * _masked_median(np.abs(tensor - med[:, None, :]), rows)
+
+
+def _robust_reject_tensor(tensor, rows, p_threshold, varnames):
+    """Reject rows of a curve tensor based on robust Z-score.
+
+    Does the same as _robust_reject_rows() for all variables at once. Returns
+    the mask of accepted rows.
+    """
+    p_threshold_corr = p_threshold / tensor.shape[2]
+    med = _masked_median(tensor, rows)
+    mad = _masked_mad(tensor, rows, med)
+    z_threshold = np.sqrt(2) * erfcinv(p_threshold_corr)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        zs = (tensor - med[:, None, :]) / mad[:, None, :]
+        outlier_rows = np.any(np.abs(zs) > z_threshold, axis=2) & rows
+    for var, n_out in zip(varnames, outlier_rows.sum(axis=1)):
+        if n_out > 0:
+            logger.info(
+                '%s: rejected %d outlier(s) (corrected P=%g)'
+                % (var, n_out, p_threshold_corr)
+            )
+    return rows & ~outlier_rows
+
+
+def _average_curves(data, rows_ok, reject_outliers, use_medians):
+    """Average curves of several variables.
+
+    data is a dict of (n_curves x T) arrays (or None for no data) and rows_ok
+    gives the initially accepted rows of each array. Variables with equal T are
+    processed together as a tensor. Returns dicts of averages, stddevs and N
+    of accepted curves, in the order of data.
+    """
+    avgdata = {var: None for var in data}
+    stddata = {var: None for var in data}
+    ncycles_ok = {var: 0 for var in data}
+    by_len = defaultdict(list)
+    for var, vardata in data.items():
+        if vardata is not None and rows_ok[var].any():
+            by_len[vardata.shape[1]].append(var)
+    for vars_ in by_len.values():
+        tensor, rows = _stack_curves([data[var][rows_ok[var]] for var in vars_])
+        if reject_outliers is not None and not use_medians:
+            rows = _robust_reject_tensor(tensor, rows, reject_outliers, vars_)
+        n_ok = rows.sum(axis=1)
+        if use_medians:
+            avg = _masked_median(tensor, rows)
+            std = _masked_mad(tensor, rows, avg)
+        else:
+            # masked reductions; the summation order is the same as in
+            # ndarray.mean() and std() of the unpadded data
+            sel = rows[:, :, None]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                avg = np.where(sel, tensor, 0).sum(axis=1) / n_ok[:, None]
+                devs = np.where(sel, tensor - avg[:, None, :], 0)
+                std = np.sqrt((devs * devs).sum(axis=1) / n_ok[:, None])
+        for k, var in enumerate(vars_):
+            ncycles_ok[var] = int(n_ok[k])
+            if n_ok[k] > 0:
+                avgdata[var] = avg[k]
+                stddata[var] = std[k]
+    return avgdata, stddata, ncycles_ok
+
+
 def average_analog_data(data, reject_outliers=None, use_medians=None):
     """Average collected analog data.
 
@@ -212,36 +312,17 @@ def average_analog_data(data, reject_outliers=None, use_medians=None):
     ncycles_ok : dict
         N of accepted cycles for each variable.
     """
-    stddata = dict()
-    avgdata = dict()
-    ncycles_ok = dict()
-
     if use_medians is None:
         use_medians = False
 
-    for var, vardata in data.items():
-        if vardata is None:
-            stddata[var] = None
-            avgdata[var] = None
-            ncycles_ok[var] = 0
-            continue
-        else:
-            n_ok = vardata.shape[0]
-            # do the outlier rejection
-            if n_ok > 0 and reject_outliers is not None and not use_medians:
-                logger.info('averaging %s (N=%d)' % (var, n_ok))
-                vardata = _robust_reject_rows(vardata, reject_outliers)
-            n_ok = vardata.shape[0]
-            if n_ok == 0:
-                stddata[var] = None
-                avgdata[var] = None
-            elif use_medians:
-                stddata[var] = numutils.mad(vardata, axis=0)
-                avgdata[var] = np.median(vardata, axis=0)
-            else:
-                stddata[var] = vardata.std(axis=0) if n_ok > 0 else None
-                avgdata[var] = vardata.mean(axis=0) if n_ok > 0 else None
-            ncycles_ok[var] = n_ok
+    rows_ok = {
+        var: np.ones(len(vardata), dtype=bool)
+        for var, vardata in data.items()
+        if vardata is not None
+    }
+    avgdata, stddata, ncycles_ok = _average_curves(
+        data, rows_ok, reject_outliers, use_medians
+    )
 
     if not avgdata:
         logger.warning('nothing averaged')
@@ -277,57 +358,616 @@ def average_model_data(data, reject_zeros=None, reject_outliers=None, use_median
     ncycles_ok : dict
         N of accepted cycles for each variable.
     """
-    stddata = dict()
-    avgdata = dict()
-    ncycles_ok = dict()
-
     if use_medians is None:
         use_medians = False
 
     if reject_zeros is None:
         reject_zeros = True
 
+    rows_ok = dict()
     for var, vardata in data.items():
         if vardata is None:
-            stddata[var] = None
-            avgdata[var] = None
-            ncycles_ok[var] = 0
             continue
-        else:
-            Ntot = vardata.shape[0]
-            if reject_zeros:
-                this_model = models.model_from_var(var)
-                if not this_model.is_kinetic_var(var):
-                    rows_bad = np.where(np.any(vardata == 0, axis=1))[0]
-                    if len(rows_bad) > 0:
-                        logger.info(
-                            '%s: rejecting %d curves with zero values'
-                            % (var, len(rows_bad))
-                        )
-                        vardata = np.delete(vardata, rows_bad, axis=0)
-            n_ok = vardata.shape[0]
-            # do the outlier rejection
-            if n_ok > 0 and reject_outliers is not None and not use_medians:
-                logger.info('%s:' % var)
-                vardata = _robust_reject_rows(vardata, reject_outliers)
-            n_ok = vardata.shape[0]
-            if n_ok == 0:
-                stddata[var] = None
-                avgdata[var] = None
-            elif use_medians:
-                stddata[var] = numutils.mad(vardata, axis=0)
-                avgdata[var] = np.median(vardata, axis=0)
-            else:
-                stddata[var] = vardata.std(axis=0) if n_ok > 0 else None
-                avgdata[var] = vardata.mean(axis=0) if n_ok > 0 else None
-            logger.debug('%s: averaged %d/%d curves' % (var, n_ok, Ntot))
-            ncycles_ok[var] = n_ok
+        rows_ok[var] = np.ones(len(vardata), dtype=bool)
+        if reject_zeros:
+            this_model = models.model_from_var(var)
+            if not this_model.is_kinetic_var(var):
+                rows_bad = np.any(vardata == 0, axis=1)
+                if rows_bad.any():
+                    logger.info(
+                        '%s: rejecting %d curves with zero values'
+                        % (var, rows_bad.sum())
+                    )
+                    rows_ok[var] = ~rows_bad
+    avgdata, stddata, ncycles_ok = _average_curves(
+        data, rows_ok, reject_outliers, use_medians
+    )
+    for var in rows_ok:
+        logger.debug(
+            '%s: averaged %d/%d curves' % (var, ncycles_ok[var], len(data[var]))
+        )
 
     if not avgdata:
         logger.warning('nothing averaged')
     return (avgdata, stddata, ncycles_ok)
 
 
+class AvgTrialAccumulator:
+    """Incrementally average gait cycles into an AvgTrial.
+
+    Curves can be added one trial or one cycle at a time, and accumulators can
+    be merged, so that averages can be built from a large number of cycles
+    without keeping them in memory. For mean and standard deviation, running
+    moments (Welford's algorithm) are kept, so memory use does not depend on
+    the number of curves. Medians and outlier rejection need all curves; in
+    that case, the curves are spilled into on-disk buffers.
+
+    Parameters
+    ----------
+    reject_zeros : bool
+        Reject model curves which contain zero values. See average_model_data().
+    reject_outliers : float or None
+        None for no outlier rejection. Otherwise, a P value for false
+        rejection. See average_model_data().
+    use_medians: bool
+        Use median and MAD instead of mean and stddev.
+    analog_len : int
+        Grid length for analog data. See collect_trial_data().
+    analog_envelope : bool
+        Whether to average the envelope of analog data. See
+        collect_trial_data().
+    spill_dir : str | None
+        Directory for the on-disk buffers. If None, the system temporary
+        directory is used.
+    """
+
+    def __init__(
+        self,
+        reject_zeros=None,
+        reject_outliers=None,
+        use_medians=None,
+        analog_len=None,
+        analog_envelope=None,
+        spill_dir=None,
+    ):
+        if reject_zeros is None:
+            reject_zeros = True
+        if use_medians is None:
+            use_medians = False
+        self.reject_zeros = reject_zeros
+        self.reject_outliers = reject_outliers
+        self.use_medians = use_medians
+        self.analog_len = analog_len
+        self.analog_envelope = analog_envelope
+        self.nfiles = 0
+        # running moments, keyed by var type and var: [n, mean, M2]
+        self._moments = {'model': dict(), 'emg': dict()}
+        # spilled curves, keyed by var type and var: (filename, n, T)
+        self._spilled = {'model': dict(), 'emg': dict()}
+        self._spill_dir = None
+        if self.spills:
+            self._spill_dir = tempfile.mkdtemp(prefix='gaitutils_avg_', dir=spill_dir)
+            self._cleanup = weakref.finalize(
+                self, shutil.rmtree, self._spill_dir, ignore_errors=True
+            )
+
+    @property
+    def spills(self):
+        """Whether the curves are kept in on-disk buffers"""
+        return self.use_medians or self.reject_outliers is not None
+
+    def add_trial(self, trial):
+        """Add all gait cycles of a trial.
+
+        Parameters
+        ----------
+        trial : Trial | str
+            The trial, or a c3d filename to load it from.
+        """
+        tensors = collect_cycle_tensors(
+            [trial], analog_len=self.analog_len, analog_envelope=self.analog_envelope
+        )
+        for var_type, ct in tensors.items():
+            for var, data in ct.data.items():
+                self.add_cycle(var, data, var_type=var_type)
+        self.nfiles += 1
+
+    def add_cycle(self, var, data, var_type=None):
+        """Add curves of a variable.
+
+        Parameters
+        ----------
+        var : str
+            The variable name.
+        data : ndarray
+            A single curve (shape (T,)) or a number of curves (shape (N, T)).
+        var_type : str
+            The variable type, 'model' (the default) or 'emg'.
+        """
+        if var_type is None:
+            var_type = 'model'
+        if var_type not in self._moments:
+            raise ValueError('Invalid variable type: %s' % var_type)
+        data = np.atleast_2d(np.asarray(data, dtype=np.float64))
+        if var_type == 'model' and self.reject_zeros:
+            this_model = models.model_from_var(var)
+            if this_model is None or not this_model.is_kinetic_var(var):
+                rows_bad = np.any(data == 0, axis=1)
+                if rows_bad.any():
+                    logger.info(
+                        '%s: rejecting %d curves with zero values'
+                        % (var, rows_bad.sum())
+                    )
+                    data = data[~rows_bad]
+        if not len(data):
+            return
+        if self.spills:
+            self._spill(var_type, var, data)
+        else:
+            mean = data.mean(axis=0)
+            m2 = ((data - mean) ** 2).sum(axis=0)
+            self._combine(var_type, var, len(data), mean, m2)
+
+    def _combine(self, var_type, var, n_b, mean_b, m2_b):
+        """Combine moments of a batch of curves into the running moments"""
+        moments = self._moments[var_type]
+        if var not in moments:
+            moments[var] = [n_b, mean_b.copy(), m2_b.copy()]
+            return
+        n_a, mean_a, m2_a = moments[var]
+        if mean_a.shape != mean_b.shape:
+            raise ValueError('Curve length mismatch for %s' % var)
+        n = n_a + n_b
+        delta = mean_b - mean_a
+        mean_a += delta * (n_b / n)
+        m2_a += m2_b + delta ** 2 * (n_a * n_b / n)
+        moments[var][0] = n
+
+    def _spill(self, var_type, var, data):
+        """Append curves to the on-disk buffer"""
+        spilled = self._spilled[var_type]
+        if var not in spilled:
+            # variable names may not be valid filenames
+            fn = op.join(self._spill_dir, '%s_%d.bin' % (var_type, len(spilled)))
+            spilled[var] = (fn, 0, data.shape[1])
+        fn, n, T = spilled[var]
+        if data.shape[1] != T:
+            raise ValueError('Curve length mismatch for %s' % var)
+        with open(fn, 'ab') as f:
+            f.write(np.ascontiguousarray(data).tobytes())
+        spilled[var] = (fn, n + len(data), T)
+
+    def _spilled_data(self, var_type, var):
+        """Return the spilled curves as a read-only memory-mapped array"""
+        fn, n, T = self._spilled[var_type][var]
+        return np.memmap(fn, dtype=np.float64, mode='r', shape=(n, T))
+
+    def merge(self, other):
+        """Merge curves accumulated by another instance into this one.
+
+        Parameters
+        ----------
+        other : AvgTrialAccumulator
+            The other accumulator. It must use the same settings.
+        """
+        if (
+            other.spills != self.spills
+            or other.use_medians != self.use_medians
+            or other.reject_outliers != self.reject_outliers
+        ):
+            raise ValueError('Cannot merge accumulators with different settings')
+        for var_type in self._moments:
+            for var, (n, mean, m2) in other._moments[var_type].items():
+                self._combine(var_type, var, n, mean, m2)
+            for var in other._spilled[var_type]:
+                self._spill(var_type, var, other._spilled_data(var_type, var))
+        self.nfiles += other.nfiles
+
+    def finalize(self, sessionpath=None):
+        """Compute the averages.
+
+        Parameters
+        ----------
+        sessionpath : str | None
+            Session path for the AvgTrial.
+
+        Returns
+        -------
+        AvgTrial
+            The averaged trial.
+        """
+        if self.spills:
+            data = {
+                var_type: {
+                    var: self._spilled_data(var_type, var)
+                    for var in self._spilled[var_type]
+                }
+                for var_type in self._spilled
+            }
+            avgdata_model, stddata_model, _ = average_model_data(
+                data['model'],
+                reject_zeros=False,  # already done
+                reject_outliers=self.reject_outliers,
+                use_medians=self.use_medians,
+            )
+            avgdata_emg, stddata_emg, _ = average_analog_data(
+                data['emg'],
+                reject_outliers=self.reject_outliers,
+                use_medians=self.use_medians,
+            )
+        else:
+            avgdata_model, stddata_model = dict(), dict()
+            avgdata_emg, stddata_emg = dict(), dict()
+            for var_type, avgdata, stddata in [
+                ('model', avgdata_model, stddata_model),
+                ('emg', avgdata_emg, stddata_emg),
+            ]:
+                for var, (n, mean, m2) in self._moments[var_type].items():
+                    avgdata[var] = mean.copy()
+                    stddata[var] = np.sqrt(m2 / n)
+        return AvgTrial(
+            avgdata_model=avgdata_model,
+            stddata_model=stddata_model,
+            avgdata_emg=avgdata_emg,
+            stddata_emg=stddata_emg,
+            sessionpath=sessionpath,
+            nfiles=self.nfiles,
+        )
+
+    def close(self):
+        """Remove the on-disk buffers"""
+        if self._spill_dir is not None:
+            self._cleanup()
+            self._spilled = {'model': dict(), 'emg': dict()}
+
+
+class CycleTensor:
+    """Cycle-normalized curves of several variables, in columnar form.
+
+    The curves of each variable are stored as a single (n_curves x T) array.
+    Each curve belongs to a gait cycle. The cycles are stored in a table that
+    is shared by all the variables; the metadata of the cycles (see COLUMNS)
+    is available as columns of the table, one ndarray per column.
+
+    Parameters
+    ----------
+    data : dict
+        The curves. Keys are variable names and values are (n_curves x T)
+        ndarrays.
+    cycle_ids : dict
+        For each variable, a (n_curves,) ndarray of indices into the cycle
+        table.
+    cycles : list
+        The cycle table. Items are Gaitcycle instances, or None for static
+        trials.
+    trial_ids : ndarray
+        For each cycle in the table, the index of its trial in trials.
+    trials : list
+        The Trial instances.
+    """
+
+    # metadata columns of the cycle table. Missing values (e.g. plate index for
+    # cycles that are not on forceplate, or all values for static trials) are
+    # -1 for integer columns and '' for context.
+    COLUMNS = [
+        'trial_id',
+        'context',
+        'cycle_index',
+        'toeoffn',
+        'on_forceplate',
+        'plate_idx',
+    ]
+
+    def __init__(self, data, cycle_ids, cycles, trial_ids, trials):
+        self.data = data
+        self.cycle_ids = cycle_ids
+        self.cycles = cycles
+        self.trials = trials
+        # the columns are computed when needed, since on_forceplate
+        # may trigger forceplate event detection for the trials
+        self._columns = {'trial_id': np.asarray(trial_ids, dtype=int)}
+
+    def __repr__(self):
+        s = '<CycleTensor |'
+        s += ' variables: %d,' % len(self.data)
+        s += ' cycles: %d,' % len(self.cycles)
+        s += ' trials: %d' % len(self.trials)
+        s += '>'
+        return s
+
+    @property
+    def varnames(self):
+        """Names of the variables that have curves"""
+        return list(self.data.keys())
+
+    def column(self, name):
+        """Return a metadata column of the cycle table.
+
+        Parameters
+        ----------
+        name : str
+            The column name, one of CycleTensor.COLUMNS.
+
+        Returns
+        -------
+        ndarray
+            The column, with one value for each cycle in the table.
+        """
+        if name not in self.COLUMNS:
+            raise ValueError('Invalid column %s' % name)
+        if name not in self._columns:
+            if name == 'context':
+                vals = [cyc.context if cyc else '' for cyc in self.cycles]
+                col = np.array(vals, dtype='U1')
+            elif name == 'on_forceplate':
+                vals = [bool(cyc and cyc.on_forceplate) for cyc in self.cycles]
+                col = np.array(vals, dtype=bool)
+            else:
+                attr = {'cycle_index': 'index'}.get(name, name)
+                vals = [getattr(cyc, attr) if cyc else None for cyc in self.cycles]
+                vals = [-1 if val is None else val for val in vals]
+                col = np.array(vals, dtype=int)
+            self._columns[name] = col
+        return self._columns[name]
+
+    def meta(self, var):
+        """Return the metadata for the curves of a variable.
+
+        Parameters
+        ----------
+        var : str
+            The variable name.
+
+        Returns
+        -------
+        dict
+            The metadata columns (see CycleTensor.COLUMNS), with one value for
+            each curve of the variable.
+        """
+        ids = self.cycle_ids[var]
+        return {name: self.column(name)[ids] for name in self.COLUMNS}
+
+    def filter(self, mask=None, **conditions):
+        """Select curves by the metadata of their cycles.
+
+        Parameters
+        ----------
+        mask : ndarray | None
+            A boolean mask over the cycle table.
+        **conditions
+            Column values to select, e.g. context='R' or on_forceplate=True.
+            A list of values selects any of them.
+
+        Returns
+        -------
+        CycleTensor
+            The selected curves. It shares the cycle table with this
+            instance. Variables without any selected curves are omitted.
+        """
+        keep = np.ones(len(self.cycles), dtype=bool)
+        if mask is not None:
+            keep &= mask
+        for name, val in conditions.items():
+            col = self.column(name)
+            if isinstance(val, (list, tuple, set)):
+                keep &= np.isin(col, list(val))
+            else:
+                keep &= col == val
+        data = dict()
+        cycle_ids = dict()
+        for var, ids in self.cycle_ids.items():
+            rows = keep[ids]
+            if rows.any():
+                data[var] = self.data[var][rows]
+                cycle_ids[var] = ids[rows]
+        trial_ids = self.column('trial_id')
+        ct = CycleTensor(data, cycle_ids, self.cycles, trial_ids, self.trials)
+        ct._columns = self._columns  # the table is the same
+        return ct
+
+    def groupby(self, name):
+        """Group the curves by the values of a metadata column.
+
+        Parameters
+        ----------
+        name : str
+            The column name.
+
+        Returns
+        -------
+        dict
+            Keys are the column values and values are CycleTensor instances
+            (see filter()).
+        """
+        col = self.column(name)
+        used = np.zeros(len(self.cycles), dtype=bool)
+        for ids in self.cycle_ids.values():
+            used[ids] = True
+        return {val.item(): self.filter(**{name: val}) for val in np.unique(col[used])}
+
+    def to_dicts(self):
+        """Convert into the dict output of collect_trial_data().
+
+        Returns
+        -------
+        tuple
+            Tuple of (data, cycles) dicts for the variable type. See
+            collect_trial_data() for details.
+        """
+        data = defaultdict(lambda: None)
+        data.update(self.data)
+        cycles = defaultdict(list)
+        for var, ids in self.cycle_ids.items():
+            cycles[var] = [self.cycles[k] for k in ids]
+        return data, cycles
+
+
+class _CycleTensorBuilder:
+    """Accumulates curves for a CycleTensor.
+
+    The curves are collected into chunks, which are concatenated only once.
+    """
+
+    def __init__(self):
+        self._chunks = defaultdict(list)
+        self._ids = defaultdict(list)
+
+    def add(self, var, data, cycle_ids):
+        """Add (n_curves x T) data for var"""
+        self._chunks[var].append(data)
+        self._ids[var].append(cycle_ids)
+
+    def build(self, cycles, trial_ids, trials):
+        data = {var: np.concatenate(chunks) for var, chunks in self._chunks.items()}
+        cycle_ids = {var: np.concatenate(ids) for var, ids in self._ids.items()}
+        return CycleTensor(data, cycle_ids, cycles, trial_ids, trials)
+
+
+def collect_cycle_tensors(
+    trials,
+    collect_types=None,
+    fp_cycles_only=None,
+    analog_len=None,
+    analog_envelope=None,
+):
+    """Read model and analog cycle-normalized data from trials.
+
+    Like collect_trial_data(), but returns the data as CycleTensor instances.
+    For the parameters, see collect_trial_data().
+
+    Returns
+    -------
+    dict | None
+        Keys are the collected variable types ('model', 'emg') and values are
+        CycleTensor instances. All of them share the same cycle table. None if
+        no trials were given.
+    """
+    if fp_cycles_only is None:
+        fp_cycles_only = False
+
+    if collect_types is None:
+        collect_types = ['model', 'emg']
+
+    if analog_len is None:
+        analog_len = 1000  # reasonable default for analog data (?)
+
+    if analog_envelope is None:
+        analog_envelope = True
+
+    if not trials:
+        return None
+
+    if not isinstance(trials, list):
+        trials = [trials]
+
+    models_to_collect = models.models_all if 'model' in collect_types else list()
+    if 'emg' in collect_types:
+        emg_chs_to_collect = cfg.emg.channel_labels.keys()
+    else:
+        emg_chs_to_collect = list()
+    builders = {
+        type_: _CycleTensorBuilder()
+        for type_ in ['model', 'emg']
+        if type_ in collect_types
+    }
+
+    # create Trial instances in case we got filenames as args
+    inds = [k for k, trial in enumerate(trials) if not isinstance(trial, Trial)]
+    if inds:
+        trials = trials[:]
+        for k, trial in zip(inds, load_trials([trials[k] for k in inds])):
+            trials[k] = trial
+
+    # the cycle table
+    cycles_all = list()
+    trial_ids = list()
+
+    trial_types = list()
+    for trial_id, trial in enumerate(trials):
+        logger.info('collecting data for %s' % trial.trialname)
+        trial_types.append(trial.is_static)
+        if any(trial_types) and not all(trial_types):
+            raise GaitDataError('Cannot mix dynamic and static trials')
+
+        cycles = [None] if trial.is_static else trial.cycles
+        ids = np.arange(len(cycles_all), len(cycles_all) + len(cycles))
+        cycles_all.extend(cycles)
+        trial_ids.extend([trial_id] * len(cycles))
+
+        # collect model data
+        for model in models_to_collect:
+            for context in [None] if trial.is_static else ['R', 'L']:
+                if trial.is_static:
+                    # static data is not normalized
+                    vars_ = list(model.varnames)
+                    datas = np.array([[trial.get_model_data(var)[1] for var in vars_]])
+                    cyc_inds = np.array([0])
+                    ok = np.ones((1, len(vars_)), dtype=bool)
+                else:
+                    # pick data only if var context matches cycle context
+                    # FIXME: should implement context() for models
+                    # (and a filter for context?)
+                    vars_ = [var for var in model.varnames if var[0] == context]
+                    cyc_inds = np.array(
+                        [k for k, cyc in enumerate(cycles) if cyc.context == context],
+                        dtype=int,
+                    )
+                    if not vars_ or not len(cyc_inds):
+                        continue
+                    # normalize all vars to all cycles at once
+                    datas = trial.normalize_all(vars_, [cycles[k] for k in cyc_inds])
+                    # don't collect kinetics if cycle is not on forceplate
+                    needs_fp = np.array(
+                        [model.is_kinetic_var(var) or fp_cycles_only for var in vars_],
+                        dtype=bool,
+                    )
+                    if needs_fp.any():
+                        on_fp = np.array(
+                            [cycles[k].on_forceplate for k in cyc_inds], dtype=bool
+                        )
+                    else:  # avoid resolving the forceplate info
+                        on_fp = np.ones(len(cyc_inds), dtype=bool)
+                    ok = ~(needs_fp[None, :] & ~on_fp[:, None])
+                nodata = np.all(np.isnan(datas), axis=2)
+                for j, var in enumerate(vars_):
+                    if nodata[ok[:, j], j].any():
+                        logger.debug('no data for %s/%s' % (trial.trialname, var))
+                    rows = ok[:, j] & ~nodata[:, j]
+                    if rows.any():
+                        cycle_ids = ids[cyc_inds[rows]]
+                        builders['model'].add(var, datas[rows, j, :], cycle_ids)
+
+        # collect EMG data; all cycles of a channel are resampled at once
+        for ch in emg_chs_to_collect:
+            # check whether cycle matches channel context
+            cyc_inds = [
+                k
+                for k, cycle in enumerate(cycles)
+                if trial.is_static or trial.emg.context_ok(ch, cycle.context)
+            ]
+            if not cyc_inds:
+                continue
+            # get data on analog sampling grid
+            try:
+                logger.debug('collecting EMG channel %s from %s' % (ch, trial))
+                data = trial.emg.get_channel_data(ch, envelope=analog_envelope)
+            except (KeyError, GaitDataError):
+                logger.warning('no channel %s for %s' % (ch, trial))
+                continue
+            if trial.is_static:
+                segments = [(0, len(data))]
+            else:
+                segments = [(cycles[k].start_smp, cycles[k].end_smp) for k in cyc_inds]
+            # resample to requested grid
+            data_cycs = numutils.resample_segments(data, segments, analog_len)
+            builders['emg'].add(ch, data_cycs, ids[cyc_inds])
+    logger.info('collected %d trials' % len(trials))
+    return {
+        type_: builder.build(cycles_all, trial_ids, trials)
+        for type_, builder in builders.items()
+    }
+
+
 def collect_trial_data(
     trials,
     collect_types=None,
@@ -350,7 +990,9 @@ def collect_trial_data(
         will always be collected from forceplate cycles only.
     analog_len : int
         Analog data length varies by gait cycle, so it will be resampled into
-        grid length specified by analog_len (default 1000 samples)
+        grid length specified by analog_len (default 1000 samples). The
+        resampling method is set by cfg.emg.cycle_resample_method (see
+        numutils.resample_segments).
     analog_envelope : bool
         Whether to compute envelope of analog data or return raw data. By
         default the data will be enveloped.
@@ -375,106 +1017,156 @@ def collect_trial_data(
         create a list of toeoff frames for each curve:
         [cyc.toeoffn for cyc in cycles_all['model']['LKneeAnglesX']]
     """
-
+    tensors = collect_cycle_tensors(
+        trials,
+        collect_types=collect_types,
+        fp_cycles_only=fp_cycles_only,
+        analog_len=analog_len,
+        analog_envelope=analog_envelope,
+    )
+    if tensors is None:
+        return None, None
     data_all = dict()
     cycles_all = dict()
+    for type_, tensor in tensors.items():
+        data_all[type_], cycles_all[type_] = tensor.to_dicts()
+    return data_all, cycles_all
 
-    if fp_cycles_only is None:
-        fp_cycles_only = False
-
-    if collect_types is None:
-        collect_types = ['model', 'emg']
 
-    if analog_len is None:
-        analog_len = 1000  # reasonable default for analog data (?)
+_EXTRACT_PHASES = ['overall', 'stance', 'swing']
 
-    if analog_envelope is None:
-        analog_envelope = True
-
-    if not trials:
-        return None, None
-
-    if not isinstance(trials, list):
-        trials = [trials]
+_EXTRACT_FIELDS = (
+    [('contact', np.float64), ('toeoff', np.float64)]
+    + [
+        ('extrema_%s_%s' % (phase, valtype), dtype)
+        for phase in _EXTRACT_PHASES
+        for valtype, dtype in [
+            ('min', np.float64),
+            ('argmin', np.int64),
+            ('max', np.float64),
+            ('argmax', np.int64),
+        ]
+    ]
+    + [
+        # peak indices are float, since nan marks a missing peak
+        ('peaks_%s_%s' % (phase, valtype), np.float64)
+        for phase in _EXTRACT_PHASES
+        for valtype in ['min', 'argmin', 'max', 'argmax']
+    ]
+)
+
+
+def _phase_masks(n_curves, npts, toeoffs):
+    """Boolean (n_curves x npts) masks for each gait phase"""
+    stance = np.arange(npts)[None, :] < toeoffs[:, None]
+    return {
+        'overall': np.ones((n_curves, npts), dtype=bool),
+        'stance': stance,
+        'swing': ~stance,
+    }
+
+
+def _local_maxima(curves):
+    """Find local maxima of all curves.
+
+    Returns (is_peak, right) arrays of shape (N x T). is_peak is True at the
+    left edge of each peak (a flat peak spans several samples), and right gives
+    the right edge of the flat run of values starting at each sample. The peaks
+    match those of scipy.signal.find_peaks(); the peak index is the middle of
+    the flat run, i.e. (left + right) // 2.
+    """
+    npts = curves.shape[1]
+    rising = np.zeros(curves.shape, dtype=bool)
+    rising[:, 1:] = curves[:, :-1] < curves[:, 1:]
+    falling = np.zeros(curves.shape, dtype=bool)
+    falling[:, :-1] = curves[:, 1:] < curves[:, :-1]
+    # right edges of runs of equal values
+    run_end = np.ones(curves.shape, dtype=bool)
+    run_end[:, :-1] = curves[:, 1:] != curves[:, :-1]
+    right = np.where(run_end, np.arange(npts), npts)
+    right = np.minimum.accumulate(right[:, ::-1], axis=1)[:, ::-1]
+    is_peak = rising & np.take_along_axis(falling, right, axis=1)
+    return is_peak, right
+
+
+def _select_peaks(curves, is_peak, right, lo, hi):
+    """Find the largest peak of each curve within sample range lo..hi.
+
+    lo and hi are (N,) arrays of inclusive phase limits. The whole flat peak
+    must be inside the phase, excluding its end samples. Returns (inds, vals)
+    with nan for curves without peaks.
+    """
+    npts = curves.shape[1]
+    left = np.arange(npts)[None, :]
+    ok = is_peak & (left > lo[:, None]) & (right < hi[:, None])
+    vals = np.where(ok, curves, -np.inf)
+    best = vals.argmax(axis=1)
+    rows = np.arange(len(curves))
+    found = ok[rows, best]
+    inds = np.where(found, (best + right[rows, best]) // 2, np.nan)
+    return inds, np.where(found, curves[rows, best], np.nan)
 
-    if 'model' in collect_types:
-        data_all['model'] = defaultdict(lambda: None)
-        cycles_all['model'] = defaultdict(list)
-        models_to_collect = models.models_all
-    else:
-        models_to_collect = list()
 
-    if 'emg' in collect_types:
-        data_all['emg'] = defaultdict(lambda: None)
-        cycles_all['emg'] = defaultdict(list)
-        emg_chs_to_collect = cfg.emg.channel_labels.keys()
-    else:
-        emg_chs_to_collect = list()
+def curve_extract_table(curves, toeoffs):
+    """Extract values from gait curves into a table.
 
-    trial_types = list()
-    for trial_ in trials:
-        # create Trial instance in case we got filenames as args
-        trial = trial_ if isinstance(trial_, Trial) else Trial(trial_)
-        logger.info('collecting data for %s' % trial.trialname)
-        trial_types.append(trial.is_static)
-        if any(trial_types) and not all(trial_types):
-            raise GaitDataError('Cannot mix dynamic and static trials')
+    Vectorized version of curve_extract_values(): all curves are processed at
+    once.
 
-        cycles = [None] if trial.is_static else trial.cycles
+    Parameters
+    ----------
+    curves : ndarray
+        NxT array of gait curves. Typically T==101 for normalized data.
+    toeoffs : ndarray
+        Length N array of toeoff frame indices, one for each curve.
 
-        for cycle in cycles:
-
-            # collect model data
-            for model in models_to_collect:
-                for var in model.varnames:
-                    if not trial.is_static:
-                        # pick data only if var context matches cycle context
-                        # FIXME: should implement context() for models
-                        # (and a filter for context?)
-                        if var[0] != cycle.context:
-                            continue
-                        # don't collect kinetics if cycle is not on forceplate
-                        if (
-                            model.is_kinetic_var(var) or fp_cycles_only
-                        ) and not cycle.on_forceplate:
-                            continue
-                    _, data = trial.get_model_data(var, cycle=cycle)
-                    if np.all(np.isnan(data)):
-                        logger.debug('no data for %s/%s' % (trial.trialname, var))
-                    else:
-                        cycles_all['model'][var].append(cycle)
-                        if var not in data_all['model']:
-                            data_all['model'][var] = data[None, :]
-                        else:
-                            data_all['model'][var] = np.concatenate(
-                                [data_all['model'][var], data[None, :]]
-                            )
-
-            # collect EMG data
-            for ch in emg_chs_to_collect:
-                # check whether cycle matches channel context
-                if not trial.is_static and not trial.emg.context_ok(ch, cycle.context):
-                    continue
-                # get data on analog sampling grid
-                try:
-                    logger.debug('collecting EMG channel %s from %s' % (ch, cycle))
-                    _, data = trial.get_emg_data(
-                        ch, cycle=cycle, envelope=analog_envelope
-                    )
-                except (KeyError, GaitDataError):
-                    logger.warning('no channel %s for %s' % (ch, trial))
-                    continue
-                # resample to requested grid
-                data_cyc = scipy.signal.resample(data, analog_len)
-                cycles_all['emg'][ch].append(cycle)
-                if ch not in data_all['emg']:
-                    data_all['emg'][ch] = data_cyc[None, :]
-                else:
-                    data_all['emg'][ch] = np.concatenate(
-                        [data_all['emg'][ch], data_cyc[None, :]]
-                    )
-    logger.info('collected %d trials' % len(trials))
-    return data_all, cycles_all
+    Returns
+    -------
+    ndarray
+        Structured array of N records. The fields are 'contact', 'toeoff',
+        and names of the form 'extrema_swing_max' or 'peaks_stance_argmin',
+        corresponding to the keys in the output of curve_extract_values().
+        Missing peaks are marked with nan.
+    """
+    curves = np.asarray(curves, dtype=np.float64)
+    toeoffs = np.asarray(toeoffs, dtype=int)
+    if curves.ndim != 2 or curves.shape[0] != toeoffs.shape[0]:
+        raise ValueError('invalid shape of arguments')
+    n_curves, npts = curves.shape
+    if ((toeoffs < 1) | (toeoffs >= npts)).any():
+        raise ValueError('toeoff frames must be inside the curves')
+    rows = np.arange(n_curves)
+    res = np.empty(n_curves, dtype=_EXTRACT_FIELDS)
+    res['contact'] = curves[:, 0]
+    res['toeoff'] = curves[rows, toeoffs]
+    # simple extrema; nans propagate into the values as in np.min etc.
+    for phase, mask in _phase_masks(n_curves, npts, toeoffs).items():
+        for valtype, fill, func in [
+            ('min', np.inf, np.argmin),
+            ('max', -np.inf, np.argmax),
+        ]:
+            inds = func(np.where(mask, curves, fill), axis=1)
+            has_nan = np.isnan(curves) & mask
+            nan_ind = has_nan.argmax(axis=1)
+            nans = has_nan.any(axis=1)
+            inds = np.where(nans, nan_ind, inds)
+            res['extrema_%s_arg%s' % (phase, valtype)] = inds
+            res['extrema_%s_%s' % (phase, valtype)] = np.where(
+                nans, np.nan, curves[rows, inds]
+            )
+    # peaks (local extrema)
+    limits = {
+        'overall': (np.zeros(n_curves, dtype=int), np.full(n_curves, npts - 1)),
+        'stance': (np.zeros(n_curves, dtype=int), toeoffs - 1),
+        'swing': (toeoffs, np.full(n_curves, npts - 1)),
+    }
+    for valtype, sign in [('max', 1), ('min', -1)]:
+        is_peak, right = _local_maxima(sign * curves)
+        for phase, (lo, hi) in limits.items():
+            inds, vals = _select_peaks(sign * curves, is_peak, right, lo, hi)
+            res['peaks_%s_arg%s' % (phase, valtype)] = inds
+            res['peaks_%s_%s' % (phase, valtype)] = sign * vals
+    return res
 
 
 def curve_extract_values(curves, toeoffs):
@@ -483,6 +1175,7 @@ def curve_extract_values(curves, toeoffs):
     This extracts values such as swing phase maximum from a set of gait curves.
     The curves are input as ndarrays, returned by e.g. collect_trial_data().
     Data with any nans will result in (at least partially) nan output values.
+    This is a nested dict view of the output of curve_extract_table().
 
     Parameters
     ----------
@@ -507,76 +1200,244 @@ def curve_extract_values(curves, toeoffs):
     Thus, to get maximum peak values at swing phase, use
     results['peaks']['swing']['max'].
     """
-
-    if isinstance(curves, list):
-        curves = np.array(curves)
-    if isinstance(toeoffs, list):
-        toeoffs = np.array(toeoffs)
-    if curves.shape[0] != toeoffs.shape[0]:
-        raise ValueError('invalid shape of arguments')
+    table = curve_extract_table(curves, toeoffs)
     # use defaultdict to reduct dict initialization boilerplate
     results = defaultdict(lambda: defaultdict(lambda: defaultdict(list)))
-    results['contact'] = list()
-    results['toeoff'] = list()
-
-    for curve, toeoff in zip(curves, toeoffs):
-
-        # extract stance and swing phases; swing phase begins at the toeoff frame
-        curve_stance, curve_swing = np.split(curve, [toeoff])
-
-        # get the simple extrema
-        results['extrema']['overall']['min'].append(curve.min())
-        results['extrema']['overall']['argmin'].append(curve.argmin())
-        results['extrema']['overall']['max'].append(curve.max())
-        results['extrema']['overall']['argmax'].append(curve.argmax())
-
-        results['extrema']['stance']['min'].append(curve_stance.min())
-        results['extrema']['stance']['argmin'].append(curve_stance.argmin())
-        results['extrema']['stance']['max'].append(curve_stance.max())
-        results['extrema']['stance']['argmax'].append(curve_stance.argmax())
-
-        # swing phase indices need to be offset by the toeff frame
-        results['extrema']['swing']['min'].append(curve_swing.min())
-        results['extrema']['swing']['argmin'].append(curve_swing.argmin() + toeoff)
-        results['extrema']['swing']['max'].append(curve_swing.max())
-        results['extrema']['swing']['argmax'].append(curve_swing.argmax() + toeoff)
-
-        # get the peaks (local extrema)
-        ind, val = _get_local_min(curve)
-        results['peaks']['overall']['argmin'].append(ind)
-        results['peaks']['overall']['min'].append(val)
-        ind, val = _get_local_max(curve)
-        results['peaks']['overall']['argmax'].append(ind)
-        results['peaks']['overall']['max'].append(val)
-
-        ind, val = _get_local_min(curve_stance)
-        results['peaks']['stance']['argmin'].append(ind)
-        results['peaks']['stance']['min'].append(val)
-        ind, val = _get_local_max(curve_stance)
-        results['peaks']['stance']['argmax'].append(ind)
-        results['peaks']['stance']['max'].append(val)
-
-        ind, val = _get_local_min(curve_swing)
-        results['peaks']['swing']['argmin'].append(ind + toeoff)
-        results['peaks']['swing']['min'].append(val)
-        ind, val = _get_local_max(curve_swing)
-        results['peaks']['swing']['argmax'].append(ind + toeoff)
-        results['peaks']['swing']['max'].append(val)
-
-        # get some single values
-        results['contact'].append(curve[0])
-        results['toeoff'].append(curve[toeoff])
-
-        # if needed, we can finally return a regular dict
-        # results = dict(results)
-        # for k in 'extrema', 'peaks':
-        #     results[k] = dict(results[k])
-        #     for x, v in results[k].items():
-        #         results[k][x] = dict(v)
-
+    results['contact'] = list(table['contact'])
+    results['toeoff'] = list(table['toeoff'])
+    for field in table.dtype.names[2:]:
+        kind, phase, valtype = field.split('_')
+        col = list(table[field])
+        if kind == 'peaks' and valtype.startswith('arg'):
+            # peak indices are ints, or nan for missing peaks
+            col = [np.nan if np.isnan(ind) else int(ind) for ind in col]
+        results[kind][phase][valtype] = col
     return results
 
 
+def _tstats(labels, X, sums, sumsqs):
+    """Two-sample t statistics for a batch of label vectors.
+
+    labels is a (B x N) float matrix of group A membership (0/1) and X the
+    (N x T) data. sums and sumsqs are the column sums of X and X**2. Returns
+    the (B x T) pooled-variance t statistics.
+    """
+    n_a = labels[0].sum()
+    n_b = X.shape[0] - n_a
+    sum_a = labels @ X
+    sumsq_a = labels @ (X * X)
+    sum_b = sums - sum_a
+    sumsq_b = sumsqs - sumsq_a
+    mean_a, mean_b = sum_a / n_a, sum_b / n_b
+    ss = sumsq_a - sum_a * mean_a + sumsq_b - sum_b * mean_b
+    var_pooled = np.maximum(ss, 0) / (n_a + n_b - 2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = (mean_a - mean_b) / np.sqrt(var_pooled * (1 / n_a + 1 / n_b))
+    return np.nan_to_num(t, nan=0.0, posinf=0.0, neginf=0.0)
+
+
+def _cluster_masses(t, threshold):
+    """Mass (sum of |t|) of the largest supra-threshold cluster for each row.
+
+    Clusters are runs of consecutive samples where t > threshold, or where
+    t < -threshold. Also returns the (B x T) array of running cluster masses,
+    which is nonzero inside the clusters.
+    """
+    npts = t.shape[1]
+    idx = np.arange(npts)
+    run_mass = np.zeros(t.shape)
+    for supra in [t > threshold, t < -threshold]:
+        cum = np.cumsum(np.where(supra, np.abs(t), 0), axis=1)
+        # cumulative sum at the last sample before the current run
+        last_break = np.maximum.accumulate(np.where(supra, -1, idx), axis=1)
+        cum_break = np.where(
+            last_break >= 0, np.take_along_axis(cum, np.maximum(last_break, 0), 1), 0
+        )
+        run_mass += np.where(supra, cum - cum_break, 0)
+    return run_mass.max(axis=1), run_mass
+
+
+def _perm_max_masses(X, n_a, threshold, batches):
+    """Max cluster masses for batches of random permutations (worker function).
+
+    batches is a list of (n_perm, seed) tuples.
+    """
+    n = X.shape[0]
+    sums, sumsqs = X.sum(axis=0), (X * X).sum(axis=0)
+    max_masses = list()
+    for n_perm, seed in batches:
+        rng = np.random.default_rng(seed)
+        # random label matrix; first n_a of each permuted order are group A
+        order = rng.random((n_perm, n)).argsort(axis=1)
+        labels = np.zeros((n_perm, n))
+        np.put_along_axis(labels, order[:, :n_a], 1.0, axis=1)
+        t = _tstats(labels, X, sums, sumsqs)
+        max_masses.append(_cluster_masses(t, threshold)[0])
+    return np.concatenate(max_masses)
+
+
+def compare_curves(
+    data_a,
+    data_b,
+    n_perm=None,
+    alpha=None,
+    threshold=None,
+    batch_size=None,
+    workers=None,
+    seed=None,
+):
+    """Compare two groups of gait curves with a cluster permutation test.
+
+    Computes pointwise two-sample t statistics between the groups, and finds
+    clusters of consecutive samples where the statistic exceeds a threshold.
+    The significance of each cluster is assessed by comparing its mass (sum of
+    |t| over the cluster) against the distribution of the maximum cluster mass
+    over random permutations of the group labels. The permutations are
+    processed in batches, with the statistics computed for a whole batch by
+    matrix operations.
+
+    Parameters
+    ----------
+    data_a : ndarray | dict
+        The curves for group A, as an (N_a x T) array. Can also be a dict of
+        such arrays keyed by variable (e.g. collect_trial_data() output), in
+        which case all variables with data in both groups are compared.
+    data_b : ndarray | dict
+        The curves for group B, in the same format.
+    n_perm : int
+        Number of permutations. Default is 1000.
+    alpha : float
+        Significance level for the clusters. Default is 0.05.
+    threshold : float | None
+        The cluster forming threshold for |t|. If None, it is set to the
+        two-tailed critical t value at alpha.
+    batch_size : int | None
+        Number of permutations per batch; memory use is proportional to
+        batch_size * (N_a + N_b + T). Default is 500.
+    workers : int | None
+        Number of worker processes for the permutations. If None or 1, the
+        permutations are done in the calling process.
+    seed : int | None
+        Seed for the random number generator. The results do not depend on
+        the number of workers.
+
+    Returns
+    -------
+    dict
+        The results, with keys:
+            't' : the t statistics, shape (T,)
+            'threshold' : the cluster forming threshold
+            'clusters' : list of (start, end) sample indices of the clusters
+            (end is exclusive)
+            'cluster_mass' : the cluster masses
+            'cluster_p' : the cluster P values
+            'significant' : bool array of shape (T,), True for samples in
+            clusters with P < alpha
+            'null_max_mass' : the max cluster masses of the permutations
+        If the data was given as dicts, a dict of such results is returned,
+        keyed by variable.
+    """
+    if n_perm is None:
+        n_perm = 1000
+    if alpha is None:
+        alpha = 0.05
+    if batch_size is None:
+        batch_size = 500
+    if isinstance(data_a, dict):
+        vars_ = [
+            var
+            for var, vardata in data_a.items()
+            if vardata is not None and data_b.get(var) is not None
+        ]
+        if not isinstance(seed, np.random.SeedSequence):
+            seed = np.random.SeedSequence(seed)
+        return {
+            var: compare_curves(
+                data_a[var],
+                data_b[var],
+                n_perm=n_perm,
+                alpha=alpha,
+                threshold=threshold,
+                batch_size=batch_size,
+                workers=workers,
+                seed=var_ss,
+            )
+            for var, var_ss in zip(vars_, seed.spawn(len(vars_)))
+        }
+    data_a = np.asarray(data_a, dtype=np.float64)
+    data_b = np.asarray(data_b, dtype=np.float64)
+    if data_a.ndim != 2 or data_b.ndim != 2 or data_a.shape[1] != data_b.shape[1]:
+        raise ValueError('invalid shape of arguments')
+    # curves with nans cannot be used
+    rows_a, rows_b = ~np.isnan(data_a).any(axis=1), ~np.isnan(data_b).any(axis=1)
+    if not (rows_a.all() and rows_b.all()):
+        logger.warning(
+            'ignoring %d curves with nan values' % (np.sum(~rows_a) + np.sum(~rows_b))
+        )
+        data_a, data_b = data_a[rows_a], data_b[rows_b]
+    n_a, n_b = len(data_a), len(data_b)
+    if n_a < 2 or n_b < 2:
+        raise GaitDataError('Need at least 2 curves in each group')
+    if threshold is None:
+        threshold = scipy.stats.t.ppf(1 - alpha / 2, n_a + n_b - 2)
+    # centering does not change the statistics, but improves accuracy
+    X = np.concatenate([data_a, data_b])
+    X -= X.mean(axis=0)
+    labels = np.zeros((1, n_a + n_b))
+    labels[0, :n_a] = 1
+    t = _tstats(labels, X, X.sum(axis=0), (X * X).sum(axis=0))
+    _, run_mass = _cluster_masses(t, threshold)
+    run_mass = run_mass[0]
+    t = t[0]
+    # permutations, in batches with their own seeds
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+    sizes = [batch_size] * (n_perm // batch_size)
+    if n_perm % batch_size:
+        sizes.append(n_perm % batch_size)
+    batches = list(zip(sizes, seed.spawn(len(sizes))))
+    workers = min(workers or 1, len(batches))
+    if workers > 1:
+        bounds = np.linspace(0, len(batches), workers + 1).astype(int)
+        chunks = [batches[lo:hi] for lo, hi in zip(bounds[:-1], bounds[1:])]
+        with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+            futures = [
+                executor.submit(_perm_max_masses, X, n_a, threshold, chunk)
+                for chunk in chunks
+            ]
+            results = [fut.result() for fut in futures]
+    else:
+        results = [_perm_max_masses(X, n_a, threshold, batches)]
+    null_max_mass = np.concatenate(results)
+    # find the observed clusters
+    inside = run_mass > 0
+    edges = np.diff(np.r_[0, inside.astype(int), 0])
+    starts, ends = np.where(edges == 1)[0], np.where(edges == -1)[0]
+    # a sign change splits a cluster
+    clusters = list()
+    for start, end in zip(starts, ends):
+        splits = np.where(np.diff(np.sign(t[start:end])) != 0)[0] + start + 1
+        bounds = np.r_[start, splits, end]
+        clusters.extend(zip(bounds[:-1], bounds[1:]))
+    masses = np.array([run_mass[end - 1] for start, end in clusters])
+    pvals = np.array(
+        [(1 + np.sum(null_max_mass >= mass)) / (1 + n_perm) for mass in masses]
+    )
+    significant = np.zeros(len(t), dtype=bool)
+    for (start, end), p in zip(clusters, pvals):
+        if p < alpha:
+            significant[start:end] = True
+    return {
+        't': t,
+        'threshold': threshold,
+        'clusters': [(int(start), int(end)) for start, end in clusters],
+        'cluster_mass': masses,
+        'cluster_p': pvals,
+        'significant': significant,
+        'null_max_mass': null_max_mass,
+    }
+
+
 def _trials_extract_values(trials, from_models=None):
     """Extract curve values from given trials.
 
@@ -6,12 +6,13 @@ Time-distance computations
 @author: Jussi (jnu@iki.fi)
 """
 
+import copy
 import logging
 import numpy as np
 from collections import defaultdict
 
 from .envutils import GaitDataError
-from . import c3d
+from . import read_data, trialcache
 
 logger = logging.getLogger(__name__)
 
@@ -83,17 +84,20 @@ def _group_analysis_trials(trials):
     """Multitrial analysis from given trials (.c3d files).
     trials: dict of lists keyed by condition name
     If there are multiple trials per condition, they will be averaged.
+    The values are computed from events and marker data (see trials_analysis()).
     """
     res_avg_all = dict()  # preserve condition ordering
     res_std_all = dict()  # for plots etc.
+    # compute the values for all conditions in a single batch
+    c3dfiles = [c3dfile for cond_files in trials.values() for c3dfile in cond_files]
+    ans_all = trials_analysis(c3dfiles, on_error='skip')
+    ans_files = dict(zip(c3dfiles, ans_all))
     for cond_label, cond_files in trials.items():
-        ans = list()
-        for c3dfile in cond_files:
-            try:
-                an = c3d.get_analysis(c3dfile, condition=cond_label)
-                ans.append(an)
-            except GaitDataError:
-                logger.warning('no analysis values found in %s' % c3dfile)
+        ans = [
+            _condition_dict(ans_files[c3dfile]['unknown'], cond_label)
+            for c3dfile in cond_files
+            if ans_files[c3dfile] is not None
+        ]
         if ans:
             res_avg = group_analysis(ans)
             res_std = group_analysis(ans, fun=np.std)
@@ -127,3 +131,271 @@ def _pick_common_vars(values, vars_wanted=None):
         vars_ = list(vars_common)
     units = [vals_1[var]['unit'] for var in vars_]
     return conds, vars_, units
+
+
+# markers (without context) for the length and width parameters
+_LENGTH_MARKER = 'HEE'
+_WIDTH_MARKER = 'TOE'
+
+# trial cache subkind for the computed analysis values; bump the version when
+# the computation changes, so that stale cached values are not used
+_CACHE_SUBKIND = 'timedist_v1'
+# time-distance variables computed from events and markers, with their units
+_analysis_units = {
+    'Cadence': 'steps/min',
+    'Walking Speed': 'm/s',
+    'Stride Time': 's',
+    'Step Time': 's',
+    'Stride Length': 'm',
+    'Step Length': 'm',
+    'Step Width': 'm',
+    'Foot Off': '%',
+    'Opposite Foot Off': '%',
+    'Opposite Foot Contact': '%',
+    'Single Support': 's',
+    'Double Support': 's',
+}
+
+
+def _first_events(events, starts, ends):
+    """Return the first of events after each start and before the
+    corresponding end; NaN if there is none"""
+    events = np.asarray(events, dtype=float)
+    inds = np.searchsorted(events, starts, side='right')
+    first = np.append(events, np.nan)[inds]
+    return np.where(first < ends, first, np.nan)
+
+
+def _marker_pos(mkrdata, marker, frames):
+    """Return marker positions at given frames; NaN for missing frames, gaps
+    and missing markers"""
+    pos = np.full((len(frames), 3), np.nan)
+    if marker not in mkrdata:
+        return pos
+    data = mkrdata[marker]
+    ok = (frames >= 0) & (frames < len(data))
+    pos[ok] = data[frames[ok].astype(int)]
+    pos[~np.any(pos, axis=1)] = np.nan  # gaps are all zeros
+    return pos
+
+
+def _trial_cycles(events, mkrdata, framerate):
+    """Collect the gait cycles of a trial.
+
+    events is a TrialEvents instance, with frames relative to the start of the
+    marker data. Returns a dict of cycle tables keyed by context ('R', 'L').
+    Each table is a dict of per-cycle arrays of event frames (NaN if the event
+    is missing from the cycle) and marker positions at the events.
+    """
+    cycles = dict()
+    for context, context_co in [('R', 'L'), ('L', 'R')]:
+        strikes = np.array(getattr(events, context.lower() + 'strikes'), dtype=float)
+        strikes_co = getattr(events, context_co.lower() + 'strikes')
+        toeoffs = getattr(events, context.lower() + 'toeoffs')
+        toeoffs_co = getattr(events, context_co.lower() + 'toeoffs')
+        starts, ends = strikes[:-1], strikes[1:]
+        opp_contact = _first_events(strikes_co, starts, ends)
+        # step width uses the next contralateral contact even if it falls
+        # after the end of the cycle, as in the old step width computation
+        width_contact = _first_events(strikes_co, starts, np.inf)
+        cycles[context] = {
+            'start': starts,
+            'end': ends,
+            'foot_off': _first_events(toeoffs, starts, ends),
+            'opp_foot_off': _first_events(toeoffs_co, starts, ends),
+            'opp_contact': opp_contact,
+            'rate': np.full(len(starts), float(framerate)),
+        }
+        for key, marker, opp in [
+            ('len', _LENGTH_MARKER, opp_contact),
+            ('width', _WIDTH_MARKER, width_contact),
+        ]:
+            cycles[context].update(
+                {
+                    '%s_start' % key: _marker_pos(mkrdata, context + marker, starts),
+                    '%s_end' % key: _marker_pos(mkrdata, context + marker, ends),
+                    '%s_opp' % key: _marker_pos(mkrdata, context_co + marker, opp),
+                }
+            )
+    return cycles
+
+
+def _compute_cycles(cycles):
+    """Compute the time-distance values for a table of cycles.
+
+    Returns a dict of per-cycle values keyed by variable. Values that cannot be
+    computed due to missing events or marker data are NaN. For the definitions,
+    see:
+    https://www.vicon.com/faqs/software/how-does-nexus-plug-in-gait-and-polygon-calculate-gait-cycle-parameters-spatial-and-temporal
+    """
+    start, end, rate = cycles['start'], cycles['end'], cycles['rate']
+    foot_off, opp_foot_off = cycles['foot_off'], cycles['opp_foot_off']
+    opp_contact = cycles['opp_contact']
+    stride_frames = end - start
+    stride_time = stride_frames / rate
+    with np.errstate(divide='ignore', invalid='ignore'):
+        stride_vec = cycles['len_end'] - cycles['len_start']
+        stride_len = np.linalg.norm(stride_vec, axis=1)
+        # step length is measured along the ipsilateral stride
+        stride_dir = stride_vec / stride_len[:, None]
+        step_len = np.sum((cycles['len_end'] - cycles['len_opp']) * stride_dir, axis=1)
+        # step width is the distance of the contralateral marker from the
+        # ipsilateral 'step line'
+        line = cycles['width_end'] - cycles['width_start']
+        line /= np.linalg.norm(line, axis=1)[:, None]
+        vc = cycles['width_opp'] - cycles['width_start']
+        vsw = line * np.sum(vc * line, axis=1)[:, None] - vc
+        # marker data is in mm, but return lengths in m
+        return {
+            'Cadence': 2 * 60 / stride_time,
+            'Walking Speed': stride_len / 1000 / stride_time,
+            'Stride Time': stride_time,
+            'Step Time': (end - opp_contact) / rate,
+            'Stride Length': stride_len / 1000,
+            'Step Length': step_len / 1000,
+            'Step Width': np.linalg.norm(vsw, axis=1) / 1000,
+            'Foot Off': 100 * (foot_off - start) / stride_frames,
+            'Opposite Foot Off': 100 * (opp_foot_off - start) / stride_frames,
+            'Opposite Foot Contact': 100 * (opp_contact - start) / stride_frames,
+            'Single Support': (opp_contact - opp_foot_off) / rate,
+            'Double Support': (opp_foot_off - start + foot_off - opp_contact) / rate,
+        }
+
+
+def _compute_trials(trials_cycles):
+    """Compute time-distance variables for a batch of trials.
+
+    trials_cycles is a list of the outputs of _trial_cycles(). The cycles of
+    all trials are computed at once, and then averaged per trial and context.
+    Returns a list of analysis dicts (without the condition key).
+    """
+    tables = [cycles[context] for cycles in trials_cycles for context in ('R', 'L')]
+    if not tables:
+        return list()
+    groups = np.concatenate(
+        [np.full(len(table['start']), k) for k, table in enumerate(tables)]
+    )
+    cycles_all = {key: np.concatenate([t[key] for t in tables]) for key in tables[0]}
+    values = _compute_cycles(cycles_all)
+    ans = [dict() for _ in trials_cycles]
+    for var, vals in values.items():
+        ok = ~np.isnan(vals)
+        sums = np.bincount(groups[ok], weights=vals[ok], minlength=len(tables))
+        counts = np.bincount(groups[ok], minlength=len(tables))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            means = (sums / counts).reshape(-1, 2)
+        for an, (val_r, val_l) in zip(ans, means):
+            an[var] = {
+                'unit': _analysis_units[var],
+                'Right': float(val_r),
+                'Left': float(val_l),
+            }
+    return ans
+
+
+def _condition_dict(an, condition):
+    """Wrap an analysis dict under a condition key, as in get_analysis()"""
+    di = defaultdict(lambda: defaultdict(dict))
+    di[condition].update(copy.deepcopy(an))
+    return di
+
+
+def _read_trial_data(source):
+    """Read the events, marker data and frame rate needed for the
+    time-distance computations"""
+    meta = read_data.get_metadata(source)
+    events = meta['events']
+    events.subtract_offset(meta['offset'])
+    markers = [
+        context + marker
+        for context in ('R', 'L')
+        for marker in (_LENGTH_MARKER, _WIDTH_MARKER)
+    ]
+    mkrdata = read_data.get_marker_data(source, markers, ignore_missing=True)
+    return events, mkrdata, meta['framerate']
+
+
+def analysis_from_events(events, mkrdata, framerate, condition='unknown'):
+    """Compute time-distance variables from gait events and marker data.
+
+    The variables are computed for each gait cycle and averaged over the
+    cycles of each context. This does not need the analysis values written by
+    Nexus.
+
+    Parameters
+    ----------
+    events : TrialEvents
+        The gait events. The frames must be relative to the start of the marker
+        data (see Trial.events).
+    mkrdata : dict | MarkerSet
+        The marker data. The heel and toe markers are used for the spatial
+        variables. If they are missing, the spatial variables will be NaN.
+    framerate : float
+        The frame rate of the marker data.
+    condition : str, optional
+        The condition name, by default 'unknown'.
+
+    Returns
+    -------
+    dict
+        A nested dict of the analysis values, keyed by variable name and
+        context, as returned by read_data.get_analysis(). The first key is the
+        condition name. Values that cannot be computed are NaN.
+    """
+    an = _compute_trials([_trial_cycles(events, mkrdata, framerate)])[0]
+    return _condition_dict(an, condition)
+
+
+def trials_analysis(sources, condition='unknown', on_error='raise'):
+    """Compute time-distance variables for a list of trials.
+
+    The variables are computed from the events and marker data of the trials
+    (see analysis_from_events()), for all trials in a single batch. The results
+    are cached per trial in the persistent trial cache, if it is enabled.
+
+    Parameters
+    ----------
+    sources : list
+        List of sources (c3d filenames or SourceContext instances).
+    condition : str, optional
+        The condition name, by default 'unknown'.
+    on_error : str
+        What to do when a trial cannot be read. If 'raise', raise a
+        GaitDataError listing the errors for each failed trial. If 'skip', the
+        error is logged and None is returned for the trial.
+
+    Returns
+    -------
+    list
+        The analysis dicts (see analysis_from_events()), in the same order as
+        sources.
+    """
+    if on_error not in ('raise', 'skip'):
+        raise ValueError('Invalid on_error: %s' % on_error)
+    sources = list(sources)
+    ans = [None] * len(sources)
+    errors = dict()
+    # read the trials that are not cached
+    trials_cycles = dict()
+    for k, source in enumerate(sources):
+        try:
+            ans[k] = trialcache.load(
+                read_data._raw_source(source), 'analysis', subkind=_CACHE_SUBKIND
+            )
+            if ans[k] is None:
+                trials_cycles[k] = _trial_cycles(*_read_trial_data(source))
+        except (GaitDataError, OSError) as e:
+            errors[k] = e
+    # compute them in a single batch
+    for k, an in zip(trials_cycles, _compute_trials(list(trials_cycles.values()))):
+        fn = read_data._raw_source(sources[k])
+        trialcache.store(fn, 'analysis', an, subkind=_CACHE_SUBKIND)
+        ans[k] = an
+    for k, e in errors.items():
+        logger.warning(
+            'cannot compute time-distance variables for %s: %s' % (sources[k], e)
+        )
+    if errors and on_error == 'raise':
+        msg = '\n'.join('%s: %s' % (sources[k], e) for k, e in sorted(errors.items()))
+        raise GaitDataError('Could not compute time-distance variables:\n%s' % msg)
+    return [an if an is None else _condition_dict(an, condition) for an in ans]
@@ -9,16 +9,20 @@ Read gait trials.
 
 
 from collections import defaultdict
+import concurrent.futures
 import numpy as np
 import re
+import os
 import os.path as op
 import logging
 
 from .emg import EMG
 from .config import cfg
-from .envutils import GaitDataError
+from .envutils import GaitDataError, _to_bytes, _from_bytes
 from . import (
     read_data,
+    c3d,
+    trialcache,
     nexus,
     utils,
     eclipse,
@@ -62,6 +66,252 @@ def nexus_trial(from_c3d=False):
         return Trial(nexus.viconnexus())
 
 
+def load_trials(sources, workers=None, backend=None, signals=None, on_error='raise'):
+    """Create Trial instances for several sources, reading the data in parallel.
+
+    With the 'process' backend, the c3d files are parsed in worker processes.
+    If the persistent trial cache is enabled (cfg.cache.use_trial_cache), the
+    workers store the data into the cache (see trialcache.py) and the Trial
+    instances are then created in the calling process from the cached arrays.
+    Otherwise, the workers create the trials, read their data and send them
+    back serialized by Trial.to_bytes(). With the 'thread' backend, the Trial
+    instances are created directly in a thread pool. Nexus sources are always
+    read serially in the calling thread.
+
+    Parameters
+    ----------
+    sources : list
+        List of sources (c3d filenames or ViconNexus instances).
+    workers : int | None
+        Number of workers. If None, taken from cfg.trial.load_workers. If that
+        is None too, the number of CPUs is used.
+    backend : str | None
+        'process' or 'thread'. If None, taken from cfg.trial.load_backend.
+    signals : ProgressSignals | None
+        Instance of ProgressSignals, used to send progress updates across
+        threads and track cancel flag.
+    on_error : str
+        What to do when a trial cannot be loaded. If 'raise', raise a
+        GaitDataError listing the errors for each failed file. If 'skip', the
+        error is logged and None is returned in place of the trial.
+
+    Returns
+    -------
+    list | None
+        The Trial instances, in the same order as sources. None if the
+        operation was canceled via signals.
+    """
+    if workers is None:
+        workers = cfg.trial.load_workers or os.cpu_count() or 1
+    if backend is None:
+        backend = cfg.trial.load_backend
+    if backend not in ('process', 'thread'):
+        raise ValueError('Invalid backend: %s' % backend)
+    if on_error not in ('raise', 'skip'):
+        raise ValueError('Invalid on_error: %s' % on_error)
+    # whether the workers preload the data into the trial cache
+    preload = backend == 'process' and trialcache._enabled()
+    sources = list(sources)
+    c3d_inds = [k for k, source in enumerate(sources) if c3d._is_c3d_file(source)]
+    # files to be read in the pool
+    if preload:
+        pool_inds = [k for k in c3d_inds if not _is_preloaded(sources[k])]
+    else:
+        pool_inds = c3d_inds
+    workers = min(workers, len(pool_inds))
+    trials = [None] * len(sources)
+    errors = dict()
+    # preloading and creating the trials are counted as separate steps for
+    # progress reporting
+    nsteps = len(sources)
+    if workers > 1 and preload:
+        nsteps += len(pool_inds)
+    ndone = 0
+
+    def _progress(source):
+        if signals is not None:
+            signals.progress.emit(
+                'Loading: %s' % op.split(str(source))[-1], int(100 * ndone / nsteps)
+            )
+
+    if workers > 1:
+        if backend == 'process':
+            executor = concurrent.futures.ProcessPoolExecutor(
+                workers, initializer=_init_load_worker, initargs=(_cfg_values(),)
+            )
+            job = _preload_trial if preload else _load_trial_bytes
+        else:
+            executor = concurrent.futures.ThreadPoolExecutor(workers)
+            job = Trial
+        with executor:
+            futures = {executor.submit(job, sources[k]): k for k in pool_inds}
+            for future in concurrent.futures.as_completed(futures):
+                k = futures[future]
+                if signals is not None and signals.canceled:
+                    for future_ in futures:
+                        future_.cancel()
+                    return None
+                try:
+                    result = future.result()
+                except Exception as e:
+                    errors[k] = e
+                    if preload:  # no trial will be created
+                        ndone += 1
+                else:
+                    if backend == 'thread':
+                        trials[k] = result
+                    elif not preload:
+                        trials[k] = Trial.from_bytes(result)
+                ndone += 1
+                _progress(sources[k])
+    # whatever was not created in the pool is created serially here
+    for k, source in enumerate(sources):
+        if trials[k] is not None or k in errors:
+            continue
+        if signals is not None and signals.canceled:
+            return None
+        try:
+            trials[k] = Trial(source)
+        except Exception as e:
+            errors[k] = e
+        ndone += 1
+        _progress(source)
+    for k, e in errors.items():
+        logger.warning('cannot load %s: %s' % (sources[k], e))
+    if errors and on_error == 'raise':
+        msg = '\n'.join('%s: %s' % (sources[k], e) for k, e in sorted(errors.items()))
+        raise GaitDataError('Could not load trials:\n%s' % msg)
+    return trials
+
+
+def _cfg_values():
+    """Return config values as a picklable nested dict"""
+    return {
+        secname: {name: item.value for name, item in sec}
+        for secname, sec in cfg
+        if secname != 'layouts'  # not needed for reading data
+    }
+
+
+def _init_load_worker(cfg_values):
+    """Initialize a worker process for load_trials()"""
+    for secname, items in cfg_values.items():
+        sec = getattr(cfg, secname)
+        for name, value in items.items():
+            setattr(sec, name, value)
+
+
+def _run_in_pool(job, items, workers, signals=None, desc=None):
+    """Run job(*args) for each args tuple in items, in a process pool.
+
+    The worker processes get the current config (see _init_load_worker). With a
+    single worker, the jobs are run serially in the calling process. If signals
+    (ProgressSignals) is given, progress is emitted as each job finishes,
+    labeled by desc and the first argument of the job, and the remaining jobs
+    are canceled when the cancel flag is set.
+
+    Returns a list of the results in the order of items (None for failed jobs)
+    and a dict of the exceptions of the failed jobs, keyed by item index.
+    Returns None if canceled.
+    """
+    items = list(items)
+    results = [None] * len(items)
+    errors = dict()
+    workers = min(workers, len(items))
+
+    def _progress(ndone, k):
+        if signals is not None:
+            signals.progress.emit(
+                '%s: %s' % (desc, op.split(str(items[k][0]))[-1]),
+                int(100 * ndone / len(items)),
+            )
+
+    if workers > 1:
+        executor = concurrent.futures.ProcessPoolExecutor(
+            workers, initializer=_init_load_worker, initargs=(_cfg_values(),)
+        )
+        with executor:
+            futures = {executor.submit(job, *args): k for k, args in enumerate(items)}
+            for ndone, future in enumerate(concurrent.futures.as_completed(futures)):
+                if signals is not None and signals.canceled:
+                    for future_ in futures:
+                        future_.cancel()
+                    return None
+                k = futures[future]
+                try:
+                    results[k] = future.result()
+                except Exception as e:
+                    errors[k] = e
+                _progress(ndone + 1, k)
+    else:
+        for k, args in enumerate(items):
+            if signals is not None and signals.canceled:
+                return None
+            try:
+                results[k] = job(*args)
+            except Exception as e:
+                errors[k] = e
+            _progress(k + 1, k)
+    return results, errors
+
+
+def _check_errors(errors, on_error, desc):
+    """Log errors of a batch operation, given as a dict keyed by source. If
+    on_error is 'raise', raise a GaitDataError listing them"""
+    for source, e in errors.items():
+        logger.warning('%s: %s: %s' % (desc, source, e))
+    if errors and on_error == 'raise':
+        msg = '\n'.join('%s: %s' % (source, e) for source, e in errors.items())
+        raise GaitDataError('%s:\n%s' % (desc, msg))
+
+
+def _preload_trial(source):
+    """Read trial data into the persistent trial cache (worker function)"""
+    logger.debug('preloading %s' % source)
+    meta = read_data.get_metadata(source)
+    read_data.get_marker_data(source, meta['markers'], ignore_missing=True)
+    for reader in [
+        read_data.get_emg_data,
+        read_data.get_accelerometer_data,
+        read_data.get_forceplate_data,
+    ]:
+        try:
+            reader(source)
+        except GaitDataError:  # the error is cached too
+            pass
+    for model in models.models_all:
+        try:
+            read_data.get_model_data(source, model)
+        except GaitDataError:
+            pass
+
+
+def _load_trial_bytes(source):
+    """Create a trial, read its data and return it serialized (worker
+    function)"""
+    logger.debug('loading %s' % source)
+    trial = Trial(source)
+    trial._full_marker_data
+    trial.fp_events
+    try:
+        trial.emg.data
+    except GaitDataError:
+        pass
+    for model in models.models_all:
+        try:
+            trial._models_data[model.desc] = read_data.get_model_data(trial.ctx, model)
+        except GaitDataError:
+            pass
+    return trial.to_bytes()
+
+
+def _is_preloaded(source):
+    """Whether the data read by _preload_trial() is in the trial cache"""
+    kinds = [(kind, None) for kind in ['metadata', 'markers', 'emg', 'forceplate']]
+    kinds += [('model', model.desc) for model in models.models_all]
+    return all(trialcache.is_cached(source, *kind) for kind in kinds)
+
+
 class Noncycle:
     """Used in place of Gaitcycle when requesting unnormalized data.
 
@@ -99,16 +349,19 @@ class Gaitcycle:
         Frame where toeoff occurs.
     context : str
         Cycle context: R or L for right and left, respectively.
-    on_forceplate : bool
-        Whether cycle starts on forceplate contact.
-    plate_idx : int
-        Index of forceplate.
+    on_forceplate : bool | None
+        Whether cycle starts on forceplate contact. If None, this is resolved
+        from the trial forceplate events when first needed.
+    plate_idx : int | None
+        Index of forceplate. Resolved along with on_forceplate, if that is
+        None.
     smp_per_frame : float
         Analog samples per frame.
     trial : instance of Trial
         The trial instance owning this cycle. Does not need to be set.
     name : str
-        Name for the cycle. Can be set freely.
+        Name for the cycle. Can be set freely. If None, a default name is
+        created from the context and index (e.g. 'right1 (f)').
     index : int
         Cycle index.
     """
@@ -133,24 +386,43 @@ class Gaitcycle:
         self.toeoff = toeoff
         # which foot begins and ends the cycle
         self.context = context
-        # whether cycle begins with forceplate strike
-        self.on_forceplate = on_forceplate
+        # whether cycle begins with forceplate strike; None until resolved
+        self._on_forceplate = on_forceplate
+        self._plate_idx = plate_idx
         # start and end on the analog samples axis; round to whole samples
         self.start_smp = int(round(self.start * smp_per_frame))
         self.end_smp = int(round(self.end * smp_per_frame))
         self.len_smp = self.end_smp - self.start_smp
+        self._set_time_axes()
+        # normalize toe-off event to the cycle
+        self.toeoffn = int(round(100 * ((self.toeoff - self.start) / self.len)))
+        self.trial = trial
+        self.index = index
+        self._name = name
+
+    def _set_time_axes(self):
+        """Create the normalized time axes"""
         # normalized x-axis (% of gait cycle) of same length as cycle
         self.t = np.linspace(0, 100, self.len)
         # same for analog variables
         self.tn_analog = np.linspace(0, 100, self.len_smp)
         # normalized x-axis of 0,1,2..100%
         self.tn = np.linspace(0, 100, 101)
-        # normalize toe-off event to the cycle
-        self.toeoffn = int(round(100 * ((self.toeoff - self.start) / self.len)))
-        self.trial = trial
-        self.plate_idx = plate_idx
-        self.index = index
-        self.name = name
+        self._interp_op = None  # created when needed
+
+    def __getstate__(self):
+        """Return the state for pickling.
+
+        The time axes are not stored, since they are recreated on unpickling.
+        """
+        state = self.__dict__.copy()
+        for attr in ['t', 'tn_analog', 'tn', '_interp_op']:
+            state.pop(attr, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._set_time_axes()
 
     def __repr__(self):
         s = '<Gaitcycle |'
@@ -162,6 +434,50 @@ class Gaitcycle:
         s += '>'
         return s
 
+    def _resolve_forceplate(self):
+        """Match the cycle start with the trial forceplate events"""
+        if self.trial is None:
+            self._on_forceplate, self._plate_idx = False, None
+        else:
+            self._on_forceplate, self._plate_idx = self.trial._match_fp_strike(
+                self.context, self.start
+            )
+
+    @property
+    def on_forceplate(self):
+        """Whether cycle begins with a forceplate strike"""
+        if self._on_forceplate is None:
+            self._resolve_forceplate()
+        return self._on_forceplate
+
+    @on_forceplate.setter
+    def on_forceplate(self, on_forceplate):
+        self._on_forceplate = on_forceplate
+
+    @property
+    def plate_idx(self):
+        """Index of the forceplate where the cycle begins, or None"""
+        if self._on_forceplate is None:
+            self._resolve_forceplate()
+        return self._plate_idx
+
+    @plate_idx.setter
+    def plate_idx(self, plate_idx):
+        self._plate_idx = plate_idx
+
+    @property
+    def name(self):
+        """Name of the cycle"""
+        if self._name is None and self.index is not None:
+            sidestr = {'R': 'right', 'L': 'left'}[self.context]
+            fp_str = ' (f)' if self.on_forceplate else ''
+            return '%s%d%s' % (sidestr, self.index, fp_str)
+        return self._name
+
+    @name.setter
+    def name(self, name):
+        self._name = name
+
     def normalize(self, var):
         """Normalize (columns of) frames-based variable var to the cycle.
 
@@ -176,18 +492,38 @@ class Gaitcycle:
             A tuple of (tn, ndata) where tn is the normalized time (0..100%) and ndata
             is the normalized data.
         """
-        # convert 1D arrays to 2D
-        if len(var.shape) == 1:
-            var = var[:, np.newaxis]
-        ncols = var.shape[1]
-        idata = np.array(
-            [
-                np.interp(self.tn, self.t, var[self.start : self.end, k])
-                for k in range(ncols)
-            ]
-        ).T
+        idata = self._interpolate(var[self.start : self.end])
         return self.tn, np.squeeze(idata)
 
+    @property
+    def _interp_operator(self):
+        """The linear interpolation operator from cycle frames to tn.
+
+        The operator is a (101 x len) matrix with at most two nonzero elements
+        per row. It is stored in banded form as a tuple of (lo, hi, w), where
+        row i of the normalized data is (1 - w[i]) * data[lo[i]] + w[i] *
+        data[hi[i]]. It is computed once per cycle.
+        """
+        if self._interp_op is None:
+            t = self.t
+            hi = np.searchsorted(t, self.tn, side='right').clip(1, len(t) - 1)
+            lo = hi - 1
+            w = (self.tn - t[lo]) / (t[hi] - t[lo])
+            # at the grid points, use a single frame only, so that nans in the
+            # neighbouring frames do not propagate (as with np.interp)
+            at_hi = w >= 1
+            lo[at_hi] = hi[at_hi]
+            w[at_hi] = 0
+            hi[w == 0] = lo[w == 0]
+            self._interp_op = lo, hi, w
+        return self._interp_op
+
+    def _interpolate(self, data):
+        """Interpolate cycle data (frames on the first axis) to tn"""
+        lo, hi, w = self._interp_operator
+        w = w.reshape((-1,) + (1,) * (data.ndim - 1))
+        return data[lo] * (1 - w) + data[hi] * w
+
     def crop_analog(self, var):
         """Crop analog variable (EMG, forceplate, etc. ) to the gait cycle.
 
@@ -204,9 +540,15 @@ class Trial:
 
     Parameters
     ----------
-    source : str | instance of ViconNexus
+    source : str | instance of ViconNexus | SourceContext
         Source to read data from. Can be a c3d filename or a ViconNexus
-        connection.
+        connection. A read_data.SourceContext can be given to share the reads
+        with other users of the same source.
+    detect_fp_events : str | None
+        When to detect forceplate events: 'lazy' (when first needed), 'eager'
+        (on trial creation) or 'never'. If 'never', no cycles will be
+        considered to start on a forceplate. If None, taken from
+        cfg.trial.detect_fp_events.
 
     Attributes
     ----------
@@ -234,6 +576,10 @@ class Trial:
     events : TrialEvents
         Trial events (foot strikes, toeoffs etc.). These events are read from
         the trial data (i.e. not autodetected).
+    fp_events : dict
+        Forceplate events (see utils.detect_forceplate_events).
+    ctx : SourceContext
+        The context that all data reads go through.
     """
 
     def __repr__(self):
@@ -245,10 +591,18 @@ class Trial:
         s += '>'
         return s
 
-    def __init__(self, source):
-        logger.debug('new trial instance from %s' % source)
-        self.source = source
-        meta = read_data.get_metadata(source)
+    def __init__(self, source, detect_fp_events=None):
+        logger.debug('new trial instance from %s' % read_data._raw_source(source))
+        if detect_fp_events is None:
+            detect_fp_events = cfg.trial.detect_fp_events
+        if detect_fp_events not in ('lazy', 'eager', 'never'):
+            raise ValueError('Invalid detect_fp_events: %s' % detect_fp_events)
+        if isinstance(source, read_data.SourceContext):
+            self.ctx = source
+        else:
+            self.ctx = read_data.SourceContext(source)
+        self.source = self.ctx.source
+        meta = read_data.get_metadata(self.ctx)
         # insert metadata dict directly as instance attributes (those are
         # documented above)
         self.__dict__.update(meta)
@@ -278,16 +632,17 @@ class Trial:
         self._handle_quirks()
         # data are lazily read
         self.emg = EMG(
-            self.source,
+            self.ctx,
             correction_factor=self.emg_correction_factor,
             chs_disabled=self.emg_chs_disabled,
         )
         self._forceplate_data = None
         self._marker_data = None
-        if not self.is_static:
-            self.fp_events = self._get_fp_events()
-        else:
-            self.fp_events = utils._empty_fp_events()
+        self._fp_events = None  # lazily detected
+        if self.is_static or detect_fp_events == 'never':
+            self._fp_events = utils._empty_fp_events()
+        elif detect_fp_events == 'eager':
+            self._fp_events = self._get_fp_events()
         self._models_data = dict()
         self.stddev_data = None  # AvgTrial only
         # frames 0...length
@@ -300,6 +655,60 @@ class Trial:
         self.cycles = list() if self.is_static else list(self._scan_cycles())
         self.ncycles = len(self.cycles)
 
+    def __getstate__(self):
+        """Return the state for pickling.
+
+        The defaultdicts are stored as plain dicts. The data that has already
+        been read is included in the state, but the memoized reads of the
+        source context are not.
+        """
+        state = self.__dict__.copy()
+        for attr in ['eclipse_data', 'subj_params']:
+            if attr in state:
+                state[attr] = dict(state[attr])
+        return state
+
+    def __setstate__(self, state):
+        if 'eclipse_data' in state:
+            state['eclipse_data'] = defaultdict(lambda: '', state['eclipse_data'])
+        if 'subj_params' in state:
+            state['subj_params'] = defaultdict(lambda: None, state['subj_params'])
+        self.__dict__.update(state)
+
+    def to_bytes(self):
+        """Serialize the trial into bytes.
+
+        The arrays are stored as pickle protocol 5 out-of-band buffers, so they
+        are not copied by pickle, and from_bytes() can return them as views
+        into the serialized data. Trials read from Nexus cannot be serialized.
+
+        Returns
+        -------
+        bytes
+            The serialized trial.
+        """
+        return _to_bytes(self)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Create a trial from data serialized by to_bytes().
+
+        Parameters
+        ----------
+        data : bytes | bytearray | memoryview
+            The serialized trial. The arrays of the returned trial are views
+            into data, so it must not be modified afterwards.
+
+        Returns
+        -------
+        Trial
+            The trial.
+        """
+        trial = _from_bytes(data)
+        if not isinstance(trial, cls):
+            raise TypeError('Data does not contain a %s instance' % cls.__name__)
+        return trial
+
     def _handle_quirks(self):
         """Handle session quirks"""
         quirks = sessionutils.load_quirks(self.sessionpath)
@@ -397,6 +806,38 @@ class Trial:
             raise ValueError('invalid type for cycle argument')
         return t, data
 
+    def normalize_all(self, varnames, cycles=None):
+        """Normalize several model variables to several gait cycles at once.
+
+        The interpolation operators of the cycles are applied to a single
+        (frames x variables) block of data, so this is much faster than
+        calling get_model_data() for each variable and cycle.
+
+        Parameters
+        ----------
+        varnames : list
+            Names of model variables (e.g. 'LKneeAnglesX').
+        cycles : list | None
+            List of Gaitcycle instances to normalize to. If None, all cycles of
+            the trial are used.
+
+        Returns
+        -------
+        ndarray
+            An (n_cycles x n_vars x 101) array of the normalized data.
+        """
+        if cycles is None:
+            cycles = self.cycles
+        if not cycles or not varnames:
+            return np.empty((len(cycles), len(varnames), 101))
+        data = np.column_stack([self._get_modelvar(var) for var in varnames])
+        ops = [cycle._interp_operator for cycle in cycles]
+        lo = np.array([cycle.start + op[0] for cycle, op in zip(cycles, ops)])
+        hi = np.array([cycle.start + op[1] for cycle, op in zip(cycles, ops)])
+        w = np.array([op[2] for op in ops])[:, :, None]
+        ndata = data[lo] * (1 - w) + data[hi] * w  # n_cycles x 101 x n_vars
+        return np.ascontiguousarray(ndata.transpose(0, 2, 1))
+
     def normalize_analog_to_cycle(self, data, cycle):
         """Normalize analog data to a gait cycle.
 
@@ -425,7 +866,7 @@ class Trial:
     def _full_marker_data(self):
         """Return the full marker data dict."""
         if self._marker_data is None:
-            self._marker_data = read_data.get_marker_data(self.source, self.markers)
+            self._marker_data = read_data.get_marker_data(self.ctx, self.markers)
         return self._marker_data
 
     def _get_modelvar(self, var):
@@ -435,7 +876,7 @@ class Trial:
             raise ValueError('No model found for %s' % var)
         if model_.desc not in self._models_data:
             # read and cache model data
-            modeldata = read_data.get_model_data(self.source, model_)
+            modeldata = read_data.get_model_data(self.ctx, model_)
             self._models_data[model_.desc] = modeldata
         return self._models_data[model_.desc][var]
 
@@ -520,7 +961,7 @@ class Trial:
             and data is the marker data as a (Nt, 3) ndarray.
         """
         if not self._forceplate_data:
-            self._forceplate_data = read_data.get_forceplate_data(self.source)
+            self._forceplate_data = read_data.get_forceplate_data(self.ctx)
         if nplate < 0 or nplate >= len(self._forceplate_data):
             raise GaitDataError('Invalid plate index %d' % nplate)
         if kind == 'force':
@@ -537,6 +978,41 @@ class Trial:
         """Return accelerometer data."""
         raise NotImplementedError
 
+    @property
+    def fp_events(self):
+        """Forceplate events. Detected when first needed."""
+        if self._fp_events is None:
+            self._fp_events = self._get_fp_events()
+        return self._fp_events
+
+    @fp_events.setter
+    def fp_events(self, fp_events):
+        self._fp_events = fp_events
+        # forceplate info of the cycles needs to be resolved again
+        for cycle in getattr(self, 'cycles', []):
+            cycle.on_forceplate = None
+
+    def _match_fp_strike(self, context, start):
+        """Match a foot strike with the forceplate events.
+
+        A tolerance of STRIKE_TOL frames is used for the matching. Returns a
+        tuple of (on_forceplate, plate_idx).
+        """
+        STRIKE_TOL = 7
+        fp_strikes = np.array(self.fp_events[context + '_strikes'])
+        if fp_strikes.size == 0:
+            return False, None
+        logger.debug(
+            'side %s: cycle start: %d, detected fp events: %s'
+            % (context, start, fp_strikes)
+        )
+        diffs = np.abs(fp_strikes - start)
+        if min(diffs) <= STRIKE_TOL:
+            strike_idx = np.argmin(diffs)
+            return True, self.fp_events[context + '_strikes_plate'][strike_idx]
+        else:
+            return False, None
+
     def _get_fp_events(self):
         """Read the forceplate events."""
         try:
@@ -545,8 +1021,7 @@ class Trial:
                 if cfg.trial.use_eclipse_fp_info and self.use_eclipse_fp_info
                 else None
             )
-            # FIXME: marker data already read?
-            return utils.detect_forceplate_events(self.source, fp_info=fp_info)
+            return utils.detect_forceplate_events(self.ctx, fp_info=fp_info)
         except GaitDataError:
             logger.warning('Could not detect forceplate events')
             return utils._empty_fp_events()
@@ -626,13 +1101,10 @@ class Trial:
     def _scan_cycles(self):
         """Create Gaitcycle instances for this trial.
 
-        Cycle detection is based on trial strike/toeoff markers. To identify
-        cycles starting with forceplate contact, the foot strike markers need to
-        be matched with forceplate events. A tolerance of STRIKE_TOL is used for
-        the matching.
+        Cycle detection is based on trial strike/toeoff markers. The cycles are
+        matched with forceplate events only when needed (see
+        Gaitcycle.on_forceplate).
         """
-        STRIKE_TOL = 7
-        sidestrs = {'R': 'right', 'L': 'left'}
         for strikes in [self.events.lstrikes, self.events.rstrikes]:
             len_s = len(strikes)
             if len_s < 2:
@@ -645,25 +1117,6 @@ class Trial:
                 context = 'R'
             for k in range(0, len_s - 1):
                 start = strikes[k]
-                # see if cycle starts on forceplate strike
-                fp_strikes = np.array(self.fp_events[context + '_strikes'])
-                if fp_strikes.size == 0:
-                    on_forceplate = False
-                    plate_idx = None
-                else:
-                    diffs = np.abs(fp_strikes - start)
-                    on_forceplate = min(diffs) <= STRIKE_TOL
-                    if on_forceplate:
-                        strike_idx = np.argmin(diffs)
-                        plate_idx = self.fp_events[context + '_strikes_plate'][
-                            strike_idx
-                        ]
-                    else:
-                        plate_idx = None
-                    logger.debug(
-                        'side %s: cycle start: %d, '
-                        'detected fp events: %s' % (context, start, fp_strikes)
-                    )
                 end = strikes[k + 1]
                 toeoff = [x for x in toeoffs if x > start and x < end]
                 if len(toeoff) == 0:
@@ -703,17 +1156,14 @@ class Trial:
                         )
                 else:
                     toeoff = toeoff[0]
-                fp_str = ' (f)' if on_forceplate else ''
-                name = '%s%d%s' % (sidestrs[context], (k + 1), fp_str)
                 yield Gaitcycle(
                     start,
                     end,
                     toeoff,
                     context,
-                    on_forceplate,
-                    plate_idx,
+                    None,
+                    None,
                     self.samplesperframe,
                     trial=self,
                     index=k + 1,
-                    name=name,
                 )
@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent on-disk cache of data read from c3d files.
+
+Each c3d file gets a cache directory (by default under a .gaitcache directory
+next to the file). Metadata is stored as JSON. Array data of each kind (markers,
+model outputs, analog data, forceplate data) is stored as a single flat float64
+.npy buffer together with a JSON index that gives the offset and shape of each
+array in the buffer. Buffers are memory-mapped on load, so the returned arrays
+are read-only views into the mapped file.
+
+The cache is keyed by the c3d file fingerprint (path, size, mtime, inode), the
+gaitutils version, the cache format version and a digest of the config items
+that affect the cached data. If the key does not match, the cache directory is
+emptied. Each kind of data is written lazily, when it is first read from the c3d
+file.
+
+NB: do not use directly, this is used transparently via the read_data module.
+
+@author: Jussi (jnu@iki.fi)
+"""
+
+from collections import defaultdict
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+import threading
+
+import numpy as np
+from pkg_resources import get_distribution, DistributionNotFound
+
+from .config import cfg
+from .envutils import _file_fingerprint, GaitDataError
+from .utils import TrialEvents
+
+
+logger = logging.getLogger(__name__)
+
+# increment this when the layout of the cached data changes
+CACHE_FORMAT = 1
+CACHE_DIRNAME = '.gaitcache'
+KEY_FILENAME = 'key.json'
+
+try:
+    _GAITUTILS_VERSION = get_distribution('gaitutils').version
+except DistributionNotFound:
+    _GAITUTILS_VERSION = 'unknown'
+
+# cache dirs validated by this process, keyed by dir; values are the keys
+_validated = dict()
+_lock = threading.Lock()
+
+
+def _enabled():
+    """Whether the trial cache is in use"""
+    return cfg.cache.use_trial_cache
+
+
+def _config_digest():
+    """Digest of the config items that affect the cached data"""
+    items = sorted((name, repr(item.value)) for name, item in cfg.models)
+    return hashlib.md5(repr(items).encode('utf-8')).hexdigest()
+
+
+def _cache_dir(c3dfile):
+    """Return the cache directory for a c3d file"""
+    c3dfile = Path(c3dfile).resolve()
+    if cfg.cache.trial_cache_dir:
+        # a central cache root; use digest of the path to avoid name clashes
+        pathdigest = hashlib.md5(str(c3dfile).encode('utf-8')).hexdigest()
+        return Path(cfg.cache.trial_cache_dir) / ('%s_%s' % (c3dfile.stem, pathdigest))
+    else:
+        return c3dfile.parent / CACHE_DIRNAME / c3dfile.stem
+
+
+def _cache_key(c3dfile):
+    """Return the cache key for a c3d file"""
+    return {
+        'fingerprint': list(_file_fingerprint(c3dfile)),
+        'gaitutils_version': _GAITUTILS_VERSION,
+        'format': CACHE_FORMAT,
+        'config': _config_digest(),
+    }
+
+
+def _write_atomic(fn, writer):
+    """Write a file via a temporary file, so that readers never see a partial
+    file"""
+    fn_temp = fn.with_name(fn.name + '.%d.tmp' % os.getpid())
+    with open(fn_temp, 'wb') as f:
+        writer(f)
+    os.replace(fn_temp, fn)
+
+
+def _json_default(obj):
+    """Serialize numpy types into JSON"""
+    if isinstance(obj, np.generic):
+        return obj.item()
+    elif isinstance(obj, np.ndarray):
+        return obj.tolist()
+    raise TypeError('cannot serialize %s' % type(obj))
+
+
+def _write_json(fn, data):
+    txt = json.dumps(data, default=_json_default)
+    _write_atomic(fn, lambda f: f.write(txt.encode('utf-8')))
+
+
+def _read_json(fn):
+    with open(fn, 'rb') as f:
+        return json.loads(f.read().decode('utf-8'))
+
+
+def _valid_cache_dir(c3dfile, create=False):
+    """Return the cache dir for c3dfile, if it exists and its key is valid.
+
+    If create is True, the directory is created (or emptied, if the key does
+    not match), so that it can be written into. Returns None if there is no
+    valid cache.
+    """
+    cdir = _cache_dir(c3dfile)
+    key = _cache_key(c3dfile)
+    with _lock:
+        if _validated.get(cdir) == key:
+            return cdir
+    keyfile = cdir / KEY_FILENAME
+    try:
+        valid = _read_json(keyfile) == key
+    except (OSError, ValueError):
+        valid = False
+    if not valid:
+        if not create:
+            return None
+        logger.debug('creating trial cache in %s' % cdir)
+        cdir.mkdir(parents=True, exist_ok=True)
+        for fn in cdir.iterdir():
+            fn.unlink()
+        _write_json(keyfile, key)
+    with _lock:
+        _validated[cdir] = key
+    return cdir
+
+
+def _flatten(data, prefix=''):
+    """Flatten nested dicts/lists of arrays into a dict of name -> array.
+
+    List items are named by their index. Names of nested items are joined by
+    slashes.
+    """
+    items = dict()
+    if isinstance(data, dict):
+        children = data.items()
+    else:
+        children = enumerate(data)
+    for name, val in children:
+        name = '%s%s' % (prefix, name)
+        if isinstance(val, (dict, list)):
+            items.update(_flatten(val, prefix=name + '/'))
+        else:
+            items[name] = np.asarray(val, dtype=np.float64)
+    return items
+
+
+def _write_arrays(cdir, kind, arrays):
+    """Write a dict of arrays as a single buffer + index"""
+    index = dict()
+    offset = 0
+    for name, arr in arrays.items():
+        index[name] = [offset, list(arr.shape)]
+        offset += arr.size
+    buf = np.empty(offset, dtype=np.float64)
+    for name, arr in arrays.items():
+        start, _ = index[name]
+        buf[start : start + arr.size] = arr.ravel()
+    _write_atomic(cdir / ('%s.npy' % kind), lambda f: np.save(f, buf))
+    _write_json(cdir / ('%s.json' % kind), {'size': offset, 'index': index})
+
+
+def _read_arrays(cdir, kind):
+    """Read a dict of arrays written by _write_arrays.
+
+    The arrays are read-only views into a memory-mapped buffer.
+    """
+    meta = _read_json(cdir / ('%s.json' % kind))
+    if 'error' in meta:
+        raise GaitDataError(meta['error'])
+    buf = np.load(cdir / ('%s.npy' % kind), mmap_mode='r')
+    if buf.size != meta['size']:
+        raise ValueError('cache buffer size mismatch')
+    return {
+        name: buf[start : start + int(np.prod(shape))].reshape(shape)
+        for name, (start, shape) in meta['index'].items()
+    }
+
+
+def _kind_name(kind, subkind=None):
+    """File name for a kind of data"""
+    if subkind is None:
+        return kind
+    # model names etc. may contain arbitrary characters
+    return '%s_%s' % (kind, hashlib.md5(subkind.encode('utf-8')).hexdigest()[:12])
+
+
+def load(c3dfile, kind, subkind=None):
+    """Load cached data of a given kind.
+
+    Returns None if there is no valid cached data. Raises GaitDataError if the
+    original read raised one (the error is cached as well).
+    """
+    if not _enabled():
+        return None
+    cdir = _valid_cache_dir(c3dfile)
+    if cdir is None:
+        return None
+    kname = _kind_name(kind, subkind)
+    try:
+        if kind in ('metadata', 'analysis'):
+            data = _read_json(cdir / ('%s.json' % kname))
+            if 'error' in data:
+                raise GaitDataError(data['error'])
+            return _decode_metadata(data) if kind == 'metadata' else data
+        else:
+            return _unflatten(kind, _read_arrays(cdir, kname))
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def is_cached(c3dfile, kind, subkind=None):
+    """Whether data of a given kind is in the cache"""
+    if not _enabled():
+        return False
+    cdir = _valid_cache_dir(c3dfile)
+    if cdir is None:
+        return False
+    return (cdir / ('%s.json' % _kind_name(kind, subkind))).is_file()
+
+
+def store(c3dfile, kind, data, subkind=None):
+    """Store data of a given kind into the cache.
+
+    data may be a GaitDataError instance, which is then raised on load.
+    Failure to write the cache is logged, but is not an error.
+    """
+    if not _enabled():
+        return
+    kname = _kind_name(kind, subkind)
+    try:
+        cdir = _valid_cache_dir(c3dfile, create=True)
+        if isinstance(data, GaitDataError):
+            _write_json(cdir / ('%s.json' % kname), {'error': str(data)})
+        elif kind == 'metadata':
+            _write_json(cdir / ('%s.json' % kname), _encode_metadata(data))
+        elif kind == 'analysis':
+            _write_json(cdir / ('%s.json' % kname), data)
+        else:
+            _write_arrays(cdir, kname, _flatten(data))
+    except OSError as e:
+        logger.warning('cannot write trial cache for %s: %s' % (c3dfile, e))
+
+
+def clear(c3dfile):
+    """Remove cached data for a c3d file"""
+    cdir = _cache_dir(c3dfile)
+    with _lock:
+        _validated.pop(cdir, None)
+    if cdir.is_dir():
+        for fn in cdir.iterdir():
+            fn.unlink()
+        cdir.rmdir()
+
+
+def _encode_metadata(meta):
+    """Convert metadata dict into JSON compatible form"""
+    meta = meta.copy()
+    events = meta['events']
+    meta['events'] = {
+        evtype: getattr(events, evtype) for evtype in TrialEvents.event_types
+    }
+    meta['subj_params'] = dict(meta['subj_params'])
+    return meta
+
+
+def _decode_metadata(meta):
+    """Inverse of _encode_metadata()"""
+    meta['events'] = TrialEvents(**meta['events'])
+    subj_params = defaultdict(lambda: None)
+    subj_params.update(meta['subj_params'])
+    meta['subj_params'] = subj_params
+    return meta
+
+
+def _unflatten(kind, arrays):
+    """Rebuild the reader output structure for a kind of data"""
+    if kind == 'forceplate':
+        plates = defaultdict(dict)
+        for name, arr in arrays.items():
+            plate, var = name.split('/')
+            plates[int(plate)][var] = arr
+        return [plates[k] for k in sorted(plates)]
+    elif kind in ('emg', 'accelerometer'):
+        data = {
+            name.split('/', 1)[1]: arr
+            for name, arr in arrays.items()
+            if name.startswith('data/')
+        }
+        return {'t': arrays['t'], 'data': data}
+    else:  # markers and model data are flat dicts
+        return arrays
@@ -6,6 +6,7 @@ Utility functions for processing gait data.
 @author: Jussi (jnu@iki.fi)
 """
 
+from collections.abc import Mapping
 from scipy import signal
 from matplotlib import path
 import matplotlib.pyplot as plt
@@ -14,7 +15,12 @@ import logging
 
 from .envutils import GaitDataError
 from .config import cfg
-from .numutils import rising_zerocross, digitize_array, falling_zerocross, _baseline
+from .numutils import (
+    rising_zerocross,
+    falling_zerocross,
+    _baseline,
+    _rigid_body_extrapolate_markers_batch,
+)
 
 
 logger = logging.getLogger(__name__)
@@ -74,6 +80,133 @@ class TrialEvents:
         self._offset = offset
 
 
+class MarkerSet(Mapping):
+    """Marker data of a trial in a single contiguous array.
+
+    Behaves as a read-only dict of (n_frames x 3) position arrays keyed by
+    marker name, so it can be used in place of the marker data dicts returned
+    by read_data.get_marker_data(). The gap mask and the velocities are
+    computed once and cached.
+
+    Parameters
+    ----------
+    names : list
+        The marker names.
+    data : ndarray
+        The marker positions, shape (n_markers x n_frames x 3). Frames where
+        all coordinates are zero are considered gaps. The data is copied.
+    """
+
+    def __init__(self, names, data):
+        data = np.array(data, dtype=np.float64)
+        if data.ndim != 3 or data.shape[0] != len(names) or data.shape[2] != 3:
+            raise ValueError('data must be of shape (n_markers x n_frames x 3)')
+        data.flags.writeable = False
+        self.names = list(names)
+        self.data = data
+        self._index = {name: k for k, name in enumerate(self.names)}
+        self._gap_mask = None
+        self._interior_gap_mask = None
+        self._velocity = None
+
+    @classmethod
+    def from_dict(cls, mkrdata, markers=None):
+        """Create a MarkerSet from a marker data dict.
+
+        If markers is given, only those markers are included. If mkrdata is
+        already a MarkerSet, it is returned as is.
+        """
+        if isinstance(mkrdata, cls):
+            return mkrdata
+        if markers is None:
+            markers = list(mkrdata.keys())
+        if not markers:
+            raise ValueError('no markers')
+        return cls(markers, np.stack([mkrdata[marker] for marker in markers]))
+
+    def __getitem__(self, marker):
+        return self.data[self._index[marker]]
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __repr__(self):
+        return '<MarkerSet | %d markers, %d frames>' % (len(self), self.n_frames)
+
+    @property
+    def n_frames(self):
+        return self.data.shape[1]
+
+    @property
+    def gap_mask(self):
+        """Boolean gap mask, shape (n_markers x n_frames)"""
+        if self._gap_mask is None:
+            self._gap_mask = ~np.any(self.data, axis=2)
+            self._gap_mask.flags.writeable = False
+        return self._gap_mask
+
+    @property
+    def interior_gap_mask(self):
+        """Gap mask without the leading and trailing gaps.
+
+        For markers that have no data at all, all frames are gaps.
+        """
+        if self._interior_gap_mask is None:
+            valid = ~self.gap_mask
+            first = valid.argmax(axis=1)[:, None]
+            last = self.n_frames - 1 - valid[:, ::-1].argmax(axis=1)[:, None]
+            frames = np.arange(self.n_frames)
+            mask = self.gap_mask & (frames > first) & (frames < last)
+            mask[~valid.any(axis=1)] = True
+            mask.flags.writeable = False
+            self._interior_gap_mask = mask
+        return self._interior_gap_mask
+
+    @property
+    def velocity(self):
+        """Marker velocities (per frame), shape (n_markers x n_frames x 3)"""
+        if self._velocity is None:
+            self._velocity = np.gradient(self.data, axis=1)
+            self._velocity.flags.writeable = False
+        return self._velocity
+
+    def gaps(self, marker, ignore_edge_gaps=True):
+        """Return the indices of gap frames for a marker.
+
+        See marker_gaps().
+        """
+        mask = self.interior_gap_mask if ignore_edge_gaps else self.gap_mask
+        return np.where(mask[self._index[marker]])[0]
+
+    def stack(self, markers):
+        """Return data for given markers, shape (n_markers x n_frames x 3)"""
+        return self.data[[self._index[marker] for marker in markers]]
+
+    def average(self, markers, roi=None, fail_on_gaps=True, velocity=False):
+        """Average marker data over a subset of markers.
+
+        See avg_markerdata() for the parameters.
+        """
+        inds = np.array([self._index[marker] for marker in markers])
+        gaps = self.interior_gap_mask[inds]
+        if roi is not None:
+            gaps = gaps[:, roi[0] : roi[1]]
+        ok = ~gaps.any(axis=1)
+        for marker in [marker for marker, ok_ in zip(markers, ok) if not ok_]:
+            if fail_on_gaps:
+                raise GaitDataError('Averaging data for %s has gaps' % marker)
+            logger.warning(
+                'marker %s cannot be included in average due to gaps' % marker
+            )
+        if not ok.any():
+            raise GaitDataError('all markers have gaps, cannot average')
+        data = self.velocity if velocity else self.data
+        return data[inds[ok]].mean(axis=0)
+
+
 def get_contexts(right_first=False):
     """Return the usual contexts and their names as pairs.
 
@@ -128,47 +261,24 @@ def marker_gaps(mdata, ignore_edge_gaps=True):
 def _step_width(source):
     """Compute step width over trial cycles.
 
-    For details of computation, see:
-    https://www.vicon.com/faqs/software/how-does-nexus-plug-in-gait-and-polygon-calculate-gait-cycle-parameters-spatial-and-temporal
-    Returns context keyed dict of lists.
-    FIXME: marker name into params?
-    FIXME: this (and similar) may also need to take Trial instance as argument
-    to avoid creating new Trials
+    The computation is done by the time-distance engine, see
+    timedist.analysis_from_events(). Returns context keyed dict of arrays.
+    source may also be a Trial instance, whose events and marker data are then
+    used as is, or a SourceContext.
     """
+    from . import timedist
     from .trial import Trial
 
-    tr = Trial(source)
+    if isinstance(source, Trial):
+        events, mkrdata = source.events, source._full_marker_data
+        framerate = source.framerate
+    else:
+        events, mkrdata, framerate = timedist._read_trial_data(source)
+    cycles = timedist._trial_cycles(events, mkrdata, framerate)
     sw = dict()
-    mkr = 'TOE'  # marker name without context
-    mkrdata = tr._full_marker_data
-    # FIXME: why not use cycles here?
-    for context, strikes in zip(['L', 'R'], [tr.events.lstrikes, tr.events.rstrikes]):
-        sw[context] = list()
-        nstrikes = len(strikes)
-        if nstrikes < 2:
-            continue
-        # contralateral vars
-        context_co = 'L' if context == 'R' else 'R'
-        strikes_co = tr.events.lstrikes if context == 'R' else tr.events.rstrikes
-        mname = context + mkr
-        mname_co = context_co + mkr
-        for j, strike in enumerate(strikes):
-            if strike == strikes[-1]:  # last strike on this side
-                break
-            pos_this = mkrdata[mname][strike]
-            pos_next = mkrdata[mname][strikes[j + 1]]
-            strikes_next_co = [k for k in strikes_co if k > strike]
-            if len(strikes_next_co) == 0:  # no subsequent contralateral strike
-                break
-            pos_next_co = mkrdata[mname_co][strikes_next_co[0]]
-            # vector distance between 'step lines' (see url above)
-            V1 = pos_next - pos_this
-            V1 /= np.linalg.norm(V1)
-            VC = pos_next_co - pos_this
-            VCP = V1 * np.dot(VC, V1)  # proj to ipsilateral line
-            VSW = VCP - VC
-            # marker data is in mm, but return step width in m
-            sw[context].append(np.linalg.norm(VSW) / 1000.0)
+    for context, table in cycles.items():
+        sw_ = timedist._compute_cycles(table)['Step Width']
+        sw[context] = sw_[~np.isnan(sw_)]
     return sw
 
 
@@ -177,15 +287,17 @@ def avg_markerdata(mkrdata, markers, roi=None, fail_on_gaps=True, avg_velocity=F
 
     Parameters
     ----------
-    mkrdata : dict
-        The markerdata dict.
+    mkrdata : dict | MarkerSet
+        The markerdata dict. Repeated calls are faster with a MarkerSet,
+        since its gaps and velocities are computed only once.
     markers : list
         Markers to average.
     roi : array-like
         If given, specified a ROI. Gaps outside the ROI will be ignored.
     fail_on_gaps : bool, optional
         If True, raise an exception on ANY gaps. Otherwise, markers with gaps
-        will not be included in the average.
+        will not be included in the average. Leading and trailing gaps are
+        not considered gaps.
     avg_velocity : bool, optional
         If True, return averaged marker velocity data instead of position.
 
@@ -194,32 +306,70 @@ def avg_markerdata(mkrdata, markers, roi=None, fail_on_gaps=True, avg_velocity=F
     ndarray
         The averaged data (Nx3).
     """
-    data_shape = mkrdata[markers[0]].shape
-    mdata_avg = np.zeros(data_shape)
-    if roi is None:
-        roi = [0, data_shape[0]]
-    roi_frames = np.arange(roi[0], roi[1])
-    n_ok = 0
-    for marker in markers:
-        mdata = mkrdata[marker]
-        if avg_velocity:
-            mdata = np.gradient(mdata)[0]
-        gap_frames = marker_gaps(mdata)
-        if np.intersect1d(roi_frames, gap_frames).size > 0:
-            if fail_on_gaps:
-                raise GaitDataError('Averaging data for %s has gaps' % marker)
-            else:
-                logger.warning(
-                    'marker %s cannot be included in average due to gaps' % marker
-                )
-                continue
-        else:
-            mdata_avg += mdata
-            n_ok += 1
-    if n_ok == 0:
-        raise GaitDataError('all markers have gaps, cannot average')
-    else:
-        return mdata_avg / n_ok
+    mkrdata = MarkerSet.from_dict(mkrdata, markers)
+    return mkrdata.average(
+        markers, roi=roi, fail_on_gaps=fail_on_gaps, velocity=avg_velocity
+    )
+
+
+def rigid_body_extrapolate(
+    ref_trial, extrap_trials, ref_markers, extrap_markers, ref_frame=None
+):
+    """Extrapolate missing marker positions from one trial to others.
+
+    This is an offline version of nexus.rigid_body_extrapolate() that reads
+    the data from c3d files (or other sources supported by read_data). The
+    frames of all the extrapolation trials are solved in a single pass. See
+    nexus.rigid_body_extrapolate() for details of the algorithm.
+
+    Parameters
+    ----------
+    ref_trial : str | SourceContext
+        The reference trial. The reference and extrapolated markers must be
+        present in the reference trial, at least at the frame given by
+        ref_frame.
+    extrap_trials : list
+        The trials on which the extrapolation should be performed.
+    ref_markers : list
+        The reference markers to extrapolate from.
+    extrap_markers : list
+        The markers to extrapolate.
+    ref_frame : int or None
+        The reference frame to use from the reference trial. If not given,
+        defaults to 0.
+
+    Returns
+    -------
+    list
+        The extrapolated data for each trial, as dicts keyed by marker. The
+        values are (n_frames x 3) arrays of positions. Frames where any of the
+        reference markers is missing are set to NaN.
+    """
+    from . import read_data
+
+    if ref_frame is None:
+        ref_frame = 0
+    if not isinstance(extrap_trials, list):
+        extrap_trials = [extrap_trials]
+    allmarkers = ref_markers + extrap_markers
+    mdata_ref = read_data.get_marker_data(ref_trial, allmarkers)
+    P0 = np.stack([mdata_ref[marker][ref_frame, :] for marker in allmarkers])
+    if not np.all(np.any(P0, axis=1)):
+        raise GaitDataError('markers missing from reference frame %d' % ref_frame)
+    # stack the reference markers of all trials into a single batch
+    frames = list()
+    for extrap_trial in extrap_trials:
+        mdata = read_data.get_marker_data(extrap_trial, ref_markers)
+        frames.append(np.stack([mdata[marker] for marker in ref_markers], axis=1))
+    Pr = np.concatenate(frames)
+    extrap = _rigid_body_extrapolate_markers_batch(P0, Pr)
+    # gaps are marked by all zero positions
+    extrap[~np.all(np.any(Pr, axis=2), axis=1)] = np.nan
+    splits = np.cumsum([len(fr) for fr in frames])[:-1]
+    return [
+        dict(zip(extrap_markers, np.moveaxis(trial_extrap, 1, 0)))
+        for trial_extrap in np.split(extrap, splits)
+    ]
 
 
 # FIXME: marker sets could be moved into models.py?
@@ -310,6 +460,7 @@ def _get_foot_contact_vel(mkrdata, fp_events, medians=True, roi=None):
     """Return foot velocities during forceplate strike/toeoff frames.
     fp_events is from detect_forceplate_events() If medians=True, return median
     values."""
+    mkrdata = MarkerSet.from_dict(mkrdata)
     results = dict()
     for context, markers in zip(
         ('R', 'L'), [cfg.autoproc.right_foot_markers, cfg.autoproc.left_foot_markers]
@@ -403,9 +554,10 @@ def _get_foot_points(mkrdata, context, footlen=None):
 
 def _leading_foot(mkrdata, roi=None):
     """Determine which foot is leading (ahead in the direction of gait).
-    Returns n-length list of 'R' or 'L' correspondingly (n = number of
+    Returns n-length object array of 'R' or 'L' correspondingly (n = number of
     frames). Gaps are indicated as None. mkrdata must include foot and
     pelvis markers"""
+    mkrdata = MarkerSet.from_dict(mkrdata)
     subj_pos = avg_markerdata(
         mkrdata, cfg.autoproc.track_markers, roi=roi, fail_on_gaps=False
     )
@@ -419,10 +571,9 @@ def _leading_foot(mkrdata, roi=None):
         mkrdata, cfg.autoproc.right_foot_markers, roi=roi, fail_on_gaps=False
     )[:, gait_dim]
     cmpfun = np.greater if gait_dir > 0 else np.less
-    return [
-        None if R == 0.0 or L == 0.0 else ('R' if cmpfun(R, L) else 'L')
-        for R, L in zip(rfoot, lfoot)
-    ]
+    leading = np.where(cmpfun(rfoot, lfoot), 'R', 'L').astype(object)
+    leading[(rfoot == 0.0) | (lfoot == 0.0)] = None
+    return leading
 
 
 def _trial_median_velocity(source, return_curve=False):
@@ -462,12 +613,45 @@ def _point_in_poly(poly, pt):
     return p.contains_point(pt)
 
 
+def _points_in_polys(polys, pts):
+    """Batched point-in-polygon test for convex polygons.
+
+    polys is a (K x V x 3) array of ordered polygon vertices and pts a
+    (K x M x 3) array of points to test against the corresponding polygons.
+    Returns a (K x M) array of booleans. The 3rd dim is ignored. A point is
+    inside if it is on the same side of all the polygon edges.
+    """
+    verts = polys[:, :, :2]
+    edges = np.roll(verts, -1, axis=1) - verts
+    # vertex -> point vectors, (K x M x V x 2)
+    vecs = pts[:, :, None, :2] - verts[:, None, :, :]
+    cross = edges[:, None, :, 0] * vecs[..., 1] - edges[:, None, :, 1] * vecs[..., 0]
+    return np.all(cross > 0, axis=-1) | np.all(cross < 0, axis=-1)
+
+
+def _foot_plate_checks(polys, foot_pts, checks):
+    """Check foot position on forceplates for a set of (plate, frame, side).
+
+    polys is a (n_plates x 4 x 3) array of plate corners and foot_pts a dict
+    of (n_frames x 4 x 3) arrays of foot points (see _get_foot_points), keyed
+    by side. All the checks are evaluated in a single batch. Returns an array
+    with 0, 1, 2 for each check: foot completely outside plate, partially
+    outside plate, inside plate, respectively.
+    """
+    if not checks:
+        return np.zeros(0, dtype=int)
+    plates, frames, sides = zip(*checks)
+    pts = np.stack([foot_pts[side][fr] for fr, side in zip(frames, sides)])
+    inside = _points_in_polys(polys[list(plates)], pts)
+    return np.where(inside.all(axis=1), 2, np.where(inside.any(axis=1), 1, 0))
+
+
 def detect_forceplate_events(source, mkrdata=None, fp_info=None, roi=None):
     """Detect frames where valid forceplate strikes and toeoffs occur.
     Uses forceplate data and estimated foot shape.
 
-    If supplied, mkrdata must include foot and pelvis markers. Otherwise
-    it will be read.
+    If supplied, mkrdata (dict or MarkerSet) must include foot and pelvis
+    markers. Otherwise it will be read.
 
     If fp_info dict is supplied, no marker-based checks will be done;
     instead the Eclipse forceplate info will be used to determine the foot.
@@ -478,28 +662,10 @@ def detect_forceplate_events(source, mkrdata=None, fp_info=None, roi=None):
 
     If roi is given e.g. [100, 300], all marker data checks will be restricted
     to roi.
-    """
-
-    def _foot_plate_check(fpdata, mkrdata, fr0, side, footlen):
-        """Helper for foot-plate check.
 
-        Returns 0, 1, 2 for: completely outside plate, partially outside plate,
-        inside plate, respectively.
-        """
-        allpts = _get_foot_points(mkrdata, side, footlen)
-        poly = fpdata['plate_corners']
-        pts_ok = list()
-        for label, pts in allpts.items():
-            pt = pts[fr0, :]
-            pt_ok = _point_in_poly(poly, pt)
-            logger.debug('%s point %son plate' % (label, '' if pt_ok else 'not '))
-            pts_ok.append(pt_ok)
-        if all(pts_ok):
-            return 2
-        elif any(pts_ok):
-            return 1
-        else:
-            return 0
+    source may be a read_data.SourceContext instance, in which case data that
+    has already been read through it is not read again.
+    """
 
     def _threshold_forceplate(fp, bodymass=None):
         """Get candidate foot strike and toeoff frames by considering force only"""
@@ -606,13 +772,25 @@ def detect_forceplate_events(source, mkrdata=None, fp_info=None, roi=None):
             + cfg.autoproc.track_markers
         )
         mkrdata = read_data.get_marker_data(source, mkrs)
+    mkrdata = MarkerSet.from_dict(mkrdata)
 
-    datalen = mkrdata[cfg.autoproc.track_markers[0]].shape[0]
+    datalen = mkrdata.n_frames
 
     logger.debug('acquiring gait events')
     events_0 = automark_events(source, mkrdata=mkrdata, mark=False, roi=roi)
 
-    # loop over the plates; our internal forceplate index is 0-based
+    # plate polygons, foot points and the leading foot are computed only once
+    polys = np.stack([fp['plate_corners'] for fp in fpdata])
+    foot_pts = dict()
+    leading_foot = None
+    # allows foot to settle for 50 ms after strike
+    settle_fr = int(50 / 1000 * info['framerate'])
+
+    # first pass: forceplate data and the required foot-plate checks for each
+    # plate; the checks are (plate, frame, side, expected result) tuples
+    plates = list()
+    checks = list()
+    # our internal forceplate index is 0-based
     for plate_ind, fp in enumerate(fpdata):
         logger.debug('analyzing plate %d' % plate_ind)
         # XXX: are we sure that the plate indices always match Eclipse?
@@ -624,60 +802,66 @@ def detect_forceplate_events(source, mkrdata=None, fp_info=None, roi=None):
             context = None
 
         # check foot markers (or points) to determine context and validity
+        plate_checks = list()
         if force_checks_ok and detect_context:
             logger.debug('autodetecting context')
-            # allows foot to settle for 50 ms after strike
-            settle_fr = int(50 / 1000 * info['framerate'])
             fr0 = strike_fr + settle_fr
             # context is determined by leading foot at strike time
-            this_context = _leading_foot(mkrdata, roi=roi)[fr0]
-            if this_context is None:
+            if leading_foot is None:
+                leading_foot = _leading_foot(mkrdata, roi=roi)
+            context = leading_foot[fr0]
+            if context is None:
                 raise GaitDataError('cannot determine leading foot from marker data')
-            footlen = rfootlen if this_context == 'R' else lfootlen
-            logger.debug('checking contact for leading foot: %s' % this_context)
-            foot_contacts_ok = (
-                _foot_plate_check(fp, mkrdata, fr0, this_context, footlen) == 2
-            )
+            plate_checks.append((plate_ind, fr0, context, 2))
             # to eliminate double contacts, check that contralateral foot is not on plate
             # this needs marker-based events
-            if foot_contacts_ok and events_0 is not None:
-                contra_side = 'R' if this_context == 'L' else 'L'
+            if events_0 is not None:
+                contra_side = 'R' if context == 'L' else 'L'
                 contra_strikes = events_0[contra_side + '_strikes']
-                contra_strikes_next = contra_strikes[
-                    np.where(contra_strikes > strike_fr)
-                ]
+                contra_strikes_next = contra_strikes[contra_strikes > strike_fr]
                 if contra_strikes_next.size == 0:
                     logger.debug('no following contralateral strike')
+                elif contra_strikes_next[0] + settle_fr >= datalen:
+                    logger.debug('no following contralateral strike (overrun)')
                 else:
                     fr0 = contra_strikes_next[0] + settle_fr
-                    if fr0 > datalen:  # data overrun
-                        logger.debug('no following contralateral strike (overrun)')
-                    else:
-                        logger.debug(
-                            'checking the following contralateral strike '
-                            '(at frame %d)' % fr0
-                        )
-                        contra_next_ok = (
-                            _foot_plate_check(fp, mkrdata, fr0, contra_side, footlen)
-                            == 0
-                        )
-                        foot_contacts_ok &= contra_next_ok
-                contra_strikes_prev = contra_strikes[
-                    np.where(contra_strikes < strike_fr)
-                ]
+                    plate_checks.append((plate_ind, fr0, contra_side, 0))
+                contra_strikes_prev = contra_strikes[contra_strikes < strike_fr]
                 if contra_strikes_prev.size == 0:
                     logger.debug('no previous contralateral strike')
                 else:
                     fr0 = contra_strikes_prev[-1] + settle_fr
-                    logger.debug(
-                        'checking previous contact for contralateral '
-                        'foot (at frame %d)' % fr0
-                    )
-                    contra_prev_ok = (
-                        _foot_plate_check(fp, mkrdata, fr0, contra_side, footlen) == 0
-                    )
-                    foot_contacts_ok &= contra_prev_ok
-            context = this_context if foot_contacts_ok else None
+                    plate_checks.append((plate_ind, fr0, contra_side, 0))
+            for _, _, side, _ in plate_checks:
+                if side not in foot_pts:
+                    footlen = rfootlen if side == 'R' else lfootlen
+                    pts = _get_foot_points(mkrdata, side, footlen)
+                    foot_pts[side] = np.stack(list(pts.values()), axis=1)
+        plates.append((plate, context, strike_fr, toeoff_fr, len(plate_checks)))
+        checks.extend(plate_checks)
+
+    # evaluate all the foot-plate checks at once
+    check_results = _foot_plate_checks(
+        polys, foot_pts, [check[:3] for check in checks]
+    )
+    check_ok = check_results == np.array([check[3] for check in checks], dtype=int)
+    check_ind = 0
+
+    for plate_ind, (plate, context, strike_fr, toeoff_fr, nchecks) in enumerate(
+        plates
+    ):
+        if nchecks:
+            inds = slice(check_ind, check_ind + nchecks)
+            for (_, fr0, side, expected), result in zip(
+                checks[inds], check_results[inds]
+            ):
+                logger.debug(
+                    'plate %d: %s foot contact at frame %d: %d (expected %d)'
+                    % (plate_ind, side, fr0, result, expected)
+                )
+            if not check_ok[inds].all():
+                context = None
+            check_ind += nchecks
 
         if context:
             logger.debug(
@@ -720,12 +904,17 @@ def automark_events(
     Before running automark, run reconstruct, label, gap fill and filter
     pipelines. Filtering is important to get reasonably smooth derivatives.
 
+    The detection itself is done by events.detect_events(), which can also be
+    used directly on marker data from any source.
+
     Parameters
     ----------
-    source : str | ViconNexus
+    source : str | ViconNexus | SourceContext
         The data source, either c3d filename or ViconNexus connection. For Nexus
         connections, the events can automatically be inserted into Nexus. For c3d
-        files, the events are returned but not actually written to the c3d file.
+        files, the events are returned but not actually written to the c3d file
+        (autoprocess.autoproc_c3ds() does that). A SourceContext for either may
+        be given, to share already read data.
     mkrdata : dict, optional
         The marker data dict. If not given, it will be read from the source. If
         given, it must include foot markers and subject tracking markers (see cfg).
@@ -751,37 +940,10 @@ def automark_events(
         If False, do not actually insert the marker events into Nexus.
     """
 
-    from .read_data import get_metadata, get_marker_data
+    from .read_data import get_metadata, get_marker_data, _raw_source
+    from . import events, nexus
 
     info = get_metadata(source)
-    frate = info['framerate']
-    # some operations are Nexus specific and make no sense for c3d source
-    from . import nexus
-
-    # TODO: move into config
-    # marker data is assumed to be in mm
-    # mm/frame = 1000 m/frame = 1000/frate m/s
-    VEL_CONV = 1000 / frate
-    # reasonable limit for peak velocity (m/s before multiplier)
-    MAX_PEAK_VELOCITY = 12 * VEL_CONV
-    # reasonable limits for velocity on slope (increasing/decreasing)
-    MAX_SLOPE_VELOCITY = 6 * VEL_CONV
-    MIN_SLOPE_VELOCITY = 0  # not currently in use
-    # minimum swing velocity (rel to max velocity)
-    MIN_SWING_VELOCITY = 0.5
-    # median prefilter width
-    PREFILTER_MEDIAN_WIDTH = 3
-    # tolerance for matching forceplate and vel. thresholded events
-    FP_EVENT_TOL = 10
-
-    if vel_thresholds is None:
-        vel_thresholds = {
-            'L_strike': None,
-            'L_toeoff': None,
-            'R_strike': None,
-            'R_toeoff': None,
-        }
-
     if mkrdata is None:
         # FIXME: missing markers are not detected here?
         reqd_markers = (
@@ -791,209 +953,30 @@ def automark_events(
         )
         mkrdata = get_marker_data(source, reqd_markers)
 
-    rfootctrv_ = avg_markerdata(
-        mkrdata,
-        cfg.autoproc.right_foot_markers,
-        roi=roi,
-        fail_on_gaps=False,
-        avg_velocity=True,
-    )
-    rfootctrv = np.linalg.norm(rfootctrv_, axis=1)
-    lfootctrv_ = avg_markerdata(
+    detected, footctrvs, maxvs = events.detect_events(
         mkrdata,
-        cfg.autoproc.left_foot_markers,
+        info['framerate'],
+        events_range=events_range,
+        fp_events=fp_events,
+        vel_thresholds=vel_thresholds,
         roi=roi,
-        fail_on_gaps=False,
-        avg_velocity=True,
+        start_on_forceplate=start_on_forceplate,
+        return_velocities=True,
     )
-    lfootctrv = np.linalg.norm(lfootctrv_, axis=1)
-
-    # position data: use ANK marker
-    rfootctrP = mkrdata['RANK']
-    lfootctrP = mkrdata['LANK']
-
-    strikes_all = {}
-    toeoffs_all = {}
-
-    # loop: same operations for left / right foot
-    for context, footctrP, footctrv in zip(
-        ('R', 'L'), (rfootctrP, lfootctrP), (rfootctrv, lfootctrv)
-    ):
-        logger.debug('marking side %s' % context)
-        # foot center position
-        # filter scalar velocity data to suppress noise and spikes
-        footctrv = signal.medfilt(footctrv, PREFILTER_MEDIAN_WIDTH)
-        # get peak (swing) velocity
-        maxv = _get_foot_swing_velocity(footctrv, MAX_PEAK_VELOCITY, MIN_SWING_VELOCITY)
-
-        # compute thresholds
-        if cfg.autoproc.use_fp_vel_thresholds and vel_thresholds[context + '_strike']:
-            threshold_fall_ = vel_thresholds[context + '_strike']
-        else:
-            threshold_fall_ = maxv * cfg.autoproc.strike_vel_threshold
-        if cfg.autoproc.use_fp_vel_thresholds and vel_thresholds[context + '_toeoff']:
-            threshold_rise_ = vel_thresholds[context + '_toeoff']
-        else:
-            threshold_rise_ = maxv * cfg.autoproc.toeoff_vel_threshold
-        logger.debug(
-            'side: %s, default thresholds fall/rise: %.2f/%.2f'
-            % (
-                context,
-                maxv * cfg.autoproc.strike_vel_threshold,
-                maxv * cfg.autoproc.toeoff_vel_threshold,
-            )
-        )
-        logger.debug('using thresholds: %.2f/%.2f' % (threshold_fall_, threshold_rise_))
-        # find point where velocity crosses threshold
-        # foot strikes (velocity decreases)
-        cross = falling_zerocross(footctrv - threshold_fall_)
-        # exclude edges of data vector
-        fmax = len(footctrv) - 1
-        cross = cross[np.where(np.logical_and(cross > 0, cross < fmax))]
-        # check velocity on slope
-        cind_min = np.logical_and(
-            footctrv[cross - 1] < MAX_SLOPE_VELOCITY,
-            footctrv[cross - 1] > MIN_SLOPE_VELOCITY,
-        )
-        cind_max = np.logical_and(
-            footctrv[cross + 1] < MAX_SLOPE_VELOCITY,
-            footctrv[cross + 1] > MIN_SLOPE_VELOCITY,
-        )
-        strikes = cross[np.logical_and(cind_min, cind_max)]
-
-        # check for foot swing (velocity maximum) between consecutive strikes
-        # if no swing, keep deleting the latter event until swing is found
-        bad = []
-        for sind in range(len(strikes)):
-            if sind in bad:
-                continue
-            for sind2 in range(sind + 1, len(strikes)):
-                swing_max_vel = footctrv[strikes[sind] : strikes[sind2]].max()
-                # logger.debug('check %d-%d' % (strikes[sind], strikes[sind2]))
-                if swing_max_vel < maxv * MIN_SWING_VELOCITY:
-                    logger.debug(
-                        'no swing between strikes %d-%d, deleting %d'
-                        % (strikes[sind], strikes[sind2], strikes[sind2])
-                    )
-                    bad.append(sind2)
-                else:
-                    break
-        strikes = np.delete(strikes, bad)
-
-        if len(strikes) == 0:
-            raise GaitDataError('No valid foot strikes detected')
-
-        # toe offs (velocity increases)
-        cross = rising_zerocross(footctrv - threshold_rise_)
-        cross = cross[np.where(np.logical_and(cross > 0, cross < len(footctrv)))]
-        cind_min = np.logical_and(
-            footctrv[cross - 1] < MAX_SLOPE_VELOCITY,
-            footctrv[cross - 1] > MIN_SLOPE_VELOCITY,
-        )
-        cind_max = np.logical_and(
-            footctrv[cross + 1] < MAX_SLOPE_VELOCITY,
-            footctrv[cross + 1] > MIN_SLOPE_VELOCITY,
-        )
-        toeoffs = cross[np.logical_and(cind_min, cind_max)]
-
-        if len(toeoffs) == 0:
-            raise GaitDataError('Could not detect any toe-off events')
-
-        # check for multiple toeoffs
-        for s1, s2 in list(zip(strikes, np.roll(strikes, -1)))[:-1]:
-            to_this = np.where(np.logical_and(toeoffs > s1, toeoffs < s2))[0]
-            if len(to_this) > 1:
-                logger.debug(
-                    '%d toeoffs during cycle, keeping the last one' % len(to_this)
-                )
-                toeoffs = np.delete(toeoffs, to_this[:-1])
-
-        logger.debug('autodetected strike events: %s' % strikes)
-        logger.debug('autodetected toeoff events: %s' % toeoffs)
-
-        # select events for which the foot is close enough to center frame
-        if events_range:
-            mdata = avg_markerdata(mkrdata, cfg.autoproc.track_markers, roi=roi)
-            fwd_dim = _principal_movement_direction(mdata)
-            strike_pos = footctrP[strikes, fwd_dim]
-            dist_ok = np.logical_and(
-                strike_pos > events_range[0], strike_pos < events_range[1]
-            )
-            # exactly zero position at strike should indicate a gap -> exclude
-            # TODO: smarter gap handling
-            dist_ok = np.logical_and(dist_ok, strike_pos != 0)
-            strikes = strikes[dist_ok]
-
-        # correct foot strikes with force plate autodetected events
-        if fp_events and fp_events[context + '_strikes']:
-            fp_strikes = fp_events[context + '_strikes']
-            logger.debug('forceplate strikes: %s' % fp_strikes)
-            # find best fp matches for all strikes
-            fpc = digitize_array(strikes, fp_strikes)
-            ok_ind = np.where(np.abs(fpc - strikes) < FP_EVENT_TOL)[0]
-            if ok_ind.size == 0:
-                logger.warning(
-                    'could not match forceplate strike with an autodetected strike'
-                )
-            else:
-                # replace with fp detected strikes
-                strikes[ok_ind] = fpc[ok_ind]
-                logger.debug('fp corrected strikes: %s' % strikes)
-            # toeoffs
-            fp_toeoffs = fp_events[context + '_toeoffs']
-            logger.debug('forceplate toeoffs: %s' % fp_toeoffs)
-            fpc = digitize_array(toeoffs, fp_toeoffs)
-            ok_ind = np.where(np.abs(fpc - toeoffs) < FP_EVENT_TOL)[0]
-            if ok_ind.size == 0:
-                logger.warning(
-                    'could not match forceplate toeoff with an autodetected toeoff'
-                )
-            else:
-                toeoffs[ok_ind] = fpc[ok_ind]
-                logger.debug('fp corrected toeoffs: %s' % toeoffs)
-            # delete strikes before (actual) 1st forceplate contact
-            if start_on_forceplate and len(fp_strikes) > 0:
-                # use a tolerance here to avoid deleting possible (uncorrected)
-                # strike near the fp
-                not_ok = np.where(strikes < fp_strikes[0] - FP_EVENT_TOL)[0]
-                if not_ok.size > 0:
-                    logger.debug(
-                        'deleting foot strikes before forceplate: %s' % strikes[not_ok]
-                    )
-                    strikes = np.delete(strikes, not_ok)
-
-        if roi is not None:
-            strikes = np.extract(
-                np.logical_and(roi[0] <= strikes + 1, strikes + 1 <= roi[1]), strikes
-            )
-
-            toeoffs = np.extract(
-                np.logical_and(roi[0] <= toeoffs + 1, toeoffs + 1 <= roi[1]), toeoffs
-            )
-
-        if len(strikes) == 0:
-            raise GaitDataError('No valid foot strikes detected')
-
-        # delete toeoffs that are not between strike events
-        not_ok = np.where(
-            np.logical_or(toeoffs <= min(strikes), toeoffs >= max(strikes))
-        )
-        toeoffs = np.delete(toeoffs, not_ok)
-
-        logger.debug('final strike events: %s' % strikes)
-        logger.debug('final toeoff events: %s' % toeoffs)
 
+    for context in ('R', 'L'):
+        strikes = detected[context + '_strikes']
+        toeoffs = detected[context + '_toeoffs']
         if mark:
-            if not nexus._is_vicon_instance(source):
+            # some operations are Nexus specific and make no sense for c3d source
+            if not nexus._is_vicon_instance(_raw_source(source)):
                 raise ValueError('event marking supported only for Nexus')
             vicon = nexus.viconnexus()
             nexus._create_events(vicon, context, strikes, toeoffs)
 
-        strikes_all[context] = strikes
-        toeoffs_all[context] = toeoffs
-
         # plot velocities w/ thresholds and marked events
         if plot:
+            footctrv = footctrvs[context]
             first_call = context == 'R'
             if first_call:
                 f, (ax1, ax2) = plt.subplots(2, 1)
@@ -1003,7 +986,7 @@ def automark_events(
             ax.plot(strikes, footctrv[strikes], 'kD', markersize=10, label='strike')
             ax.plot(toeoffs, footctrv[toeoffs], 'k^', markersize=10, label='toeoff')
             ax.legend(numpoints=1, fontsize=10)
-            ax.set_ylim(0, maxv + 10)
+            ax.set_ylim(0, maxvs[context] + 10)
             if not first_call:
                 plt.xlabel('Frame')
             ax.set_ylabel('Velocity (mm/frame)')
@@ -1012,9 +995,4 @@ def automark_events(
     if plot:
         plt.show()
 
-    return {
-        'R_strikes': strikes_all['R'],
-        'L_strikes': strikes_all['L'],
-        'R_toeoffs': toeoffs_all['R'],
-        'L_toeoffs': toeoffs_all['L'],
-    }
+    return detected
@@ -129,7 +129,7 @@ def _plot_sessions(
     if not tagged_only:
         tags = None
     c3ds_all = sessionutils._get_tagged_dynamic_c3ds_from_sessions(sessions, tags=tags)
-    trials = [trial.Trial(c3d) for c3d in c3ds_all]
+    trials = trial.load_trials(c3ds_all)
 
     return plot_trials(
         trials,
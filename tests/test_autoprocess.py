@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""
+
+Unit tests for offline autoprocessing.
+
+@author: jussi (jnu@iki.fi)
+"""
+
+import pytest
+import numpy as np
+import logging
+
+from gaitutils import autoprocess, eclipse, read_data, utils, GaitDataError
+from utils import _make_synthetic_c3d, _make_walking_markers, cfg
+
+
+logger = logging.getLogger(__name__)
+
+
+def _write_session(tmp_path, n, forceplate=False):
+    """Write c3d and .enf files with walking marker data; return c3d files
+    and the expected events.
+
+    If forceplate is True, the left foot of the first trial contacts the
+    forceplate for frames 47-113. In the marker data, the foot is stationary
+    on the plate for frames 50-110, and still moving at the forceplate events.
+    """
+    fns, trial_events = list(), list()
+    for k in range(n):
+        rng = np.random.default_rng(k)
+        mkrdata, evs = _make_walking_markers(n_frames=300, rng=rng)
+        mkrdata['SACR'] = (mkrdata['RASI'] + mkrdata['LASI']) / 2 - [200, 0, 0]
+        forces = None
+        if forceplate and k == 0:
+            # the plate spans x = 0..500 and y = 0..600
+            for marker in mkrdata:
+                mkrdata[marker] -= [375, 0, 0]
+            # vertical force with 20 sample ramps; the gain is 2
+            fz = np.clip(np.arange(660) / 20, 0, 1) * 400
+            forces = np.zeros((3000, 6))
+            forces[470:1130, 2] = np.minimum(fz, fz[::-1])
+        fn = tmp_path / ('walk%02d.c3d' % k)
+        _make_synthetic_c3d(fn, n_frames=300, markers=mkrdata, forces=forces)
+        enf = tmp_path / ('walk%02d.Trial.enf' % k)
+        enf.write_text('[TRIAL_INFO]\nTYPE=Dynamic\nDESCRIPTION=\nNOTES=\n')
+        fns.append(str(fn))
+        trial_events.append(evs)
+    return fns, trial_events
+
+
+def test_autoproc_c3ds(tmp_path, monkeypatch):
+    """Test offline autoprocessing of c3d files"""
+    monkeypatch.setattr(cfg.autoproc, 'check_marker_set', False)
+    monkeypatch.setattr(cfg.autoproc, 'events_range', [-1e5, 1e5])
+    fns, trial_events = _write_session(tmp_path, 3)
+    # a static trial is skipped
+    enf_static = tmp_path / 'walk02.Trial.enf'
+    enf_static.write_text('[TRIAL_INFO]\nTYPE=Static\nDESCRIPTION=\nNOTES=\n')
+    results = autoprocess.autoproc_c3ds(fns, workers=2)
+    assert list(results) == fns
+    for fn, evs in zip(fns[:2], trial_events[:2]):
+        res = results[fn]
+        assert res['recon_ok']
+        assert res['description'].startswith('ok,')
+        assert res['description'].endswith(' m/s')
+        for key, evs_ in evs.items():
+            for ev in res['events'][key]:
+                assert np.abs(np.r_[evs_, 300] - ev).min() <= 6
+        edata = eclipse.get_eclipse_keys(autoprocess._c3d_to_enf(fn))
+        assert edata['DESCRIPTION'] == res['description']
+        # the events are written into the c3d file
+        meta = read_data.get_metadata(fn)
+        meta['events'].subtract_offset(meta['offset'])
+        for key, evs_ in res['events'].items():
+            context, evtype = key.split('_')
+            assert getattr(meta['events'], context.lower() + evtype) == list(evs_)
+    assert results[fns[2]] == {
+        'recon_ok': False,
+        'description': 'skipped',
+        'events': None,
+    }
+    # results do not depend on the number of workers
+    results_ = autoprocess.autoproc_c3ds(fns, workers=1, write_eclipse=False)
+    for fn in fns[:2]:
+        for key, evs in results[fn]['events'].items():
+            assert np.array_equal(evs, results_[fn]['events'][key])
+    # the session function finds the c3d files via the .enf files
+    results_ = autoprocess.autoproc_session_c3ds(
+        str(tmp_path), patterns=['walk00'], workers=1
+    )
+    assert list(results_) == [fns[0]]
+    # unreadable file
+    bad_fn = tmp_path / 'bad.c3d'
+    bad_fn.write_bytes(b'\x00' * 100)
+    with pytest.raises(GaitDataError):
+        autoprocess.autoproc_c3ds([fns[0], bad_fn], workers=1)
+    results_ = autoprocess.autoproc_c3ds([fns[0], bad_fn], on_error='skip')
+    assert list(results_) == [fns[0]]
+
+
+def test_autoproc_c3ds_forceplate(tmp_path, monkeypatch):
+    """Test offline autoprocessing with a forceplate contact"""
+    monkeypatch.setattr(cfg.autoproc, 'check_marker_set', False)
+    monkeypatch.setattr(cfg.autoproc, 'events_range', [-1e5, 1e5])
+    fns, trial_events = _write_session(tmp_path, 2, forceplate=True)
+    vel_ths = list()
+    _mark_c3d = autoprocess._mark_c3d
+
+    def _mark_c3d_spy(c3dfile, trial, vel_th):
+        vel_ths.append(vel_th)
+        return _mark_c3d(c3dfile, trial, vel_th)
+
+    monkeypatch.setattr(autoprocess, '_mark_c3d', _mark_c3d_spy)
+    results = autoprocess.autoproc_c3ds(fns, workers=1, write_events=False)
+    assert results[fns[0]]['description'].startswith('ok,1L,')
+    no_contact = cfg.autoproc.enf_descriptions['context_none']
+    assert results[fns[1]]['description'].startswith('ok,%s,' % no_contact)
+    # the thresholds are pooled from the forceplate contact and used for all
+    # trials
+    assert len(vel_ths) == 2 and vel_ths[0] == vel_ths[1]
+    assert vel_ths[0]['R_strike'] is None and vel_ths[0]['R_toeoff'] is None
+    assert vel_ths[0]['L_strike'] > 0 and vel_ths[0]['L_toeoff'] > 0
+    # the forceplate events replace the marker based ones
+    evs = results[fns[0]]['events']
+    assert 47 in evs['L_strikes'] and 113 in evs['L_toeoffs']
+    evs_ = utils.automark_events(fns[0], mark=False)
+    assert 47 not in evs_['L_strikes'] and 113 not in evs_['L_toeoffs']
+    for key, evs_ in results[fns[1]]['events'].items():
+        for ev in evs_:
+            assert np.abs(np.r_[trial_events[1][key], 300] - ev).min() <= 6
+    # pooling works the same in a process pool
+    monkeypatch.setattr(autoprocess, '_mark_c3d', _mark_c3d)
+    results_ = autoprocess.autoproc_c3ds(fns, workers=2)
+    for fn in fns:
+        for key, evs_ in results[fn]['events'].items():
+            assert np.array_equal(evs_, results_[fn]['events'][key])
+    meta = read_data.get_metadata(fns[0])
+    assert 47 + meta['offset'] in meta['events'].lstrikes
+
+
+def test_has_gaps(monkeypatch):
+    """Test the gap check of autoprocessing"""
+    monkeypatch.setattr(cfg.autoproc, 'ignore_markers', ['LTOE'])
+    data = np.ones((3, 20, 3))
+    data[1, :3] = 0  # leading gap
+    data[2] = 0  # no data at all
+    mkrdata = utils.MarkerSet(['RHEE', 'RTOE', 'RANK'], data)
+    # the old per-marker check reported no gaps here
+    assert not any(utils.marker_gaps(mkrdata[m]).size for m in mkrdata)
+    assert not autoprocess._has_gaps(mkrdata)
+    data[0, 10] = 0
+    assert autoprocess._has_gaps(utils.MarkerSet(['RHEE', 'RTOE', 'RANK'], data))
+    assert not autoprocess._has_gaps(utils.MarkerSet(['LTOE', 'RTOE', 'RANK'], data))
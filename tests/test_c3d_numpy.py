@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""
+
+Unit tests for the NumPy c3d reader.
+
+@author: jussi (jnu@iki.fi)
+"""
+
+import os.path as op
+import pytest
+import numpy as np
+from numpy.testing import assert_allclose, assert_equal
+import logging
+
+from gaitutils import c3d, c3d_numpy, models, utils
+from utils import _c3d_path, _make_synthetic_c3d, cfg
+
+
+logger = logging.getLogger(__name__)
+
+
+@pytest.fixture(params=[-1.0, 0.1], ids=['float', 'int'])
+def synthetic_c3d(tmp_path, request):
+    """Write a synthetic c3d file and return it, along with the data"""
+    fn = tmp_path / 'synthetic.c3d'
+    points, residuals, analog, params = _make_synthetic_c3d(fn, scale=request.param)
+    return fn, points, residuals, analog, params
+
+
+def test_c3d_numpy_synthetic(synthetic_c3d):
+    """Test reads of a synthetic c3d file"""
+    fn, points, residuals, analog, params = synthetic_c3d
+    meta = c3d_numpy._get_metadata(fn)
+    assert meta['offset'] == 1
+    assert meta['length'] == 50
+    assert meta['framerate'] == 100.0
+    assert meta['analograte'] == 1000.0
+    assert meta['samplesperframe'] == 10
+    assert meta['name'] == 'Testsubject'
+    assert meta['n_forceplates'] == 1
+    assert meta['markers'] == ['RHEE', 'LHEE', 'RKneeAngles']
+    assert_allclose(meta['subj_params']['Bodymass'], 70.0)
+    assert meta['subj_params']['nonexistent'] is None
+    assert meta['events'].rstrikes == [6]
+    assert meta['events'].rtoeoffs == [21]
+    assert meta['events'].lstrikes == [32]
+    # marker data; invalid frames should be zeroed
+    mkrdata = c3d_numpy._get_marker_data(fn, ['LHEE', 'RHEE'])
+    assert list(mkrdata.keys()) == ['LHEE', 'RHEE']
+    assert_allclose(mkrdata['LHEE'], points[:, 1, :], atol=1e-3)
+    rhee = points[:, 0, :].copy()
+    rhee[10:20, :] = 0
+    assert_allclose(mkrdata['RHEE'], rhee, atol=1e-3)
+    with pytest.raises(c3d.GaitDataError):
+        c3d_numpy._get_marker_data(fn, ['RTOE'])
+    assert 'RTOE' not in c3d_numpy._get_marker_data(fn, ['RTOE'], ignore_missing=True)
+    # EMG data: scaled by channel scale and general scale, offset subtracted
+    emg = c3d_numpy._get_emg_data(fn)
+    assert list(emg['data'].keys()) == ['Voltage.LGas', 'Voltage.RGas']
+    assert_allclose(emg['data']['Voltage.LGas'], (analog[:, 6] - 10) * 0.5 * 2)
+    assert_allclose(emg['data']['Voltage.RGas'], analog[:, 7] * 0.25 * 2)
+    assert_allclose(emg['t'], np.arange(500) / 1000.0)
+    with pytest.raises(c3d.GaitDataError):
+        c3d_numpy._get_accelerometer_data(fn)
+    # model data
+    modeldata = c3d_numpy._get_model_data(fn, models.pig_lowerbody)
+    assert_allclose(modeldata['RKneeAngles'], points[:, 2, :].T, atol=1e-3)
+    assert np.isnan(modeldata['LKneeAngles']).all()
+    assert modeldata['LKneeAngles'].shape == (3, 50)
+    # forceplate data
+    fpdata = c3d_numpy._get_forceplate_data(fn)
+    assert len(fpdata) == 1
+    assert_allclose(fpdata[0]['Ftot'], np.linalg.norm(analog[:, :3] * 2, axis=1))
+    assert_allclose(fpdata[0]['wT'], [250, 300, 0])
+
+
+@pytest.mark.skipif(not c3d.BTK_IMPORTED, reason='needs btk')
+def test_c3d_numpy_btk_parity():
+    """Compare against the btk reader"""
+    c3dfile = _c3d_path('double_contact.c3d')
+    if not op.isfile(c3dfile):
+        pytest.skip('test data not available')
+    meta = c3d._get_metadata_btk(c3dfile)
+    meta_np = c3d_numpy._get_metadata(c3dfile)
+    for key in [
+        'trialname',
+        'offset',
+        'framerate',
+        'analograte',
+        'name',
+        'length',
+        'samplesperframe',
+        'n_forceplates',
+        'markers',
+    ]:
+        assert meta[key] == meta_np[key]
+    for evtype in ['rstrikes', 'lstrikes', 'rtoeoffs', 'ltoeoffs']:
+        assert getattr(meta['events'], evtype) == getattr(meta_np['events'], evtype)
+    for par, val in meta['subj_params'].items():
+        if val is not None:
+            assert_allclose(meta_np['subj_params'][par], val)
+    mkrdata = c3d._get_marker_data(c3dfile, meta['markers'])
+    mkrdata_np = c3d_numpy._get_marker_data(c3dfile, meta['markers'])
+    for mkr in mkrdata:
+        assert_allclose(mkrdata_np[mkr], mkrdata[mkr], rtol=1e-5, atol=1e-4)
+    emg = c3d._get_emg_data(c3dfile)
+    emg_np = c3d_numpy._get_emg_data(c3dfile)
+    assert_equal(emg['t'], emg_np['t'])
+    for ch in emg['data']:
+        assert_allclose(emg_np['data'][ch], emg['data'][ch], rtol=1e-5)
+    for model in [models.pig_lowerbody, models.pig_lowerbody_kinetics]:
+        modeldata = c3d._get_model_data(c3dfile, model)
+        modeldata_np = c3d_numpy._get_model_data(c3dfile, model)
+        for var in modeldata:
+            assert_allclose(modeldata_np[var], modeldata[var], rtol=1e-5, atol=1e-4)
+    fpdata = c3d._get_forceplate_data(c3dfile)
+    fpdata_np = c3d_numpy._get_forceplate_data(c3dfile)
+    assert len(fpdata) == len(fpdata_np)
+    for plate, plate_np in zip(fpdata, fpdata_np):
+        for var in plate:
+            assert_allclose(plate_np[var], plate[var], rtol=1e-5, atol=1e-4)
+    an = c3d.get_analysis(c3dfile)['unknown']
+    an_np = c3d_numpy.get_analysis(c3dfile)['unknown']
+    for var in an:
+        for context in ['Left', 'Right']:
+            assert_allclose(an_np[var][context], an[var][context])
+
+
+def test_dec_floats():
+    """Test DEC float conversion"""
+    # 1.0 and -2.5 in DEC (VAX F) format
+    buf = bytes([0x80, 0x40, 0x00, 0x00, 0x20, 0xC1, 0x00, 0x00])
+    assert_equal(c3d_numpy._dec_to_ieee(buf), [1.0, -2.5])
+    assert c3d_numpy._ieee_to_dec([1.0, -2.5]) == buf
+
+
+def test_c3d_numpy_metadata_memo(synthetic_c3d):
+    """Test that metadata is memoized and copies are returned"""
+    fn = synthetic_c3d[0]
+    c3d_numpy._read_metadata.cache_clear()
+    meta = c3d._get_metadata(fn)  # the btk reader uses the header-only path too
+    meta['events'].subtract_offset(meta['offset'])
+    meta['subj_params']['Bodymass'] = 0
+    meta_ = c3d_numpy._get_metadata(fn)
+    assert meta_['events'].rstrikes == [6]
+    assert_allclose(meta_['subj_params']['Bodymass'], 70.0)
+    info = c3d_numpy._read_metadata.cache_info()
+    assert info.hits == 1 and info.misses == 1
+
+
+def test_write_events(synthetic_c3d):
+    """Test writing events into the EVENT group"""
+    fn = synthetic_c3d[0]
+    c3d_ = c3d_numpy._C3DFile(fn)
+    mkrdata = c3d_numpy._get_marker_data(fn, ['LHEE', 'RHEE'])
+    emg = c3d_numpy._get_emg_data(fn)
+    events = utils.TrialEvents(rstrikes=[3, 40], lstrikes=[20], ltoeoffs=[9])
+    c3d_numpy._write_events(fn, events)
+    meta = c3d_numpy._get_metadata(fn)
+    for evtype in utils.TrialEvents.event_types:
+        assert getattr(meta['events'], evtype) == getattr(events, evtype)
+    c3d_new = c3d_numpy._C3DFile(fn)
+    # the data stays in place if the parameters fit
+    c3d_numpy._write_events(fn, events)
+    assert c3d_numpy._C3DFile(fn).data_start == c3d_new.data_start
+    assert c3d_new.param_list('EVENT', 'SUBJECTS') == ['Testsubject'] * 4
+    assert_equal(c3d_new.param_list('EVENT', 'ICON_IDS'), [1, 2, 1, 1])
+    for key, val in c3d_.params.items():
+        if key[0] != 'EVENT':
+            assert_equal(c3d_new.params[key], val)
+    # many events do not fit, so the data is moved
+    events = utils.TrialEvents(rstrikes=list(range(1, 50)), ltoeoffs=list(range(50)))
+    c3d_numpy._write_events(fn, events)
+    assert c3d_numpy._C3DFile(fn).data_start > c3d_new.data_start
+    meta = c3d_numpy._get_metadata(fn)
+    assert meta['events'].rstrikes == events.rstrikes
+    assert meta['events'].ltoeoffs == events.ltoeoffs
+    assert not meta['events'].lstrikes
+    mkrdata_ = c3d_numpy._get_marker_data(fn, ['LHEE', 'RHEE'])
+    for marker in mkrdata:
+        assert_equal(mkrdata_[marker], mkrdata[marker])
+    emg_ = c3d_numpy._get_emg_data(fn)
+    for ch in emg['data']:
+        assert_equal(emg_['data'][ch], emg['data'][ch])
+    c3d_numpy._write_events(fn, utils.TrialEvents())
+    assert c3d_numpy._get_metadata(fn)['events'].rstrikes == []
+    assert c3d_numpy._C3DFile(fn).param('EVENT', 'USED') == 0
+
+
+def test_write_events_keep_other(tmp_path):
+    """Test that events other than foot strikes and offs are kept"""
+    fn = tmp_path / 'events.c3d'
+    events = [('Foot Strike', 'Right', 0.05), ('Event', 'General', 0.1)]
+    _make_synthetic_c3d(fn, events=events)
+    c3d_numpy._write_events(fn, utils.TrialEvents(lstrikes=[4]))
+    c3d_ = c3d_numpy._C3DFile(fn)
+    assert c3d_.param_list('EVENT', 'LABELS') == ['Foot Strike', 'Event']
+    assert c3d_.param_list('EVENT', 'CONTEXTS') == ['Left', 'General']
+    assert_allclose(c3d_.param_list('EVENT', 'TIMES'), [0, 0.03, 0, 0.1])
+    meta = c3d_numpy._get_metadata(fn)
+    assert meta['events'].lstrikes == [4]
+    assert meta['events'].rstrikes == []
@@ -11,10 +11,11 @@ import logging
 import tempfile
 import os.path as op
 import numpy as np
+from numpy.testing import assert_allclose
 import tempfile
 
-from gaitutils import sessionutils, emg, GaitDataError
-from utils import _file_path
+from gaitutils import sessionutils, emg, numutils, GaitDataError
+from utils import _file_path, _make_synthetic_c3d, cfg
 
 logger = logging.getLogger(__name__)
 
@@ -107,3 +108,79 @@ def test_emg_get_data():
         assert chdata.shape == (1000,)
         chdata = e.get_channel_data(chname, envelope=True)
         assert chdata.shape == (1000,)
+
+
+def test_emg_derived_cache(tmp_path):
+    """Test caching of filtered and enveloped EMG data"""
+    fn = tmp_path / 'synthetic.c3d'
+    _make_synthetic_c3d(fn)
+    e = emg.EMG(fn, correction_factor=2)
+    info0 = emg.EMG.cache_info()
+    data = e.get_channel_data('LGas')
+    raw = e.data['Voltage.LGas']
+    assert_allclose(data, 2 * numutils._filtfilt(raw, cfg.emg.passband, e.sfrate))
+    assert not data.flags.writeable
+    assert e.get_channel_data('LGas') is data
+    env = e.get_channel_data('LGas', envelope=True)
+    assert_allclose(env, 2 * numutils.envelope(raw, e.sfrate))
+    assert e.get_channel_data('LGas', envelope=True) is env
+    info = emg.EMG.cache_info()
+    assert info.hits - info0.hits == 2
+    assert info.misses - info0.misses == 2
+    assert info.maxbytes == cfg.emg.derived_cache_size_mb * 2 ** 20
+    # all channels are processed at once
+    assert info.entries - info0.entries == 4
+    assert_allclose(
+        e.get_channel_data('RGas'),
+        2 * numutils._filtfilt(e.data['Voltage.RGas'], cfg.emg.passband, e.sfrate),
+    )
+    assert emg.EMG.cache_info().hits - info.hits == 1
+    assert e._chmap['LGas'] == 'Voltage.LGas'
+    with pytest.raises(KeyError):
+        e.get_channel_data('RTibA')
+    assert e._chmap['RTibA'] is None
+    # passband change invalidates the filtered data
+    e.passband = (10, 100)
+    assert emg.EMG.cache_info().nbytes == info0.nbytes
+    data_ = e.get_channel_data('LGas')
+    assert_allclose(data_, 2 * numutils._filtfilt(raw, (10, 100), e.sfrate))
+    e.passband = None
+    assert_allclose(e.get_channel_data('LGas'), 2 * raw)
+    # entries are dropped with the instance
+    del e, data, data_, env
+    assert emg.EMG.cache_info().nbytes == info0.nbytes
+
+
+def test_emg_stream(tmp_path):
+    """Test streaming EMG envelope against the offline one"""
+    fn = tmp_path / 'synthetic.c3d'
+    _make_synthetic_c3d(fn, n_frames=100)
+    replay = emg.EMGReplay(fn, blocksize=32, chnames=['RGas', 'LGas'])
+    assert replay.chnames == ['Voltage.RGas', 'Voltage.LGas']
+    assert len(replay) == 1000 // 32
+    raw = np.stack([replay._emg.data[ch] for ch in replay.chnames])
+    # RMS should match exactly, apart from the delay and the start
+    proc = replay.processor(method='rms')
+    env = np.concatenate([proc.process(block) for block in replay], axis=1)
+    assert env.shape == (2, 992)
+    assert proc.nsamples == 992
+    delay = int(proc.delay)
+    env_offline = numutils.rms(raw, cfg.emg.rms_win, axis=-1)
+    assert_allclose(
+        env[:, cfg.emg.rms_win - 1 :],
+        env_offline[:, delay : 992 - delay],
+        rtol=1e-6,
+    )
+    # the state carries over blocks, so block size should not matter
+    proc = emg.EMGStreamProcessor(replay.sfrate, 2, blocksize=1, method='rms')
+    env_ = np.concatenate([proc.process(raw[:, k : k + 1]) for k in range(992)], 1)
+    assert_allclose(env_, env)
+    with pytest.raises(ValueError):
+        proc.process(raw[:, :2])
+    # the causal linear envelope only approximates the offline one
+    proc = replay.processor(method='linear_envelope')
+    env = np.concatenate([proc.process(block) for block in replay], axis=1)
+    proc.reset()
+    assert proc.nsamples == 0
+    assert_allclose(proc.process(raw[:, :32]), env[:, :32])
+    assert env.min() > 0
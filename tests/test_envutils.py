@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+
+Unit tests for envutils.
+
+@author: jussi (jnu@iki.fi)
+"""
+
+import os
+import numpy as np
+import logging
+
+from gaitutils.envutils import ByteLRUCache, file_cache, _file_fingerprint
+
+
+logger = logging.getLogger(__name__)
+
+
+def test_byte_lru_cache():
+    """Test eviction by total bytes"""
+    cache = ByteLRUCache(maxbytes=250)
+    a, b, c = (np.zeros(10) for k in range(3))  # 80 bytes each
+    cache.put('a', a)
+    cache.put('b', b)
+    cache.put('c', c)
+    assert cache.nbytes == 240
+    assert cache.get('a') is a  # a becomes most recently used
+    cache.put('d', np.zeros(10))
+    # b was least recently used
+    assert 'b' not in cache
+    assert 'a' in cache and 'c' in cache and 'd' in cache
+    assert cache.evictions == 1
+    assert cache.get('b') is None
+    info = cache.info()
+    assert info.hits == 1
+    assert info.misses == 1
+    assert info.nbytes == 240
+    assert info.entries == 3
+    # too large to cache at all
+    cache.put('big', np.zeros(100))
+    assert 'big' not in cache
+    assert len(cache) == 3
+    cache.clear()
+    assert cache.nbytes == 0 and len(cache) == 0
+
+
+def test_file_cache(tmp_path):
+    """Test file cache invalidation by fingerprint"""
+    fn = tmp_path / 'data.bin'
+    fn.write_bytes(b'123')
+    nreads = list()
+
+    @file_cache(maxbytes=1000, sizer=len)
+    def _read(filename):
+        nreads.append(filename)
+        with open(filename, 'rb') as f:
+            return f.read()
+
+    assert _read(fn) == b'123'
+    assert _read(str(fn)) == b'123'
+    assert len(nreads) == 1
+    assert _read.cache_info().hits == 1
+    # modify file; size changes, so the entry is stale
+    fn.write_bytes(b'12345')
+    assert _read(fn) == b'12345'
+    assert len(nreads) == 2
+    assert _read.cache_info().misses == 2
+    assert _read.cache_info().entries == 1
+    # same size, fake the mtime; caught only by the content hash
+    st = os.stat(fn)
+    fn.write_bytes(b'54321')
+    os.utime(fn, ns=(st.st_atime_ns, st.st_mtime_ns))
+    assert _file_fingerprint(fn)[:4] == _file_fingerprint(fn, content_hash=True)[:4]
+    assert len(_file_fingerprint(fn, content_hash=True)) == 5
@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+"""
+
+Unit tests for gait event detection.
+
+@author: jussi (jnu@iki.fi)
+"""
+
+import pytest
+import numpy as np
+from numpy.testing import assert_equal
+from scipy import signal
+import logging
+import time
+
+from gaitutils import events, utils, read_data, GaitDataError
+from gaitutils.numutils import digitize_array, falling_zerocross, rising_zerocross
+from utils import _make_synthetic_c3d, _make_walking_markers, cfg
+
+
+logger = logging.getLogger(__name__)
+
+
+def _swing_ok_loop(footctrv, strikes, min_vel):
+    """Reference implementation of the swing check, by a loop over strikes"""
+    bad = []
+    for sind in range(len(strikes)):
+        if sind in bad:
+            continue
+        for sind2 in range(sind + 1, len(strikes)):
+            if footctrv[strikes[sind] : strikes[sind2]].max() < min_vel:
+                bad.append(sind2)
+            else:
+                break
+    return ~np.isin(np.arange(len(strikes)), bad)
+
+
+def _detect_events_loop(
+    mkrdata,
+    framerate,
+    events_range=None,
+    fp_events=None,
+    vel_thresholds=None,
+    roi=None,
+    start_on_forceplate=False,
+):
+    """Reference implementation of event detection.
+
+    This is the detection part of utils.automark_events() before the
+    vectorized engine, with the swing and toeoff checks done by loops.
+    """
+    VEL_CONV = 1000 / framerate
+    MAX_PEAK_VELOCITY = 12 * VEL_CONV
+    MAX_SLOPE_VELOCITY = 6 * VEL_CONV
+    MIN_SLOPE_VELOCITY = 0
+    MIN_SWING_VELOCITY = 0.5
+    PREFILTER_MEDIAN_WIDTH = 3
+    FP_EVENT_TOL = 10
+    if vel_thresholds is None:
+        vel_thresholds = {
+            'L_strike': None,
+            'L_toeoff': None,
+            'R_strike': None,
+            'R_toeoff': None,
+        }
+    results = dict()
+    for context, markers in zip(
+        ('R', 'L'), (cfg.autoproc.right_foot_markers, cfg.autoproc.left_foot_markers)
+    ):
+        footctrv_ = utils.avg_markerdata(
+            mkrdata, markers, roi=roi, fail_on_gaps=False, avg_velocity=True
+        )
+        footctrv = np.linalg.norm(footctrv_, axis=1)
+        footctrP = mkrdata[context + 'ANK']
+        footctrv = signal.medfilt(footctrv, PREFILTER_MEDIAN_WIDTH)
+        maxv = utils._get_foot_swing_velocity(
+            footctrv, MAX_PEAK_VELOCITY, MIN_SWING_VELOCITY
+        )
+        if cfg.autoproc.use_fp_vel_thresholds and vel_thresholds[context + '_strike']:
+            threshold_fall_ = vel_thresholds[context + '_strike']
+        else:
+            threshold_fall_ = maxv * cfg.autoproc.strike_vel_threshold
+        if cfg.autoproc.use_fp_vel_thresholds and vel_thresholds[context + '_toeoff']:
+            threshold_rise_ = vel_thresholds[context + '_toeoff']
+        else:
+            threshold_rise_ = maxv * cfg.autoproc.toeoff_vel_threshold
+        cross = falling_zerocross(footctrv - threshold_fall_)
+        fmax = len(footctrv) - 1
+        cross = cross[np.where(np.logical_and(cross > 0, cross < fmax))]
+        cind_min = np.logical_and(
+            footctrv[cross - 1] < MAX_SLOPE_VELOCITY,
+            footctrv[cross - 1] > MIN_SLOPE_VELOCITY,
+        )
+        cind_max = np.logical_and(
+            footctrv[cross + 1] < MAX_SLOPE_VELOCITY,
+            footctrv[cross + 1] > MIN_SLOPE_VELOCITY,
+        )
+        strikes = cross[np.logical_and(cind_min, cind_max)]
+        bad = []
+        for sind in range(len(strikes)):
+            if sind in bad:
+                continue
+            for sind2 in range(sind + 1, len(strikes)):
+                swing_max_vel = footctrv[strikes[sind] : strikes[sind2]].max()
+                if swing_max_vel < maxv * MIN_SWING_VELOCITY:
+                    bad.append(sind2)
+                else:
+                    break
+        strikes = np.delete(strikes, bad)
+        if len(strikes) == 0:
+            raise GaitDataError('No valid foot strikes detected')
+        cross = rising_zerocross(footctrv - threshold_rise_)
+        cross = cross[np.where(np.logical_and(cross > 0, cross < len(footctrv)))]
+        cind_min = np.logical_and(
+            footctrv[cross - 1] < MAX_SLOPE_VELOCITY,
+            footctrv[cross - 1] > MIN_SLOPE_VELOCITY,
+        )
+        cind_max = np.logical_and(
+            footctrv[cross + 1] < MAX_SLOPE_VELOCITY,
+            footctrv[cross + 1] > MIN_SLOPE_VELOCITY,
+        )
+        toeoffs = cross[np.logical_and(cind_min, cind_max)]
+        if len(toeoffs) == 0:
+            raise GaitDataError('Could not detect any toe-off events')
+        for s1, s2 in list(zip(strikes, np.roll(strikes, -1)))[:-1]:
+            to_this = np.where(np.logical_and(toeoffs > s1, toeoffs < s2))[0]
+            if len(to_this) > 1:
+                toeoffs = np.delete(toeoffs, to_this[:-1])
+        if events_range:
+            mdata = utils.avg_markerdata(mkrdata, cfg.autoproc.track_markers, roi=roi)
+            fwd_dim = utils._principal_movement_direction(mdata)
+            strike_pos = footctrP[strikes, fwd_dim]
+            dist_ok = np.logical_and(
+                strike_pos > events_range[0], strike_pos < events_range[1]
+            )
+            dist_ok = np.logical_and(dist_ok, strike_pos != 0)
+            strikes = strikes[dist_ok]
+        if fp_events and fp_events[context + '_strikes']:
+            fp_strikes = fp_events[context + '_strikes']
+            fpc = digitize_array(strikes, fp_strikes)
+            ok_ind = np.where(np.abs(fpc - strikes) < FP_EVENT_TOL)[0]
+            if ok_ind.size > 0:
+                strikes[ok_ind] = fpc[ok_ind]
+            fp_toeoffs = fp_events[context + '_toeoffs']
+            fpc = digitize_array(toeoffs, fp_toeoffs)
+            ok_ind = np.where(np.abs(fpc - toeoffs) < FP_EVENT_TOL)[0]
+            if ok_ind.size > 0:
+                toeoffs[ok_ind] = fpc[ok_ind]
+            if start_on_forceplate and len(fp_strikes) > 0:
+                not_ok = np.where(strikes < fp_strikes[0] - FP_EVENT_TOL)[0]
+                if not_ok.size > 0:
+                    strikes = np.delete(strikes, not_ok)
+        if roi is not None:
+            strikes = np.extract(
+                np.logical_and(roi[0] <= strikes + 1, strikes + 1 <= roi[1]), strikes
+            )
+            toeoffs = np.extract(
+                np.logical_and(roi[0] <= toeoffs + 1, toeoffs + 1 <= roi[1]), toeoffs
+            )
+        if len(strikes) == 0:
+            raise GaitDataError('No valid foot strikes detected')
+        not_ok = np.where(
+            np.logical_or(toeoffs <= min(strikes), toeoffs >= max(strikes))
+        )
+        toeoffs = np.delete(toeoffs, not_ok)
+        results[context + '_strikes'] = strikes
+        results[context + '_toeoffs'] = toeoffs
+    return results
+
+
+def _detect_trial_events_loop(fn):
+    """Read a trial and detect its events using the reference implementation"""
+    meta = read_data.get_metadata(fn)
+    markers = (
+        cfg.autoproc.right_foot_markers
+        + cfg.autoproc.left_foot_markers
+        + cfg.autoproc.track_markers
+    )
+    mkrdata = read_data.get_marker_data(fn, markers)
+    return _detect_events_loop(mkrdata, meta['framerate'])
+
+
+def _write_walking_trials(tmp_path, n):
+    """Write c3d files with walking marker data; return files and events"""
+    fns, trial_events = list(), list()
+    for k in range(n):
+        rng = np.random.default_rng(k)
+        mkrdata, evs = _make_walking_markers(n_frames=300 + 20 * k, rng=rng)
+        fn = tmp_path / ('walk%02d.c3d' % k)
+        _make_synthetic_c3d(fn, n_frames=300 + 20 * k, markers=mkrdata)
+        fns.append(fn)
+        trial_events.append(evs)
+    return fns, trial_events
+
+
+def test_swing_ok():
+    """Test the vectorized swing check against a loop"""
+    rng = np.random.default_rng(0)
+    for _ in range(50):
+        footctrv = rng.uniform(0, 10, size=200)
+        strikes = np.sort(rng.choice(200, size=rng.integers(1, 20), replace=False))
+        assert_equal(
+            events._swing_ok(footctrv, strikes, 9.5),
+            _swing_ok_loop(footctrv, strikes, 9.5),
+        )
+
+
+def test_last_toeoffs():
+    """Test removal of multiple toeoffs between strikes"""
+    strikes = np.array([10, 50, 90])
+    toeoffs = np.array([5, 20, 30, 50, 60, 70, 80, 100, 110])
+    assert_equal(
+        toeoffs[events._last_toeoffs(strikes, toeoffs)], [5, 30, 50, 80, 100, 110]
+    )
+
+
+def test_detect_events():
+    """Test event detection from marker data"""
+    mkrdata, evs = _make_walking_markers()
+    detected = events.detect_events(mkrdata, 100.0)
+    assert list(detected) == ['R_strikes', 'L_strikes', 'R_toeoffs', 'L_toeoffs']
+    for key, evs_ in evs.items():
+        # velocity thresholding finds events a few frames away from the
+        # kinematic ones; the last strike may be just past the data
+        for ev in detected[key]:
+            assert np.abs(np.r_[evs_, 400] - ev).min() <= 6
+    detected_roi = events.detect_events(mkrdata, 100.0, roi=[100, 300])
+    assert all(100 <= ev + 1 <= 300 for ev in detected_roi['R_strikes'])
+    mkrdata['RANK'][:] = mkrdata['RHEE'][:] = mkrdata['RTOE'][:] = 0
+    with pytest.raises(GaitDataError):
+        events.detect_events(mkrdata, 100.0)
+
+
+def test_detect_events_reference():
+    """Test the event detection engine against the reference implementation"""
+    for k in range(5):
+        mkrdata, _ = _make_walking_markers(rng=np.random.default_rng(k))
+        fp_events = {
+            'R_strikes': [102],
+            'R_toeoffs': [158],
+            'L_strikes': [],
+            'L_toeoffs': [],
+        }
+        for kwargs in [
+            dict(),
+            dict(roi=[100, 300]),
+            dict(events_range=[0, 3000]),
+            dict(fp_events=fp_events, start_on_forceplate=True),
+            dict(vel_thresholds={'R_strike': 3.0, 'R_toeoff': 4.0}),
+        ]:
+            if 'vel_thresholds' in kwargs:
+                kwargs['vel_thresholds'].update(L_strike=None, L_toeoff=None)
+            detected = events.detect_events(mkrdata, 100.0, **kwargs)
+            detected_ref = _detect_events_loop(mkrdata, 100.0, **kwargs)
+            for key in detected_ref:
+                assert_equal(detected[key], detected_ref[key])
+
+
+def test_detect_trials_events(tmp_path):
+    """Test event detection for c3d files in a process pool"""
+    fns, _ = _write_walking_trials(tmp_path, 3)
+    detected = events.detect_trials_events(fns, workers=2)
+    for fn, evs in zip(fns, detected):
+        evs_ = utils.automark_events(fn, mark=False)
+        for key in evs:
+            assert_equal(evs[key], evs_[key])
+    bad_fn = tmp_path / 'bad.c3d'
+    _make_synthetic_c3d(bad_fn)
+    with pytest.raises(GaitDataError):
+        events.detect_trials_events([fns[0], bad_fn], workers=1)
+    detected = events.detect_trials_events([fns[0], bad_fn], on_error='skip')
+    assert detected[1] is None
+
+
+@pytest.mark.slow
+def test_detect_events_benchmark(tmp_path):
+    """Benchmark event detection throughput over c3d trials"""
+    fns, _ = _write_walking_trials(tmp_path, 40)
+    # read the data once, so that the trials are in the trial cache
+    for fn in fns:
+        _detect_trial_events_loop(fn)
+    t0 = time.perf_counter()
+    for fn in fns:
+        _detect_trial_events_loop(fn)
+    t_ref = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    for fn in fns:
+        utils.automark_events(fn, mark=False)
+    t_serial = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    events.detect_trials_events(fns, workers=4)
+    t_pool = time.perf_counter() - t0
+    # the strike/swing check for a long trial with many candidate strikes
+    rng = np.random.default_rng(0)
+    footctrv = rng.uniform(0, 10, size=100000)
+    strikes = np.sort(rng.choice(100000, size=5000, replace=False))
+    t0 = time.perf_counter()
+    _swing_ok_loop(footctrv, strikes, 9.999)
+    t_loop = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    events._swing_ok(footctrv, strikes, 9.999)
+    t_vec = time.perf_counter() - t0
+    logger.warning(
+        'reference implementation: %.1f trials/s, engine: %.1f trials/s, '
+        'engine with 4 workers: %.1f trials/s; swing check loop: %.1f ms, '
+        'vectorized: %.2f ms'
+        % (
+            len(fns) / t_ref,
+            len(fns) / t_serial,
+            len(fns) / t_pool,
+            t_loop * 1e3,
+            t_vec * 1e3,
+        )
+    )
@@ -10,10 +10,16 @@ import pytest
 import numpy as np
 from numpy.testing import assert_allclose
 from shutil import copyfile
+import json
+import datetime
+import os
+import os.path as op
 import logging
+from ulstools.num import age_from_hetu
 
-from gaitutils import normaldata, models
-from utils import _file_path
+from gaitutils import normaldata, models, cfg
+from gaitutils.config import cfg_template_fn
+from utils import _file_path, _make_synthetic_c3d
 
 
 logger = logging.getLogger(__name__)
@@ -56,3 +62,86 @@ def test_write_normaldata():
         'ForeFootAnglesZ',
     }
     assert set(pigvars) - set(ndata_vars) == not_in_normal
+
+
+def test_write_gcd(tmp_path):
+    """Test read/write cycle for GCD normaldata"""
+    fn = op.join(op.dirname(cfg_template_fn), 'normal.gcd')
+    ndata = normaldata._read_gcd(fn)
+    outfn = str(tmp_path / 'test.gcd')
+    normaldata._write_gcd(ndata, outfn)
+    ndata2 = normaldata._read_gcd(outfn)
+    assert ndata2.keys() == ndata.keys()
+    for var in ndata:
+        assert_allclose(ndata2[var], ndata[var], atol=1e-5)
+
+
+def test_build_normaldata(tmp_path, monkeypatch):
+    """Test building normal data from sessions"""
+    monkeypatch.setattr(cfg.cache, 'use_trial_cache', False)
+    monkeypatch.setattr(
+        cfg.general,
+        'normaldata_age',
+        {(0, 10): 'C:\\normaldata\\young.xlsx', (11, 200): 'old.xlsx'},
+    )
+    events = [
+        ('Foot Strike', 'Right', 0.05),
+        ('Foot Off', 'Right', 0.2),
+        ('Foot Strike', 'Right', 0.25),
+        ('Foot Strike', 'Left', 0.15),
+        ('Foot Off', 'Left', 0.3),
+        ('Foot Strike', 'Left', 0.35),
+    ]
+    rng = np.random.default_rng(0)
+    sessions = list()
+    for k in range(2):
+        session = tmp_path / ('session%d' % k)
+        session.mkdir()
+        lknee = np.round(rng.uniform(-1000, 1000, size=(50, 3)), 1)
+        _make_synthetic_c3d(
+            session / 'trial01.c3d', events=events, markers={'LKneeAngles': lknee}
+        )
+        (session / 'trial01.Trial01.enf').write_text('[TRIAL_INFO]\nTYPE=Dynamic\n')
+        (session / 'trial01.x1d').write_text('')
+        sessions.append(str(session))
+    info = {'fullname': None, 'hetu': '010110A1230', 'session_description': None}
+    (tmp_path / 'session0' / 'patient_info.json').write_text(json.dumps(info))
+    # the patient was 5 years old at the session, but is older today
+    session_t = datetime.datetime(2015, 6, 1).timestamp()
+    os.utime(tmp_path / 'session0' / 'trial01.x1d', (session_t, session_t))
+    assert age_from_hetu(info['hetu']) > 10
+    destdir = tmp_path / 'out'
+    destdir.mkdir()
+    ndata = normaldata.build_normaldata(sessions, str(destdir), workers=1)
+    assert set(ndata.keys()) == {None, (0, 10)}
+    assert ndata[None]['KneeAnglesX'].shape == (51, 2)
+    # the age specific data is from the first session only
+    assert not np.allclose(ndata[None]['KneeAnglesX'], ndata[(0, 10)]['KneeAnglesX'])
+    for name, key in [('normaldata', None), ('young', (0, 10))]:
+        for ext in ['.xlsx', '.gcd']:
+            fn = str(destdir / (name + ext))
+            ndata_ = normaldata._read_model_normaldata_file(fn)
+            assert_allclose(
+                ndata_['KneeAnglesX'], ndata[key]['KneeAnglesX'], atol=1e-5
+            )
+    assert len(list((destdir / '.checkpoints').iterdir())) == 2
+    # a rerun uses the checkpoints
+    monkeypatch.setattr(normaldata.trial, 'Trial', None)
+    ndata2 = normaldata.build_normaldata(sessions, str(destdir), workers=1)
+    assert_allclose(ndata2[None]['KneeAnglesX'], ndata[None]['KneeAnglesX'])
+
+
+def test_session_age(tmp_path):
+    """Test that the patient age is computed at the session date"""
+    session = tmp_path / 'session'
+    session.mkdir()
+    (session / 'trial01.Trial01.enf').write_text('[TRIAL_INFO]\nTYPE=Dynamic\n')
+    assert normaldata._session_age(str(session)) is None  # no patient info
+    info = {'fullname': None, 'hetu': '010110A1230', 'session_description': None}
+    (session / 'patient_info.json').write_text(json.dumps(info))
+    assert normaldata._session_age(str(session)) is None  # no session date
+    x1d = session / 'trial01.x1d'
+    x1d.write_text('')
+    session_t = datetime.datetime(2015, 6, 1).timestamp()
+    os.utime(x1d, (session_t, session_t))
+    assert normaldata._session_age(str(session)) == 5
@@ -11,8 +11,8 @@ from numpy.testing import assert_allclose, assert_equal
 import pytest
 import logging
 
-from gaitutils import sessionutils, stats, models
-from utils import _trial_path, _c3d_path, _file_path, cfg
+from gaitutils import sessionutils, stats, models, numutils
+from utils import _trial_path, _c3d_path, _file_path, _make_synthetic_c3d, cfg
 
 
 logger = logging.getLogger(__name__)
@@ -154,6 +154,63 @@ def test_avgtrial():
     assert len(cycs) == 2
 
 
+def test_average_tensor():
+    """Test that tensor averaging matches per-variable computation"""
+    rng = np.random.default_rng(0)
+    data = dict()
+    for var, n in [('RKneeAnglesX', 12), ('LKneeAnglesX', 5), ('RHipAnglesX', 20)]:
+        data[var] = rng.standard_normal((n, 101))
+        data[var][rng.integers(n)] += 20  # outlier
+    data['RHipAnglesX'][3, 50] = np.nan
+    data['LHipAnglesX'] = None
+    avgdata, stddata, ncycles_ok = stats.average_model_data(
+        data, reject_zeros=False, reject_outliers=1e-3
+    )
+    assert list(avgdata.keys()) == list(data.keys())
+    assert avgdata['LHipAnglesX'] is None and ncycles_ok['LHipAnglesX'] == 0
+    for var in ['RKneeAnglesX', 'LKneeAnglesX', 'RHipAnglesX']:
+        vardata = stats._robust_reject_rows(data[var], 1e-3)
+        assert ncycles_ok[var] == len(vardata) < len(data[var])
+        assert_equal(avgdata[var], vardata.mean(axis=0))
+        assert_equal(stddata[var], vardata.std(axis=0))
+    avgdata, stddata, _ = stats.average_analog_data(data, use_medians=True)
+    for var in ['RKneeAnglesX', 'LKneeAnglesX', 'RHipAnglesX']:
+        assert_equal(avgdata[var], np.median(data[var], axis=0))
+        assert_equal(stddata[var], numutils.mad(data[var], axis=0))
+
+
+def test_compare_curves():
+    """Test the cluster permutation test"""
+    rng = np.random.default_rng(0)
+    data_a = rng.standard_normal((12, 101))
+    data_b = rng.standard_normal((15, 101))
+    data_b[:, 40:60] += 1.5
+    res = stats.compare_curves(data_a, data_b, n_perm=500, batch_size=64, seed=1)
+    t_ref = (data_a.mean(0) - data_b.mean(0)) / np.sqrt(
+        (11 * data_a.var(0, ddof=1) + 14 * data_b.var(0, ddof=1))
+        / 25
+        * (1 / 12 + 1 / 15)
+    )
+    assert_allclose(res['t'], t_ref)
+    assert len(res['null_max_mass']) == 500
+    assert (40, 60) in res['clusters']
+    assert res['significant'][40:60].all() and res['significant'].sum() == 20
+    # results should not depend on batching over workers
+    res_ = stats.compare_curves(
+        data_a, data_b, n_perm=500, batch_size=64, seed=1, workers=2
+    )
+    assert_equal(res_['null_max_mass'], res['null_max_mass'])
+    # dict input, as from collect_trial_data()
+    res = stats.compare_curves(
+        {'RKneeAnglesX': data_a, 'LKneeAnglesX': None},
+        {'RKneeAnglesX': data_b, 'LKneeAnglesX': data_b},
+        n_perm=100,
+    )
+    assert list(res.keys()) == ['RKneeAnglesX']
+    with pytest.raises(ValueError):
+        stats.compare_curves(data_a, data_b[:, :50])
+
+
 def test_curve_extract_values():
     """Test extraction of curve values"""
     # make a fake gait curve
@@ -185,6 +242,35 @@ def test_curve_extract_values():
     }
 
 
+def test_curve_extract_table():
+    """Test vectorized curve value extraction against per-curve computation"""
+    rng = np.random.default_rng(0)
+    # integer values give plenty of flat peaks
+    curves = rng.integers(0, 4, size=(50, 101)).astype(float)
+    curves[rng.random(curves.shape) < 0.02] = np.nan
+    toeoffs = rng.integers(1, 101, size=50)
+    table = stats.curve_extract_table(curves, toeoffs)
+    assert len(table) == 50
+    for curve, toeoff, row in zip(curves, toeoffs, table):
+        swing = curve[toeoff:]
+        with np.errstate(invalid='ignore'):
+            assert_equal(row['extrema_swing_min'], swing.min())
+        assert row['extrema_swing_argmin'] == swing.argmin() + toeoff
+        for phase, data, offset in [
+            ('overall', curve, 0),
+            ('stance', curve[:toeoff], 0),
+            ('swing', swing, toeoff),
+        ]:
+            ind, val = numutils._get_local_max(data)
+            assert_equal(row['peaks_%s_argmax' % phase], ind + offset)
+            assert_equal(row['peaks_%s_max' % phase], val)
+            ind, val = numutils._get_local_min(data)
+            assert_equal(row['peaks_%s_argmin' % phase], ind + offset)
+            assert_equal(row['peaks_%s_min' % phase], val)
+    with pytest.raises(ValueError):
+        stats.curve_extract_table(curves, np.zeros(50))
+
+
 def test_trials_extract_values():
     """Test curve value extraction from trials"""
     c3ds = sessionutils.get_c3ds(sessiondir_abs, trial_type='dynamic')
@@ -194,3 +280,112 @@ def test_trials_extract_values():
         ['ForeFootAnglesX', 'ForeFootAnglesY', 'ForeFootAnglesZ']
     )
     assert set(extr_vals.keys()) == (set(models.pig_lowerbody.varnames) - set(forefoot))
+
+
+def test_cycle_tensor(tmp_path, monkeypatch):
+    """Test collection of data into CycleTensor"""
+    monkeypatch.setattr(cfg.cache, 'use_trial_cache', False)
+    events = [
+        ('Foot Strike', 'Right', 0.05),
+        ('Foot Off', 'Right', 0.2),
+        ('Foot Strike', 'Right', 0.25),
+        ('Foot Off', 'Right', 0.4),
+        ('Foot Strike', 'Right', 0.45),
+        ('Foot Strike', 'Left', 0.15),
+        ('Foot Off', 'Left', 0.3),
+        ('Foot Strike', 'Left', 0.35),
+    ]
+    c3ds = list()
+    for k in range(3):
+        fn = tmp_path / ('trial%d.c3d' % k)
+        _make_synthetic_c3d(fn, events=events)
+        c3ds.append(fn)
+    tensors = stats.collect_cycle_tensors(c3ds, collect_types=['model', 'emg'])
+    ct = tensors['model']
+    assert ct.varnames == ['RKneeAnglesX', 'RKneeAnglesY', 'RKneeAnglesZ']
+    # 3 cycles per trial, 2 of them right side
+    assert len(ct.cycles) == 9
+    assert ct.data['RKneeAnglesX'].shape == (6, 101)
+    meta = ct.meta('RKneeAnglesX')
+    assert_equal(meta['trial_id'], [0, 0, 1, 1, 2, 2])
+    assert_equal(meta['context'], ['R'] * 6)
+    assert_equal(meta['cycle_index'], [1, 2] * 3)
+    groups = ct.groupby('trial_id')
+    assert list(groups.keys()) == [0, 1, 2]
+    assert_equal(groups[1].data['RKneeAnglesX'], ct.data['RKneeAnglesX'][2:4])
+    ct_first = ct.filter(cycle_index=1, trial_id=[0, 2])
+    assert ct_first.data['RKneeAnglesX'].shape == (2, 101)
+    assert not ct.filter(context='L').varnames
+    # EMG channels are collected for matching contexts
+    ct_emg = tensors['emg']
+    assert ct_emg.data['LGas'].shape == (3, 1000)
+    assert_equal(ct_emg.meta('LGas')['context'], ['L'] * 3)
+    # compatibility with dict output
+    data_all, cycles_all = stats.collect_trial_data(c3ds, collect_types=['model'])
+    assert_equal(data_all['model']['RKneeAnglesX'], ct.data['RKneeAnglesX'])
+    assert data_all['model']['LKneeAnglesX'] is None
+    cycles = cycles_all['model']['RKneeAnglesX']
+    assert [cyc.context for cyc in cycles] == ['R'] * 6
+    assert cycles[0].trial is not cycles[2].trial
+
+
+def test_avgtrial_accumulator(tmp_path):
+    """Test incremental averaging"""
+    rng = np.random.default_rng(0)
+    data = rng.standard_normal((40, 101)) + 10
+    data[5, 20] = 0  # rejected as a gap
+    data[7] += 30  # outlier
+    emgdata = rng.uniform(size=(20, 1000))
+    for reject_outliers, use_medians in [(None, False), (None, True), (1e-3, False)]:
+        accs = list()
+        for k in range(2):
+            acc = stats.AvgTrialAccumulator(
+                reject_outliers=reject_outliers,
+                use_medians=use_medians,
+                spill_dir=tmp_path,
+            )
+            for curve in data[k::2]:
+                acc.add_cycle('RKneeAnglesX', curve)
+            acc.add_cycle('LGas', emgdata[k::2], var_type='emg')
+            acc.nfiles = 1
+            accs.append(acc)
+        accs[0].merge(accs[1])
+        avgtrial = accs[0].finalize()
+        assert avgtrial.nfiles == 2
+        # compare against averaging of all data in memory
+        order = np.r_[0:40:2, 1:40:2]
+        avg, std, _ = stats.average_model_data(
+            {'RKneeAnglesX': data[order]},
+            reject_outliers=reject_outliers,
+            use_medians=use_medians,
+        )
+        avg_emg, std_emg, _ = stats.average_analog_data(
+            {'LGas': emgdata[np.r_[0:20:2, 1:20:2]]},
+            reject_outliers=reject_outliers,
+            use_medians=use_medians,
+        )
+        assert_allclose(avgtrial.get_model_data('RKneeAnglesX')[1], avg['RKneeAnglesX'])
+        assert_allclose(avgtrial.stddev_data['RKneeAnglesX'], std['RKneeAnglesX'])
+        _, avg_emg_ = avgtrial.get_emg_data('LGas', envelope=True)
+        assert_allclose(avg_emg_, avg_emg['LGas'])
+        for acc in accs:
+            acc.close()
+    assert not list(tmp_path.iterdir())
+    # add whole trials
+    events = [
+        ('Foot Strike', 'Right', 0.05),
+        ('Foot Off', 'Right', 0.2),
+        ('Foot Strike', 'Right', 0.25),
+        ('Foot Off', 'Right', 0.4),
+        ('Foot Strike', 'Right', 0.45),
+    ]
+    fn = tmp_path / 'trial.c3d'
+    _make_synthetic_c3d(fn, events=events)
+    acc = stats.AvgTrialAccumulator()
+    acc.add_trial(fn)
+    acc.add_trial(fn)
+    avgtrial = acc.finalize()
+    assert avgtrial.nfiles == 2
+    ct = stats.collect_cycle_tensors([fn], collect_types=['model'])['model']
+    avg = ct.data['RKneeAnglesX'].mean(axis=0)
+    assert_allclose(avgtrial.get_model_data('RKneeAnglesX')[1], avg)
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+
+Unit tests for time-distance computations.
+
+@author: jussi (jnu@iki.fi)
+"""
+
+import pytest
+import numpy as np
+from numpy.testing import assert_allclose
+import logging
+
+from gaitutils import timedist, utils, trialcache, GaitDataError
+from gaitutils.utils import TrialEvents
+from utils import _make_synthetic_c3d, _make_walking_markers
+
+
+logger = logging.getLogger(__name__)
+
+
+def _step_width_loop(events, mkrdata):
+    """Reference implementation of step width, copied from the removed
+    loop-based utils._step_width()"""
+    sw = dict()
+    for context, strikes in zip(['L', 'R'], [events.lstrikes, events.rstrikes]):
+        sw[context] = list()
+        nstrikes = len(strikes)
+        if nstrikes < 2:
+            continue
+        # contralateral vars
+        context_co = 'L' if context == 'R' else 'R'
+        strikes_co = events.lstrikes if context == 'R' else events.rstrikes
+        mname = context + 'TOE'
+        mname_co = context_co + 'TOE'
+        for j, strike in enumerate(strikes):
+            if strike == strikes[-1]:  # last strike on this side
+                break
+            pos_this = mkrdata[mname][strike]
+            pos_next = mkrdata[mname][strikes[j + 1]]
+            strikes_next_co = [k for k in strikes_co if k > strike]
+            if len(strikes_next_co) == 0:  # no subsequent contralateral strike
+                break
+            pos_next_co = mkrdata[mname_co][strikes_next_co[0]]
+            # vector along ipsilateral step
+            V1 = pos_next - pos_this
+            V1 /= np.linalg.norm(V1)
+            # vector from ipsilateral to contralateral marker
+            VC = pos_next_co - pos_this
+            # projection of VC onto V1, and the perpendicular component
+            VCP = V1 * np.dot(VC, V1)
+            VSW = VCP - VC
+            sw[context].append(np.linalg.norm(VSW) / 1000.0)
+    return sw
+
+
+def _walking_trial(n_frames=400):
+    """Return events and marker data for a walking trial"""
+    mkrdata, evs = _make_walking_markers(n_frames=n_frames)
+    events = TrialEvents(
+        rstrikes=list(evs['R_strikes']),
+        lstrikes=list(evs['L_strikes']),
+        rtoeoffs=list(evs['R_toeoffs']),
+        ltoeoffs=list(evs['L_toeoffs']),
+    )
+    return events, mkrdata
+
+
+def test_analysis_from_events():
+    """Test time-distance variables against the known walking pattern"""
+    events, mkrdata = _walking_trial()
+    an = timedist.analysis_from_events(events, mkrdata, 100.0, condition='cond')
+    assert list(an) == ['cond']
+    an = an['cond']
+    # speed 1.2 m/s, 1 s cycle, stance 60%, feet 200 mm apart
+    expected = {
+        'Cadence': 120,
+        'Walking Speed': 1.2,
+        'Stride Time': 1,
+        'Step Time': 0.5,
+        'Stride Length': 1.2,
+        'Step Length': 0.6,
+        'Step Width': 0.2,
+        'Foot Off': 60,
+        'Opposite Foot Off': 10,
+        'Opposite Foot Contact': 50,
+        'Single Support': 0.4,
+        'Double Support': 0.2,
+    }
+    assert set(an) == set(expected)
+    for var, val in expected.items():
+        assert an[var]['unit'] == timedist._analysis_units[var]
+        for context in ('Right', 'Left'):
+            assert_allclose(an[var][context], val, rtol=0.02)
+    # no cycles for one side; missing markers
+    events.lstrikes = events.lstrikes[:1]
+    del mkrdata['RHEE']
+    an = timedist.analysis_from_events(events, mkrdata, 100.0)['unknown']
+    assert np.isnan(an['Cadence']['Left'])
+    assert np.isnan(an['Step Length']['Right'])
+    assert_allclose(an['Cadence']['Right'], 120)
+
+
+def test_step_width():
+    """Test the vectorized step width against a loop"""
+    events, mkrdata = _walking_trial()
+    rng = np.random.default_rng(0)
+    for marker in mkrdata:
+        mkrdata[marker] += rng.normal(scale=20, size=mkrdata[marker].shape)
+    sw = timedist._compute_trials([timedist._trial_cycles(events, mkrdata, 100.0)])
+    sw_loop = _step_width_loop(events, mkrdata)
+    assert_allclose(sw[0]['Step Width']['Right'], np.mean(sw_loop['R']))
+    assert_allclose(sw[0]['Step Width']['Left'], np.mean(sw_loop['L']))
+    # a missing contralateral strike: the next one is used, even if it falls
+    # after the end of the cycle
+    del events.lstrikes[1]
+    cycles = timedist._trial_cycles(events, mkrdata, 100.0)
+    sw_loop = _step_width_loop(events, mkrdata)
+    for context in ('R', 'L'):
+        sw_ = timedist._compute_cycles(cycles[context])['Step Width']
+        assert_allclose(sw_[~np.isnan(sw_)], sw_loop[context])
+
+
+def test_trials_analysis(tmp_path, monkeypatch):
+    """Test batched time-distance computation for c3d files"""
+    monkeypatch.setattr(utils.cfg.cache, 'use_trial_cache', True)
+    mkrdata, evs = _make_walking_markers(n_frames=300)
+    labels = {'strikes': 'Foot Strike', 'toeoffs': 'Foot Off'}
+    contexts = {'R': 'Right', 'L': 'Left'}
+    c3d_events = [
+        (labels[key[2:]], contexts[key[0]], fr / 100.0)
+        for key, frames in evs.items()
+        for fr in frames
+    ]
+    fns = list()
+    for k in range(3):
+        fn = tmp_path / ('walk%d.c3d' % k)
+        _make_synthetic_c3d(fn, n_frames=300, events=c3d_events, markers=mkrdata)
+        fns.append(str(fn))
+    ans = timedist.trials_analysis(fns, condition='cond')
+    events, _ = _walking_trial(n_frames=300)
+    an_ = timedist.analysis_from_events(events, mkrdata, 100.0, condition='cond')
+    for an in ans:
+        for var in an_['cond']:
+            assert_allclose(
+                an['cond'][var]['Right'], an_['cond'][var]['Right'], rtol=1e-6
+            )
+    # results are cached
+    assert trialcache.is_cached(fns[0], 'analysis', timedist._CACHE_SUBKIND)
+    assert timedist.trials_analysis(fns[:1]) == timedist.trials_analysis(fns[:1])
+    # the grouped values do not need Nexus analysis values
+    res_avg, res_std = timedist._group_analysis_trials({'a': fns[:2], 'b': fns[2:]})
+    assert list(res_avg) == ['a', 'b']
+    assert_allclose(res_avg['a']['Walking Speed']['Left'], 1.2, rtol=0.02)
+    assert_allclose(res_std['a']['Walking Speed']['Left'], 0, atol=1e-9)
+    bad_fn = tmp_path / 'nonexistent.c3d'
+    with pytest.raises(GaitDataError):
+        timedist.trials_analysis([fns[0], bad_fn])
+    ans = timedist.trials_analysis([fns[0], bad_fn], on_error='skip')
+    assert ans[1] is None
@@ -6,15 +6,20 @@ Test trial related functionality
 @author: jussi (jnu@iki.fi)
 """
 
+from collections import defaultdict
+import pickle
 import pytest
 import numpy as np
 from numpy.testing import assert_allclose, assert_equal
 import logging
 
-from gaitutils import models
-from gaitutils.trial import Trial
+from gaitutils import models, utils, read_data, c3d_numpy
+from gaitutils.emg import EMG
+from gaitutils.envutils import GaitDataError
+from gaitutils.trial import Trial, Gaitcycle, load_trials
+from gaitutils.trial import _run_in_pool, _check_errors
 from gaitutils.utils import _pig_markerset
-from utils import _trial_path, _c3d_path, _file_path, cfg
+from utils import _trial_path, _c3d_path, _file_path, _make_synthetic_c3d, cfg
 
 
 logger = logging.getLogger(__name__)
@@ -125,3 +130,237 @@ def test_trial_data_read():
             )
             assert_allclose(data[:15], data_truth)
     # read EMG data
+
+
+def test_trial_lazy_fp_events(tmp_path, monkeypatch):
+    """Test lazy detection of forceplate events"""
+    fn = tmp_path / 'synthetic.c3d'
+    events = [
+        ('Foot Strike', 'Right', 0.05),
+        ('Foot Off', 'Right', 0.2),
+        ('Foot Strike', 'Right', 0.25),
+        ('Foot Strike', 'Left', 0.15),
+        ('Foot Off', 'Left', 0.3),
+        ('Foot Strike', 'Left', 0.35),
+    ]
+    _make_synthetic_c3d(fn, events=events)
+    ndetects = list()
+
+    def _fake_detect(source, fp_info=None):
+        ndetects.append(source)
+        fpev = utils._empty_fp_events()
+        fpev['R_strikes'] = [6]  # not exactly at cycle start (5)
+        fpev['R_strikes_plate'] = [0]
+        return fpev
+
+    monkeypatch.setattr(utils, 'detect_forceplate_events', _fake_detect)
+    tr = Trial(fn, detect_fp_events='lazy')
+    assert not ndetects
+    assert tr.ncycles == 2
+    cyc_r = tr.get_cycles({'R': 'all'})[0]
+    assert cyc_r.start == 5 and cyc_r.context == 'R'
+    assert cyc_r.on_forceplate
+    assert cyc_r.plate_idx == 0
+    assert cyc_r.name == 'right1 (f)'
+    assert len(ndetects) == 1
+    cyc_l = tr.get_cycles({'L': 'all'})[0]
+    assert not cyc_l.on_forceplate
+    assert cyc_l.plate_idx is None
+    assert cyc_l.name == 'left1'
+    assert len(ndetects) == 1
+    # setting the events should update the cycles
+    tr.fp_events = utils._empty_fp_events()
+    assert not cyc_r.on_forceplate
+    # eager detection
+    tr = Trial(fn, detect_fp_events='eager')
+    assert len(ndetects) == 2
+    assert len(tr.get_cycles('forceplate')) == 1
+    # no detection
+    tr = Trial(fn, detect_fp_events='never')
+    assert not tr.get_cycles('forceplate')
+    assert len(ndetects) == 2
+    with pytest.raises(ValueError):
+        Trial(fn, detect_fp_events='foo')
+
+
+def test_trial_source_context(tmp_path, monkeypatch):
+    """Test that the trial data is read only once via the shared context"""
+    fn = tmp_path / 'synthetic.c3d'
+    _make_synthetic_c3d(fn)
+    monkeypatch.setattr(cfg.cache, 'use_trial_cache', False)
+    monkeypatch.setattr(cfg.general, 'c3d_reader', 'numpy')
+    nreads = defaultdict(int)
+
+    def _counted(fun):
+        def _wrapper(*args, **kwargs):
+            nreads[fun.__name__] += 1
+            return fun(*args, **kwargs)
+
+        return _wrapper
+
+    for fun in [
+        '_get_metadata',
+        '_get_emg_data',
+        '_get_model_data',
+        '_get_forceplate_data',
+    ]:
+        monkeypatch.setattr(c3d_numpy, fun, _counted(getattr(c3d_numpy, fun)))
+    tr = Trial(fn)
+    tr.get_emg_data('LGas')
+    tr.get_model_data('RKneeAnglesX')
+    tr.get_forceplate_data(0)
+    tr.fp_events  # reads metadata, forceplate and marker data
+    # other users of the context should not cause new reads
+    assert EMG(tr.ctx).data.keys() == tr.emg.data.keys()
+    modeldata = read_data.get_model_data(tr.ctx, models.pig_lowerbody)
+    assert_equal(modeldata['RKneeAnglesX'], tr.get_model_data('RKneeAnglesX')[1])
+    assert read_data.get_metadata(tr.ctx)['events'].rstrikes == [6]
+    assert tr.events.rstrikes == [5]  # offset subtracted from a copy
+    assert Trial(tr.ctx).ncycles == tr.ncycles
+    assert dict(nreads) == {
+        '_get_metadata': 1,
+        '_get_emg_data': 1,
+        '_get_model_data': 1,
+        '_get_forceplate_data': 1,
+    }
+    # markers are read only once, also the missing ones
+    mkrdata = read_data.get_marker_data(tr.ctx, ['RHEE', 'RTOE'], ignore_missing=True)
+    assert list(mkrdata.keys()) == ['RHEE']
+    monkeypatch.setattr(c3d_numpy, '_get_marker_data', _counted(lambda *args: {}))
+    read_data.get_marker_data(tr.ctx, ['RHEE', 'RTOE'], ignore_missing=True)
+    assert '<lambda>' not in nreads
+    with pytest.raises(GaitDataError):
+        read_data.get_marker_data(tr.ctx, 'RTOE')
+
+
+@pytest.mark.parametrize(
+    'backend, use_cache', [('thread', True), ('process', True), ('process', False)]
+)
+def test_load_trials(tmp_path, monkeypatch, backend, use_cache):
+    """Test parallel loading of trials"""
+    monkeypatch.setattr(cfg.cache, 'use_trial_cache', use_cache)
+    monkeypatch.setattr(cfg.cache, 'trial_cache_dir', str(tmp_path / 'cache'))
+    fns = list()
+    for k in range(4):
+        fn = tmp_path / ('trial%d.c3d' % k)
+        _make_synthetic_c3d(fn, n_frames=50 + k)
+        fns.append(fn)
+    bad_fn = tmp_path / 'bad.c3d'
+    bad_fn.write_bytes(b'not a c3d file')
+    progress = list()
+
+    class _Signals:
+        canceled = False
+
+        class progress:
+            emit = staticmethod(lambda msg, pct: progress.append(pct))
+
+    trials = load_trials(
+        fns + [bad_fn], workers=2, backend=backend, signals=_Signals, on_error='skip'
+    )
+    assert [tr.length for tr in trials[:-1]] == [50, 51, 52, 53]
+    assert trials[-1] is None
+    assert progress == sorted(progress) and progress[-1] == 100
+    with pytest.raises(GaitDataError, match='bad.c3d'):
+        load_trials(fns + [bad_fn], workers=2, backend=backend)
+    # second round is loaded from the cache
+    trials = load_trials(fns, workers=2, backend=backend)
+    assert [tr.length for tr in trials] == [50, 51, 52, 53]
+    _Signals.canceled = True
+    assert load_trials(fns, workers=2, backend=backend, signals=_Signals) is None
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_run_in_pool(workers):
+    """Test the process pool helper for batch operations"""
+    progress = list()
+
+    class _Signals:
+        canceled = False
+
+        class progress:
+            emit = staticmethod(lambda msg, pct: progress.append((msg, pct)))
+
+    items = [('1.5',), ('x',), ('3',)]
+    results, errors = _run_in_pool(float, items, workers, _Signals, 'Reading')
+    assert results == [1.5, None, 3.0]
+    assert list(errors) == [1] and isinstance(errors[1], ValueError)
+    assert {msg for msg, _ in progress} == {'Reading: 1.5', 'Reading: x', 'Reading: 3'}
+    assert [pct for _, pct in progress] == [33, 66, 100]
+    _check_errors({'x': errors[1]}, 'skip', 'Could not read')
+    with pytest.raises(GaitDataError, match='Could not read:\nx: could not'):
+        _check_errors({'x': errors[1]}, 'raise', 'Could not read')
+    _Signals.canceled = True
+    assert _run_in_pool(float, items, workers, _Signals) is None
+
+
+def test_trial_serialization(tmp_path, monkeypatch):
+    """Test pickling and to_bytes() / from_bytes()"""
+    fn = tmp_path / 'synthetic.c3d'
+    events = [
+        ('Foot Strike', 'Right', 0.05),
+        ('Foot Off', 'Right', 0.2),
+        ('Foot Strike', 'Right', 0.25),
+    ]
+    points = _make_synthetic_c3d(fn, events=events)[0]
+    monkeypatch.setattr(cfg.cache, 'use_trial_cache', False)
+    tr = Trial(fn)
+    emgdata = tr.get_emg_data('LGas')[1]
+    for tr_ in [pickle.loads(pickle.dumps(tr)), Trial.from_bytes(tr.to_bytes())]:
+        assert tr_.trialname == tr.trialname
+        assert tr_.eclipse_data['nonexistent'] == ''
+        assert tr_.subj_params['nonexistent'] is None
+        assert_allclose(tr_.subj_params['Bodymass'], 70.0)
+        assert tr_.ncycles == tr.ncycles
+        assert tr_.cycles[0].trial is tr_
+        assert_equal(tr_.cycles[0].tn_analog, tr.cycles[0].tn_analog)
+        # the data already read is included, the rest is read lazily
+        assert tr_.emg.source is tr_.ctx
+        assert_equal(tr_.get_emg_data('LGas')[1], emgdata)
+        assert_allclose(tr_.get_marker_data('LHEE')[1], points[:, 1, :], atol=1e-3)
+    # arrays should be views into the serialized data
+    data = bytearray(tr.to_bytes())
+    tr_ = Trial.from_bytes(data)
+    data_emg = tr_.emg.data['Voltage.LGas']
+    assert np.shares_memory(data_emg, np.frombuffer(data, dtype=np.uint8))
+    emg = EMG.from_bytes(tr.emg.to_bytes())
+    assert_equal(emg.data['Voltage.LGas'], tr.emg.data['Voltage.LGas'])
+    with pytest.raises(TypeError):
+        EMG.from_bytes(tr.to_bytes())
+    with pytest.raises(ValueError):
+        Trial.from_bytes(b'foo' * 10)
+
+
+def test_cycle_normalization(tmp_path, monkeypatch):
+    """Test cycle normalization and normalize_all()"""
+    # compare against np.interp, also with nans in data
+    data = np.random.randn(200, 3)
+    data[30, 1] = np.nan
+    for start, end in [(10, 12), (10, 60), (20, 157)]:
+        cyc = Gaitcycle(start, end, (start + end) // 2, 'R', True, 0, 10)
+        data_interp = np.array(
+            [np.interp(cyc.tn, cyc.t, data[start:end, k]) for k in range(3)]
+        ).T
+        tn, data_norm = cyc.normalize(data)
+        assert_equal(tn, cyc.tn)
+        assert_allclose(data_norm, data_interp, rtol=1e-12, atol=1e-12)
+        assert_allclose(cyc.normalize(data[:, 0])[1], data_interp[:, 0])
+    fn = tmp_path / 'synthetic.c3d'
+    events = [
+        ('Foot Strike', 'Right', 0.05),
+        ('Foot Strike', 'Right', 0.25),
+        ('Foot Off', 'Right', 0.2),
+        ('Foot Strike', 'Right', 0.45),
+        ('Foot Off', 'Right', 0.4),
+    ]
+    _make_synthetic_c3d(fn, events=events)
+    monkeypatch.setattr(cfg.cache, 'use_trial_cache', False)
+    tr = Trial(fn)
+    assert tr.ncycles == 2
+    varnames = ['RKneeAnglesX', 'RKneeAnglesZ']
+    ndata = tr.normalize_all(varnames)
+    assert ndata.shape == (2, 2, 101)
+    for k, cycle in enumerate(tr.cycles):
+        for j, var in enumerate(varnames):
+            assert_allclose(ndata[k, j, :], tr.get_model_data(var, cycle=cycle)[1])
+    assert tr.normalize_all(varnames, cycles=[]).shape == (0, 2, 101)
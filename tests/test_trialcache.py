@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+
+Unit tests for the persistent trial cache.
+
+@author: jussi (jnu@iki.fi)
+"""
+
+import pytest
+import numpy as np
+from numpy.testing import assert_equal
+import logging
+
+from gaitutils import trialcache, read_data
+from gaitutils.envutils import GaitDataError
+from gaitutils.utils import TrialEvents
+from utils import cfg, _make_synthetic_c3d
+
+
+logger = logging.getLogger(__name__)
+
+
+@pytest.fixture
+def fake_c3d(tmp_path):
+    """A dummy file that stands in for a c3d file"""
+    fn = tmp_path / 'session' / 'trial01.c3d'
+    fn.parent.mkdir()
+    fn.write_bytes(b'dummy')
+    cfg.cache.use_trial_cache = True
+    cfg.cache.trial_cache_dir = None
+    yield fn
+    trialcache.clear(fn)
+
+
+def test_trialcache_arrays(fake_c3d):
+    """Test roundtrip of array data"""
+    assert trialcache.load(fake_c3d, 'markers') is None
+    mkrdata = {'RHEE': np.random.randn(100, 3), 'LHEE': np.random.randn(100, 3)}
+    trialcache.store(fake_c3d, 'markers', mkrdata)
+    assert (fake_c3d.parent / '.gaitcache' / 'trial01').is_dir()
+    mkrdata_ = trialcache.load(fake_c3d, 'markers')
+    assert mkrdata_.keys() == mkrdata.keys()
+    for mkr in mkrdata:
+        assert_equal(mkrdata_[mkr], mkrdata[mkr])
+        # should be a read-only view into the mapped buffer
+        assert not mkrdata_[mkr].flags.writeable
+    fpdata = [{'F': np.ones((10, 3)), 'Ftot': np.ones(10)}, {'F': np.zeros((10, 3))}]
+    trialcache.store(fake_c3d, 'forceplate', fpdata)
+    fpdata_ = trialcache.load(fake_c3d, 'forceplate')
+    assert len(fpdata_) == 2
+    assert_equal(fpdata_[0]['Ftot'], fpdata[0]['Ftot'])
+    assert_equal(fpdata_[1]['F'], fpdata[1]['F'])
+    emgdata = {'t': np.arange(10) / 1000.0, 'data': {'Voltage.LGas': np.ones(10)}}
+    trialcache.store(fake_c3d, 'emg', emgdata)
+    emgdata_ = trialcache.load(fake_c3d, 'emg')
+    assert_equal(emgdata_['t'], emgdata['t'])
+    assert list(emgdata_['data'].keys()) == ['Voltage.LGas']
+    # read via read_data; should not need btk
+    mkrdata_ = read_data.get_marker_data(fake_c3d, 'RHEE')
+    assert_equal(mkrdata_['RHEE'], mkrdata['RHEE'])
+    with pytest.raises(GaitDataError):
+        read_data.get_marker_data(fake_c3d, ['RHEE', 'RTOE'])
+    assert 'RTOE' not in read_data.get_marker_data(
+        fake_c3d, ['RHEE', 'RTOE'], ignore_missing=True
+    )
+
+
+def test_trialcache_metadata(fake_c3d):
+    """Test roundtrip of metadata"""
+    events = TrialEvents(rstrikes=[10, 120], ltoeoffs=[50])
+    meta = {
+        'trialname': 'trial01',
+        'framerate': 100.0,
+        'subj_params': {'Bodymass': 70.0},
+        'events': events,
+        'markers': ['RHEE'],
+    }
+    trialcache.store(fake_c3d, 'metadata', meta)
+    meta_ = read_data.get_metadata(fake_c3d)
+    assert meta_['events'].rstrikes == [10, 120]
+    assert meta_['events'].ltoeoffs == [50]
+    assert meta_['subj_params']['Bodymass'] == 70.0
+    assert meta_['subj_params']['nonexistent'] is None
+    # each load should return new event objects
+    meta_['events'].subtract_offset(10)
+    assert read_data.get_metadata(fake_c3d)['events'].rstrikes == [10, 120]
+
+
+def test_trialcache_invalidation(fake_c3d):
+    """Test cache invalidation and caching of errors"""
+    trialcache.store(fake_c3d, 'emg', GaitDataError('no EMG'))
+    with pytest.raises(GaitDataError):
+        trialcache.load(fake_c3d, 'emg')
+    trialcache.store(fake_c3d, 'markers', {'RHEE': np.zeros((10, 3))})
+    assert trialcache.load(fake_c3d, 'markers') is not None
+    fake_c3d.write_bytes(b'modified')
+    assert trialcache.load(fake_c3d, 'markers') is None
+    cfg.cache.use_trial_cache = False
+    trialcache.store(fake_c3d, 'markers', {'RHEE': np.zeros((10, 3))})
+    assert trialcache.load(fake_c3d, 'markers') is None
+    cfg.cache.use_trial_cache = True
+
+
+def test_trialcache_json_errors(fake_c3d, tmp_path):
+    """Test caching of errors for JSON data"""
+    trialcache.store(fake_c3d, 'metadata', GaitDataError('no metadata'))
+    with pytest.raises(GaitDataError):
+        trialcache.load(fake_c3d, 'metadata')
+    # c3d without an ANALYSIS group; the cached error must be raised again
+    fn = tmp_path / 'noanalysis.c3d'
+    _make_synthetic_c3d(fn)
+    for _ in range(2):
+        with pytest.raises(GaitDataError):
+            read_data.get_analysis(str(fn))
+    trialcache.clear(fn)
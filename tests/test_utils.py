@@ -15,11 +15,18 @@ from gaitutils.utils import (
     TrialEvents,
     is_plugingait_set,
     _point_in_poly,
+    _points_in_polys,
     _pig_markerset,
     _check_markers_flipped,
     marker_gaps,
+    detect_forceplate_events,
+    rigid_body_extrapolate,
+    avg_markerdata,
+    MarkerSet,
 )
-from utils import _file_path
+from gaitutils import GaitDataError
+from gaitutils.numutils import _rotation_matrix
+from utils import _file_path, _make_synthetic_c3d, _make_walking_markers
 
 
 logger = logging.getLogger(__name__)
@@ -60,6 +67,71 @@ def test_marker_gaps():
     assert 0 in gaps
 
 
+def test_markerset():
+    """Test the MarkerSet container"""
+    rng = np.random.default_rng(0)
+    mkrdata = {marker: rng.standard_normal((100, 3)) for marker in 'ABCD'}
+    mkrdata['A'][40:50, :] = 0
+    mkrdata['B'][:10, :] = 0  # leading gap
+    mkrdata['D'][:] = 0  # no data at all
+    mset = MarkerSet.from_dict(mkrdata)
+    assert MarkerSet.from_dict(mset) is mset
+    assert list(mset) == list('ABCD') and len(mset) == 4 and 'C' in mset
+    assert mset.n_frames == 100
+    assert_allclose(mset['C'], mkrdata['C'])
+    assert not mset['C'].flags.writeable
+    for marker in 'ABC':
+        assert_allclose(mset.gaps(marker), marker_gaps(mkrdata[marker]))
+        assert_allclose(
+            mset.gaps(marker, ignore_edge_gaps=False),
+            marker_gaps(mkrdata[marker], ignore_edge_gaps=False),
+        )
+    assert mset.gaps('D').size == 100
+    assert mset.velocity is mset.velocity
+    assert_allclose(mset.velocity[2], np.gradient(mkrdata['C'], axis=0))
+    assert mset.stack(['C', 'A']).shape == (2, 100, 3)
+    # averaging; dicts are converted to MarkerSets
+    assert_allclose(
+        avg_markerdata(mkrdata, ['B', 'C']), (mkrdata['B'] + mkrdata['C']) / 2
+    )
+    assert_allclose(
+        mset.average(['A', 'B', 'C'], roi=[60, 100], velocity=True),
+        np.mean(mset.velocity[:3], axis=0),
+    )
+    with pytest.raises(GaitDataError):
+        mset.average(['A', 'C'])
+    assert_allclose(mset.average(['A', 'C', 'D'], fail_on_gaps=False), mset['C'])
+    with pytest.raises(GaitDataError):
+        avg_markerdata(mkrdata, ['A', 'D'], fail_on_gaps=False)
+    with pytest.raises(ValueError):
+        MarkerSet(['A'], np.zeros((2, 100, 3)))
+
+
+def test_rigid_body_extrapolate(tmp_path):
+    """Test offline rigid body extrapolation"""
+    rng = np.random.default_rng(0)
+    cluster = np.round(rng.uniform(-100, 100, size=(4, 3)), 1)
+    markers = ['M1', 'M2', 'M3', 'M4']
+    trials = list()
+    for k, n_frames in enumerate([50, 30]):
+        angles = np.linspace(0, 90, n_frames)
+        pos = np.stack(
+            [cluster @ _rotation_matrix(a, a / 2, 0).T + [a, 10 * k, 0] for a in angles]
+        )
+        fn = tmp_path / ('trial%d.c3d' % k)
+        _make_synthetic_c3d(
+            fn, n_frames=n_frames, markers=dict(zip(markers, pos.transpose(1, 0, 2)))
+        )
+        trials.append((fn, pos))
+    res = rigid_body_extrapolate(
+        trials[0][0], [fn for fn, _ in trials], markers[:3], markers[3:], ref_frame=5
+    )
+    assert len(res) == 2
+    for extrap, (_, pos) in zip(res, trials):
+        assert list(extrap.keys()) == ['M4']
+        assert_allclose(extrap['M4'], pos[:, 3, :], atol=1e-2)
+
+
 def test_is_plugingait_set():
     pig = _pig_markerset()
     assert is_plugingait_set(pig)
@@ -100,3 +172,47 @@ def test_point_in_poly():
     assert not _point_in_poly(poly, pt)
     pt = np.array([0.5, 0.5, 0])
     assert _point_in_poly(poly, pt)
+
+
+def test_points_in_polys():
+    """Test batched point-in-polygon against single point checks"""
+    rng = np.random.default_rng(0)
+    # rectangular plates with both vertex orders
+    polys = np.array(
+        [
+            [[500, 600, 0], [0, 600, 0], [0, 0, 0], [500, 0, 0]],
+            [[0, 0, 0], [400, 0, 0], [400, 900, 0], [0, 900, 0]],
+        ],
+        dtype=float,
+    )
+    pts = rng.uniform(-200, 1000, size=(2, 500, 3))
+    inside = _points_in_polys(polys, pts)
+    assert inside.shape == (2, 500)
+    assert inside.any() and not inside.all()
+    for poly, pts_, inside_ in zip(polys, pts, inside):
+        assert list(inside_) == [_point_in_poly(poly, pt) for pt in pts_]
+
+
+def test_detect_forceplate_events_foot_lengths(tmp_path):
+    """Test that each foot is checked against the plate with its own length"""
+    mkrdata, _ = _make_walking_markers(n_frames=300)
+    # the plate spans x = 0..500 and y = 0..600; the left heel is at x = 290
+    # during the stance at frames 150-210, and the right heel at x = -310 at
+    # the previous contralateral strike
+    for marker in mkrdata:
+        mkrdata[marker] += [-1410, 300, 0]
+    fz = np.clip(np.arange(660) / 20, 0, 1) * 400
+    forces = np.zeros((3000, 6))
+    forces[1470:2130, 2] = np.minimum(fz, fz[::-1])
+    for rfootlen, valid in [(200.0, {'L'}), (400.0, set())]:
+        fn = tmp_path / ('footlen%d.c3d' % rfootlen)
+        subj_params = {'RFootLen': rfootlen, 'LFootLen': 200.0}
+        _make_synthetic_c3d(
+            fn, n_frames=300, markers=mkrdata, forces=forces, subj_params=subj_params
+        )
+        fpev = detect_forceplate_events(str(fn))
+        # with the longer right foot, the right toe reaches the plate at the
+        # previous strike, so the contact is not valid
+        assert fpev['valid'] == valid
+        if valid:
+            assert fpev['L_strikes'] == [147] and fpev['L_toeoffs'] == [213]
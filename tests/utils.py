@@ -8,8 +8,10 @@ Utils for unit tests.
 
 import os.path as op
 import os
+import struct
 import subprocess
 import time
+import numpy as np
 
 from gaitutils import nexus, config, cfg
 
@@ -59,3 +61,195 @@ def _trial_path(subject, trial, session=None):
 def _c3d_path(filename):
     """Return path to c3d test file"""
     return op.abspath(op.join(testdata_root, 'test_c3ds', filename))
+
+
+def _param_record(gid, name, value):
+    """Encode a c3d parameter record (Intel format)"""
+    if isinstance(value, str):
+        value = [value]
+    if isinstance(value, list):  # strings
+        strlen = max(len(s) for s in value)
+        dtype, dims = -1, (strlen, len(value))
+        data = b''.join(s.ljust(strlen).encode('latin-1') for s in value)
+    else:
+        value = np.asarray(value)
+        dtype = 2 if np.issubdtype(value.dtype, np.integer) else 4
+        dims = value.shape
+        data = value.astype('<i2' if dtype == 2 else '<f4').ravel(order='F')
+        data = data.tobytes()
+    body = struct.pack('<bB', dtype, len(dims)) + bytes(dims) + data + b'\x00'
+    name = name.encode('latin-1')
+    offset = struct.pack('<h', len(body) + 2)
+    return struct.pack('<bb', len(name), gid) + name + offset + body
+
+
+def _write_c3d(fn, params, points, residuals, analog, spf, rate, scale=-1.0):
+    """Write a minimal c3d file.
+
+    params is a dict of {group: {param: value}}, points is a (n_frames,
+    n_points, 3) array, residuals is (n_frames, n_points) and analog is
+    (n_frames * spf, n_channels). Negative scale writes float data.
+    """
+    records = b''
+    for gid, (group, pars) in enumerate(params.items(), 1):
+        gname = group.encode('latin-1')
+        records += struct.pack('<bb', len(gname), -gid) + gname + b'\x03\x00\x00'
+        for par, val in pars.items():
+            records += _param_record(gid, par, val)
+    records += b'\x00\x00'
+    n_param_blocks = (len(records) + 4) // 512 + 1
+    param_section = bytes([1, 80, n_param_blocks, 84]) + records
+    param_section = param_section.ljust(n_param_blocks * 512, b'\x00')
+    n_frames, n_points, _ = points.shape
+    n_analog = analog.shape[1]
+    header = struct.pack(
+        '<BBhhHHhfhhf',
+        2,
+        0x50,
+        n_points,
+        n_analog * spf,
+        1,
+        n_frames,
+        0,
+        scale,
+        2 + n_param_blocks,
+        spf,
+        rate,
+    ).ljust(512, b'\x00')
+    pdata = np.concatenate([points, residuals[:, :, None]], axis=2)
+    adata = analog.reshape(n_frames, spf * n_analog)
+    if scale < 0:
+        data = np.hstack([pdata.reshape(n_frames, -1), adata]).astype('<f4')
+    else:
+        pdata[:, :, :3] /= scale
+        data = np.hstack([pdata.reshape(n_frames, -1), adata])
+        data = np.round(data).astype('<i2')
+    with open(fn, 'wb') as f:
+        f.write(header + param_section + data.tobytes())
+
+
+def _make_synthetic_c3d(
+    fn,
+    n_frames=50,
+    scale=-1.0,
+    events=None,
+    markers=None,
+    forces=None,
+    subj_params=None,
+):
+    """Write a synthetic c3d file with markers, EMG and a forceplate.
+
+    events is a list of (label, context, time) tuples and markers is a dict of
+    marker data (n_frames x 3 arrays) that are written in addition to two
+    random markers and a model variable. forces is a (n_frames * 10, 6) array
+    of forceplate channel data (before the gain of 2); if None, random data is
+    written. subj_params is a dict of additional subject parameters, e.g.
+    {'RFootLen': 250.0}. Negative scale writes float data.
+    Returns the points, residuals, analog data and parameters that were
+    written.
+    """
+    spf, rate = 10, 100.0
+    rng = np.random.default_rng(0)
+    labels = ['RHEE', 'LHEE', 'RKneeAngles']
+    points = np.round(rng.uniform(-1000, 1000, size=(n_frames, 3, 3)), 1)
+    markers = markers or dict()
+    for marker, data in markers.items():
+        if marker in labels:
+            points[:, labels.index(marker), :] = data
+        else:
+            labels.append(marker)
+            points = np.concatenate([points, data[:, None, :]], axis=1)
+    residuals = np.zeros(points.shape[:2])
+    if 'RHEE' not in markers:
+        residuals[10:20, 0] = -1  # gap in first marker
+    # forceplate channels followed by EMG channels
+    analog = np.round(rng.uniform(-1000, 1000, size=(n_frames * spf, 8)))
+    if forces is not None:
+        analog[:, :6] = forces
+    corners = np.array(
+        [[500, 600, 0], [0, 600, 0], [0, 0, 0], [500, 0, 0]], dtype=float
+    ).T[:, :, None]
+    if events is None:
+        events = [
+            ('Foot Strike', 'Right', 0.05),
+            ('Foot Off', 'Right', 0.2),
+            ('Foot Strike', 'Left', 0.31),
+        ]
+    params = {
+        'POINT': {
+            'USED': np.array(len(labels)),
+            'SCALE': np.array(scale),
+            'RATE': np.array(rate),
+            'LABELS': labels,
+        },
+        'ANALOG': {
+            'USED': np.array(8),
+            'LABELS': ['Force.Fx1', 'Force.Fy1', 'Force.Fz1', 'Moment.Mx1']
+            + ['Moment.My1', 'Moment.Mz1', 'Voltage.LGas', 'Voltage.RGas'],
+            'DESCRIPTIONS': ['Force Plate'] * 6 + ['Noraxon EMG'] * 2,
+            'SCALE': np.array([1.0] * 6 + [0.5, 0.25]),
+            'OFFSET': np.array([0] * 6 + [10, 0]),
+            'GEN_SCALE': np.array(2.0),
+            'RATE': np.array(rate * spf),
+            'FORMAT': 'SIGNED',
+        },
+        'EVENT': {
+            'USED': np.array(len(events)),
+            'LABELS': [ev[0] for ev in events],
+            'CONTEXTS': [ev[1] for ev in events],
+            'TIMES': np.array([[0, ev[2]] for ev in events]).T,
+        },
+        'SUBJECTS': {'NAMES': ['Testsubject']},
+        'PROCESSING': {'Bodymass': np.array(70.0), 'RTibialTorsion': np.array(0.1)},
+        'FORCE_PLATFORM': {
+            'USED': np.array(1),
+            'TYPE': np.array([2]),
+            'CORNERS': corners,
+            'ORIGIN': np.array([[0.0], [0.0], [-40.0]]),
+            'CHANNEL': np.arange(1, 7)[:, None],
+        },
+    }
+    if subj_params is not None:
+        params['PROCESSING'].update(
+            {par: np.array(val) for par, val in subj_params.items()}
+        )
+    _write_c3d(fn, params, points, residuals, analog, spf, rate, scale=scale)
+    return points, residuals, analog, params
+
+
+def _make_walking_markers(n_frames=400, rate=100.0, cycle_len=1.0, rng=None):
+    """Marker data for straight walking along the x axis.
+
+    Each foot is stationary during stance (60% of the cycle) and moves forward
+    smoothly during swing. Returns a dict of marker data for the foot and
+    pelvis markers, and the expected 0-based strike and toeoff frames as a
+    dict keyed by e.g. 'R_strikes'.
+    """
+    if rng is None:
+        rng = np.random.default_rng(0)
+    speed = 1200.0  # mm/s
+    stride = speed * cycle_len
+    t = np.arange(n_frames) / rate
+    mkrdata = dict()
+    events = dict()
+    for context, phase_offset, y in [('R', 0.0, -100.0), ('L', 0.5, 100.0)]:
+        phase = t / cycle_len + phase_offset
+        ncycle, cphase = np.divmod(phase, 1)
+        # position within the cycle; swing is 0.6..1
+        swing = np.clip((cphase - 0.6) / 0.4, 0, 1)
+        x = stride * (ncycle - phase_offset + (1 - np.cos(np.pi * swing)) / 2)
+        z = 50 * np.sin(np.pi * swing)
+        foot = np.stack([x, np.full(n_frames, y), z], axis=1)
+        for marker, offset in [('HEE', -100), ('ANK', -50), ('TOE', 150)]:
+            mkrdata[context + marker] = foot + [offset, 0, 60 if marker == 'ANK' else 0]
+        cycle_starts = (np.arange(-1, t[-1] / cycle_len + 2) - phase_offset) * cycle_len
+        strikes = np.round(cycle_starts * rate).astype(int)
+        toeoffs = np.round((cycle_starts + 0.6 * cycle_len) * rate).astype(int)
+        events[context + '_strikes'] = strikes[(strikes > 0) & (strikes < n_frames)]
+        events[context + '_toeoffs'] = toeoffs[(toeoffs > 0) & (toeoffs < n_frames)]
+    pelvis = np.stack([speed * t, np.zeros(n_frames), np.full(n_frames, 900.0)], 1)
+    mkrdata['RASI'] = pelvis + [100, -120, 0]
+    mkrdata['LASI'] = pelvis + [100, 120, 0]
+    for marker in mkrdata:
+        mkrdata[marker] += rng.normal(scale=0.2, size=(n_frames, 3))
+    return mkrdata, events